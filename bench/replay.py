@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+##
+##  replay.py - benchmark for decoding and encoding a captured session.
+##
+##  Replays a capture file (saved with flvrec.py -W) as fast as possible
+##  and reports the time spent without any network.
+##  With -l, it is replayed at the original speed and the CPU time
+##  shows the load of a live recording.
+##
+
+import sys, time
+from vnc2flv.rfb import RFBFileClient
+from vnc2flv.video import FLVVideoSink
+
+
+##  NullWriter
+##
+class NullWriter(object):
+
+    def __init__(self):
+        self.nframes = 0
+        self.nbytes = 0
+        return
+
+    def set_screen_size(self, width, height):
+        return
+
+    def write_video_frame(self, timestamp, data):
+        self.nframes += 1
+        self.nbytes += len(data)
+        return
+
+
+def bench(fname, blocksize, framerate, realtime=False):
+    writer = NullWriter()
+    sink = FLVVideoSink(writer, blocksize=blocksize, framerate=framerate)
+    fp = file(fname, 'rb')
+    client = RFBFileClient(fp, sink, realtime=realtime)
+    t0 = time.time()
+    c0 = time.clock()
+    client.open()
+    try:
+        while 1:
+            client.idle()
+    except EOFError:
+        pass
+    client.close()
+    t1 = time.time()
+    c1 = time.clock()
+    fp.close()
+    return (writer, client.time(), t1-t0, c1-c0)
+
+# main
+def main(argv):
+    import getopt
+    def usage():
+        print 'usage: %s [-l] [-r framerate] [-B blocksize] capturefile' % argv[0]
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], 'lr:B:')
+    except getopt.GetoptError:
+        return usage()
+    framerate = 12
+    blocksize = 32
+    realtime = False
+    for (k, v) in opts:
+        if k == '-l': realtime = True
+        elif k == '-r': framerate = int(v)
+        elif k == '-B': blocksize = int(v)
+    if not args: return usage()
+    (writer, duration, dt, cpu) = bench(args[0], blocksize, framerate, realtime)
+    print '%s: %.1fs session, %d frames, %d bytes in %.3fs (%.1f fps), cpu %.3fs' % \
+          (args[0], duration*.001, writer.nframes, writer.nbytes, dt, writer.nframes/dt, cpu)
+    return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
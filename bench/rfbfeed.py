@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+##
+##  rfbfeed.py - benchmark for RFBProxy.feed.
+##
+##  Feeds a synthetic server stream that consists of full-screen
+##  raw updates and reports the number of bytes processed per second.
+##
+
+import sys, time
+from struct import pack
+from vnc2flv.rfb import RFBProxy
+from vnc2flv.video import VideoSink
+
+
+##  NullSink
+##
+class NullSink(VideoSink):
+
+    def init_screen(self, width, height, name=None):
+        return (0, 0, width, height)
+
+
+##  BenchProxy
+##
+class BenchProxy(RFBProxy):
+
+    def send(self, s):
+        return
+
+
+##  LegacyProxy
+##
+##  The previous implementation that concatenates and slices strings.
+##
+class LegacyProxy(BenchProxy):
+
+    def open(self):
+        RFBProxy.open(self)
+        self._curbuf = ''
+        return
+
+    def feed(self, data):
+        self._curbuf += data
+        while 1:
+            if self._length < 0:
+                # a greedy state takes all the data (see RFBProxy.feed_buffer).
+                if len(self._curbuf) < -self._length: break
+                (n, (self._length, self._state)) = self._state(memoryview(self._curbuf))
+                self._curbuf = self._curbuf[n:]
+            else:
+                if len(self._curbuf) < self._length: break
+                x = self._curbuf[:self._length]
+                self._curbuf = self._curbuf[self._length:]
+                (self._length, self._state) = self._state(memoryview(x))
+        return
+
+
+def make_stream(width, height, nframes):
+    # handshake: protocol 3.3, no authentication.
+    pixelformat = pack('>BBBBHHHBBBxxx', 32, 24, 1, 1, 255, 255, 255, 24, 16, 8)
+    name = 'bench'
+    yield 'RFB 003.003\x0a' + pack('>L', 1)
+    yield pack('>HH16sL', width, height, pixelformat, len(name)) + name
+    # full-screen raw updates.
+    pixels = '\x12\x34\x56\x00' * (width*height)
+    for _ in xrange(nframes):
+        yield '\x00\x00' + pack('>H', 1) + pack('>HHHHl', 0, 0, width, height, 0)
+        yield pixels
+    return
+
+def chunks(stream, bufsiz):
+    for data in stream:
+        for i in xrange(0, len(data), bufsiz):
+            yield data[i:i+bufsiz]
+    return
+
+def bench(klass, width, height, nframes, bufsiz):
+    data = list(chunks(make_stream(width, height, nframes), bufsiz))
+    total = sum( len(x) for x in data )
+    proxy = klass(NullSink(), bufsiz=bufsiz)
+    proxy.open()
+    t0 = time.time()
+    for x in data:
+        proxy.feed(x)
+    t1 = time.time()
+    return (total, t1-t0)
+
+# main
+def main(argv):
+    import getopt
+    def usage():
+        print 'usage: %s [-n nframes] [-b bufsiz] [WxH]' % argv[0]
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], 'n:b:')
+    except getopt.GetoptError:
+        return usage()
+    nframes = 10
+    bufsiz = 65536
+    (width, height) = (1920, 1080)
+    for (k, v) in opts:
+        if k == '-n': nframes = int(v)
+        elif k == '-b': bufsiz = int(v)
+    if args:
+        (width, height) = map(int, args[0].split('x'))
+    for (name, klass) in (('legacy', LegacyProxy), ('buffer', BenchProxy)):
+        (total, dt) = bench(klass, width, height, nframes, bufsiz)
+        print '%s: %dx%d, %d frames, %d bytes in %.3fs (%.1f MB/s)' % \
+              (name, width, height, nframes, total, dt, total/dt/1e6)
+    return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+##
+##  rfbrects.py - benchmark for decoding many small rectangles.
+##
+##  Feeds updates that consist of thousands of small raw, rre and
+##  hextile rectangles, with and without the native rectangle decoder.
+##
+
+import sys, time, random
+from struct import pack
+from vnc2flv.rfb import RFBProxy
+from vnc2flv.video import FLVVideoSink
+
+
+##  NullWriter
+##
+class NullWriter(object):
+
+    def set_screen_size(self, width, height):
+        return
+
+    def write_video_frame(self, timestamp, data):
+        return
+
+
+##  BenchProxy
+##
+class BenchProxy(RFBProxy):
+
+    def send(self, s):
+        return
+
+
+##  BenchSink
+##
+##  Decodes the rectangles but does not encode frames.
+##
+class BenchSink(FLVVideoSink):
+
+    def flush(self, t):
+        self.screen.reset()
+        return
+
+
+##  SlowSink
+##
+##  Decodes every rectangle in Python.
+##
+class SlowSink(BenchSink):
+
+    def update_screen_rects(self, data, nrects):
+        return (0, 0)
+
+
+def make_rect(width, height):
+    (x, y) = (random.randrange(width-8), random.randrange(height-8))
+    color = pack('>L', random.randrange(1 << 24) << 8)
+    k = random.randrange(3)
+    if k == 0:
+        # raw 8x8
+        return pack('>HHHHl', x, y, 8, 8, 0) + color*64
+    elif k == 1:
+        # rre 8x8 with one subrect
+        return pack('>HHHHl', x, y, 8, 8, 2) + pack('>L', 1) + color + color + pack('>HHHH', 2, 2, 4, 4)
+    else:
+        # hextile 8x8 of a solid tile
+        return pack('>HHHHl', x, y, 8, 8, 5) + '\x02' + color
+
+def make_stream(width, height, nframes, nrects):
+    # handshake: protocol 3.3, no authentication.
+    pixelformat = pack('>BBBBHHHBBBxxx', 32, 24, 1, 1, 255, 255, 255, 24, 16, 8)
+    name = 'bench'
+    data = 'RFB 003.003\x0a' + pack('>L', 1)
+    data += pack('>HH16sL', width, height, pixelformat, len(name)) + name
+    for _ in xrange(nframes):
+        data += '\x00\x00' + pack('>H', nrects)
+        data += ''.join( make_rect(width, height) for _ in xrange(nrects) )
+    return data
+
+def bench(klass, data, bufsiz):
+    proxy = BenchProxy(klass(NullWriter()), bufsiz=bufsiz)
+    proxy.open()
+    t0 = time.time()
+    for i in xrange(0, len(data), bufsiz):
+        proxy.feed(data[i:i+bufsiz])
+    t1 = time.time()
+    return t1-t0
+
+# main
+def main(argv):
+    import getopt
+    def usage():
+        print 'usage: %s [-n nframes] [-r nrects] [-b bufsiz] [WxH]' % argv[0]
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], 'n:r:b:')
+    except getopt.GetoptError:
+        return usage()
+    nframes = 10
+    nrects = 5000
+    bufsiz = 65536
+    (width, height) = (1920, 1080)
+    for (k, v) in opts:
+        if k == '-n': nframes = int(v)
+        elif k == '-r': nrects = int(v)
+        elif k == '-b': bufsiz = int(v)
+    if args:
+        (width, height) = map(int, args[0].split('x'))
+    random.seed(0)
+    data = make_stream(width, height, nframes, nrects)
+    for (name, klass) in (('python', SlowSink), ('native', BenchSink)):
+        dt = bench(klass, data, bufsiz)
+        print '%s: %d frames x %d rects in %.3fs (%.0f rects/s)' % \
+              (name, nframes, nrects, dt, nframes*nrects/dt)
+    return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -10,6 +10,8 @@
 #include <string.h>
 #include <Python.h>
 #include <structmember.h>
+#include <zlib.h>
+#include <pthread.h>
 
 
 /*  FLVScreen
@@ -30,6 +32,24 @@ typedef struct _FLVPixel {
     unsigned char red;
 } FLVPixel;
 
+/* CompressedBlock: the last compressed data of a block */
+typedef struct _CompressedBlock {
+    unsigned char* data;
+    uLong length;
+    int level;
+} CompressedBlock;
+
+/* CacheEntry: a block in the content-addressed cache */
+typedef struct _CacheEntry {
+    uLong hash;			/* crc32 of the FLV pixels */
+    int level;
+    unsigned char* pixels;	/* the FLV pixels, compared on a hit */
+    unsigned char* data;
+    uLong length;
+    int prev, next;		/* in the recently used order */
+    int chain;			/* the next entry in the same bucket */
+} CacheEntry;
+
 /* FlvScreen class internal data */
 typedef struct _PyFlvScreen {
     PyObject_HEAD
@@ -37,26 +57,400 @@ typedef struct _PyFlvScreen {
     int blk_width, blk_height;
     int pix_width, pix_height;
     unsigned char* blocks;
+    int dirty_count;		/* the number of the marked blocks */
+    int dirty_x0, dirty_y0, dirty_x1, dirty_y1;	/* and their bounding box */
     RGBAPixel* pixels;
     FLVPixel* tmppix;
+    /* pixel format of the incoming data */
+    int pix_bytes;
+    int bigendian;
+    int red_max, green_max, blue_max;
+    int red_shift, green_shift, blue_shift;
+    int rgbx;			/* the data can be copied as RGBAPixel */
+    int cpix_bytes;		/* size of ZRLE CPIXEL */
+    int cpix_offset;		/* position of CPIXEL in a pixel */
+    int tpix_bytes;		/* size of Tight TPIXEL */
+    RGBAPixel* lut;		/* lookup table for 8/16bit pixels */
+    /* cursor overlay (ARGB), composited in get() */
+    unsigned char* cur_image;
+    int cur_width, cur_height;
+    int cur_hotx, cur_hoty;
+    int cur_x, cur_y;
+    /* compressed blocks, reused until the block is changed */
+    unsigned char* stale;	/* the compressed block is out of date */
+    CompressedBlock* compressed;
+    /* LRU cache of the compressed blocks keyed by the content */
+    CacheEntry* cache;
+    int cache_size, cache_used;
+    int* cache_buckets;
+    int cache_nbuckets;
+    int cache_head, cache_tail;
+    int busy;			/* encode_frame() is running without the GIL */
 } PyFlvScreen;
 
 /* FlvScreen.FlvError exception object */
 static PyObject* PyExc_FlvError;
 
 
-/* Utility functions
+/* Pixel format functions
+ */
+
+/* set_format: set the pixel format.
+ *   returns -1 if the format is not supported.
+ */
+static int
+set_format(PyFlvScreen* self, int bpp, int depth, int bigendian, int truecolour,
+	   int red_max, int green_max, int blue_max,
+	   int red_shift, int green_shift, int blue_shift)
+{
+    RGBAPixel* lut = NULL;
+    unsigned long mask;
+
+    if (!truecolour) return -1;
+    if (bpp != 8 && bpp != 16 && bpp != 32) return -1;
+    if (red_max <= 0 || green_max <= 0 || blue_max <= 0) return -1;
+    mask = (((unsigned long)red_max << red_shift) |
+	    ((unsigned long)green_max << green_shift) |
+	    ((unsigned long)blue_max << blue_shift));
+    if (bpp < 32 && (mask >> bpp) != 0) return -1;
+
+    self->pix_bytes = bpp/8;
+    self->bigendian = bigendian;
+    self->red_max = red_max;
+    self->green_max = green_max;
+    self->blue_max = blue_max;
+    self->red_shift = red_shift;
+    self->green_shift = green_shift;
+    self->blue_shift = blue_shift;
+    /* big-endian RGBX is the same as RGBAPixel. */
+    self->rgbx = (bpp == 32 && bigendian &&
+		  red_max == 255 && green_max == 255 && blue_max == 255 &&
+		  red_shift == 24 && green_shift == 16 && blue_shift == 8);
+    /* ZRLE omits the unused byte of 32bit pixels. */
+    self->cpix_bytes = self->pix_bytes;
+    self->cpix_offset = 0;
+    if (bpp == 32 && depth <= 24) {
+	if ((mask & 0xff000000UL) == 0) {
+	    /* the least significant 3 bytes */
+	    self->cpix_bytes = 3;
+	    self->cpix_offset = bigendian? 1 : 0;
+	} else if ((mask & 0xffUL) == 0) {
+	    /* the most significant 3 bytes */
+	    self->cpix_bytes = 3;
+	    self->cpix_offset = bigendian? 0 : 1;
+	}
+    }
+    /* Tight sends 24bit colors as RGB. */
+    self->tpix_bytes = self->pix_bytes;
+    if (bpp == 32 && depth == 24 &&
+	red_max == 255 && green_max == 255 && blue_max == 255) {
+	self->tpix_bytes = 3;
+    }
+
+    if (bpp <= 16) {
+	/* precompute all the pixel values. */
+	unsigned int v;
+	lut = (RGBAPixel*)PyMem_Malloc((1 << bpp) * sizeof(RGBAPixel));
+	if (lut == NULL) return -1;
+	for (v = 0; v < (1U << bpp); v++) {
+	    lut[v].red = ((v >> red_shift) & red_max) * 255 / red_max;
+	    lut[v].green = ((v >> green_shift) & green_max) * 255 / green_max;
+	    lut[v].blue = ((v >> blue_shift) & blue_max) * 255 / blue_max;
+	    lut[v].alpha = 0;
+	}
+    }
+    PyMem_Free(self->lut);
+    self->lut = lut;
+    return 0;
+}
+
+/* pixel_value: get a pixel value from the data.
+ */
+static unsigned long
+pixel_value(const PyFlvScreen* self, const unsigned char* p)
+{
+    switch (self->pix_bytes) {
+    case 1:
+	return p[0];
+    case 2:
+	return (self->bigendian)? (p[0] << 8 | p[1]) : (p[1] << 8 | p[0]);
+    default:
+	return (self->bigendian)?
+	    ((unsigned long)p[0] << 24 | p[1] << 16 | p[2] << 8 | p[3]) :
+	    ((unsigned long)p[3] << 24 | p[2] << 16 | p[1] << 8 | p[0]);
+    }
+}
+
+/* read_pixel: convert a pixel in the data to RGBAPixel.
+ */
+static void
+read_pixel(const PyFlvScreen* self, const unsigned char* p, RGBAPixel* dst)
+{
+    unsigned long v;
+    if (self->rgbx) {
+	memcpy(dst, p, sizeof(RGBAPixel));
+	return;
+    }
+    v = pixel_value(self, p);
+    if (self->lut != NULL) {
+	*dst = self->lut[v];
+	return;
+    }
+    dst->red = ((v >> self->red_shift) & self->red_max) * 255 / self->red_max;
+    dst->green = ((v >> self->green_shift) & self->green_max) * 255 / self->green_max;
+    dst->blue = ((v >> self->blue_shift) & self->blue_max) * 255 / self->blue_max;
+    dst->alpha = 0;
+}
+
+/* read_pixels: convert n pixels in the data to RGBAPixel.
+ */
+static void
+read_pixels(const PyFlvScreen* self, const unsigned char* p, RGBAPixel* dst, int n)
+{
+    if (self->rgbx) {
+	memcpy(dst, p, n * sizeof(RGBAPixel));
+    } else if (self->pix_bytes == 1) {
+	for (; 0 < n; n--, p++, dst++) {
+	    *dst = self->lut[*p];
+	}
+    } else {
+	for (; 0 < n; n--, p += self->pix_bytes, dst++) {
+	    read_pixel(self, p, dst);
+	}
+    }
+}
+
+/* read_cpixel: convert a ZRLE CPIXEL to RGBAPixel.
  */
-static int idiv(int x, int y)
+static void
+read_cpixel(const PyFlvScreen* self, const unsigned char* p, RGBAPixel* dst)
 {
-    if (0 <= x) {
-	return x/y;
+    if (self->cpix_bytes == 3) {
+	unsigned char buf[4] = { 0, 0, 0, 0 };
+	memcpy(buf + self->cpix_offset, p, 3);
+	read_pixel(self, buf, dst);
     } else {
-	return (x-y+1)/y;
+	read_pixel(self, p, dst);
+    }
+}
+
+/* read_tpixel: convert a Tight TPIXEL to RGBAPixel.
+ */
+static void
+read_tpixel(const PyFlvScreen* self, const unsigned char* p, RGBAPixel* dst)
+{
+    if (self->tpix_bytes == 3) {
+	dst->red = p[0];
+	dst->green = p[1];
+	dst->blue = p[2];
+	dst->alpha = 0;
+    } else {
+	read_pixel(self, p, dst);
     }
 }
 
 
+/* Block marking functions
+ */
+
+/* set_marks: mark all the blocks changed or unchanged.
+ */
+static void
+set_marks(PyFlvScreen* self, int marked)
+{
+    memset(self->blocks, marked, self->blk_width * self->blk_height);
+    if (marked) {
+	self->dirty_count = self->blk_width * self->blk_height;
+	self->dirty_x0 = self->dirty_y0 = 0;
+	self->dirty_x1 = self->blk_width;
+	self->dirty_y1 = self->blk_height;
+    } else {
+	self->dirty_count = 0;
+	self->dirty_x0 = self->blk_width;
+	self->dirty_y0 = self->blk_height;
+	self->dirty_x1 = self->dirty_y1 = 0;
+    }
+}
+
+/* mark_block: mark a block changed.
+ *   its compressed data is also out of date.
+ */
+static void
+mark_block(PyFlvScreen* self, int bx, int by)
+{
+    int i = by*self->blk_width + bx;
+    self->stale[i] = 1;
+    if (self->blocks[i] == 0) {
+	self->blocks[i] = 1;
+	self->dirty_count++;
+	if (bx < self->dirty_x0) self->dirty_x0 = bx;
+	if (by < self->dirty_y0) self->dirty_y0 = by;
+	if (self->dirty_x1 <= bx) self->dirty_x1 = bx+1;
+	if (self->dirty_y1 <= by) self->dirty_y1 = by+1;
+    }
+}
+
+
+/* Block cache functions
+ */
+
+/* free_compressed: discard all the compressed blocks.
+ */
+static void
+free_compressed(PyFlvScreen* self)
+{
+    int i;
+    for (i = 0; i < self->blk_width * self->blk_height; i++) {
+	if (self->compressed[i].data != NULL) {
+	    PyMem_Free(self->compressed[i].data);
+	}
+    }
+    memset(self->compressed, 0, self->blk_width * self->blk_height * sizeof(CompressedBlock));
+}
+
+/* store_compressed: keep the compressed data of a block.
+ *   returns -1 if no memory.
+ */
+static int
+store_compressed(PyFlvScreen* self, int i, int level, const unsigned char* data, uLong length)
+{
+    CompressedBlock* blk = &self->compressed[i];
+    unsigned char* p = PyMem_Realloc(blk->data, length);
+    if (p == NULL) return -1;
+    memcpy(p, data, length);
+    blk->data = p;
+    blk->length = length;
+    blk->level = level;
+    self->stale[i] = 0;
+    return 0;
+}
+
+/* free_cache: discard the LRU cache.
+ */
+static void
+free_cache(PyFlvScreen* self)
+{
+    int i;
+    if (self->cache != NULL) {
+	for (i = 0; i < self->cache_size; i++) {
+	    PyMem_Free(self->cache[i].pixels);
+	    PyMem_Free(self->cache[i].data);
+	}
+	PyMem_Free(self->cache);
+	self->cache = NULL;
+    }
+    if (self->cache_buckets != NULL) {
+	PyMem_Free(self->cache_buckets);
+	self->cache_buckets = NULL;
+    }
+    self->cache_size = self->cache_used = 0;
+    self->cache_nbuckets = 0;
+    self->cache_head = self->cache_tail = -1;
+}
+
+/* cache_unlink: remove an entry from the recently used list.
+ */
+static void
+cache_unlink(PyFlvScreen* self, int i)
+{
+    CacheEntry* e = &self->cache[i];
+    if (e->prev < 0) {
+	self->cache_head = e->next;
+    } else {
+	self->cache[e->prev].next = e->next;
+    }
+    if (e->next < 0) {
+	self->cache_tail = e->prev;
+    } else {
+	self->cache[e->next].prev = e->prev;
+    }
+}
+
+/* cache_push: put an entry at the head of the recently used list.
+ */
+static void
+cache_push(PyFlvScreen* self, int i)
+{
+    CacheEntry* e = &self->cache[i];
+    e->prev = -1;
+    e->next = self->cache_head;
+    if (self->cache_head < 0) {
+	self->cache_tail = i;
+    } else {
+	self->cache[self->cache_head].prev = i;
+    }
+    self->cache_head = i;
+}
+
+/* cache_find: look up a block in the LRU cache.
+ *   returns the entry or NULL.
+ */
+static CacheEntry*
+cache_find(PyFlvScreen* self, uLong hash, int level, const unsigned char* pixels)
+{
+    int blk_bytes = self->blk_size * self->blk_size * sizeof(FLVPixel);
+    int i = self->cache_buckets[hash & (self->cache_nbuckets-1)];
+    for (; 0 <= i; i = self->cache[i].chain) {
+	CacheEntry* e = &self->cache[i];
+	if (e->hash == hash && e->level == level &&
+	    memcmp(e->pixels, pixels, blk_bytes) == 0) {
+	    cache_unlink(self, i);
+	    cache_push(self, i);
+	    return e;
+	}
+    }
+    return NULL;
+}
+
+/* cache_insert: add a block to the LRU cache.
+ *   the least recently used entry is dropped when it is full.
+ */
+static void
+cache_insert(PyFlvScreen* self, uLong hash, int level, const unsigned char* pixels,
+	     const unsigned char* data, uLong length)
+{
+    int blk_bytes = self->blk_size * self->blk_size * sizeof(FLVPixel);
+    CacheEntry* e;
+    int i;
+
+    if (self->cache_used < self->cache_size) {
+	i = self->cache_used++;
+    } else {
+	/* remove the oldest one from its bucket. */
+	int* p;
+	i = self->cache_tail;
+	e = &self->cache[i];
+	p = &self->cache_buckets[e->hash & (self->cache_nbuckets-1)];
+	while (*p != i) {
+	    p = &self->cache[*p].chain;
+	}
+	*p = e->chain;
+	cache_unlink(self, i);
+    }
+    e = &self->cache[i];
+    e->hash = hash;
+    e->level = level;
+    memcpy(e->pixels, pixels, blk_bytes);
+    memcpy(e->data, data, length);
+    e->length = length;
+    e->chain = self->cache_buckets[hash & (self->cache_nbuckets-1)];
+    self->cache_buckets[hash & (self->cache_nbuckets-1)] = i;
+    cache_push(self, i);
+}
+
+
+/* check_busy: the screen cannot be changed while it is being encoded.
+ */
+static int
+check_busy(PyFlvScreen* self)
+{
+    if (self->busy) {
+	PyErr_SetString(PyExc_FlvError, "screen is being encoded");
+	return -1;
+    }
+    return 0;
+}
+
 /* FlvScreen(block_size, width, height)
  *   Constructor.
  */
@@ -73,12 +467,20 @@ FlvScreen_init(PyFlvScreen* self, PyObject* args, PyObject* kwargs)
     if (self->blocks == NULL) return -1;
     self->tmppix = PyMem_Malloc(blk_size * blk_size * sizeof(FLVPixel));
     if (self->tmppix == NULL) return -1;
-    memset(self->blocks, 1, blk_width * blk_height);
+    set_marks(self, 1);
+    self->stale = PyMem_Malloc(blk_width * blk_height);
+    if (self->stale == NULL) return -1;
+    memset(self->stale, 1, blk_width * blk_height);
+    self->compressed = PyMem_Malloc(blk_width * blk_height * sizeof(CompressedBlock));
+    if (self->compressed == NULL) return -1;
+    memset(self->compressed, 0, blk_width * blk_height * sizeof(CompressedBlock));
     self->pix_width = blk_width * blk_size;
     self->pix_height = blk_height * blk_size;
     self->pixels = PyMem_Malloc(self->pix_width * self->pix_height * sizeof(RGBAPixel));
     if (self->pixels == NULL) return -1;
     memset(self->pixels, 0, self->pix_width * self->pix_height * sizeof(RGBAPixel));
+    /* 32bit big-endian RGBX by default. */
+    if (set_format(self, 32, 24, 1, 1, 255, 255, 255, 24, 16, 8) < 0) return -1;
     return 0;
 }
 
@@ -93,6 +495,19 @@ FlvScreen_new(PyTypeObject* type, PyObject* args, PyObject* kwargs)
     self->blocks = NULL;
     self->pixels = NULL;
     self->tmppix = NULL;
+    self->lut = NULL;
+    self->cur_image = NULL;
+    self->cur_width = self->cur_height = 0;
+    self->cur_hotx = self->cur_hoty = 0;
+    self->cur_x = self->cur_y = 0;
+    self->stale = NULL;
+    self->compressed = NULL;
+    self->cache = NULL;
+    self->cache_size = self->cache_used = 0;
+    self->cache_buckets = NULL;
+    self->cache_nbuckets = 0;
+    self->cache_head = self->cache_tail = -1;
+    self->busy = 0;
     return (PyObject*)self;
 }
 
@@ -101,7 +516,6 @@ FlvScreen_new(PyTypeObject* type, PyObject* args, PyObject* kwargs)
 static void
 FlvScreen_dealloc(PyFlvScreen* self)
 {
-    self->ob_type->tp_free((PyObject*) self);
     if (self->blocks != NULL) {
 	PyMem_Free(self->blocks);
     }
@@ -111,107 +525,938 @@ FlvScreen_dealloc(PyFlvScreen* self)
     if (self->tmppix != NULL) {
 	PyMem_Free(self->tmppix);
     }
+    if (self->lut != NULL) {
+	PyMem_Free(self->lut);
+    }
+    if (self->cur_image != NULL) {
+	PyMem_Free(self->cur_image);
+    }
+    if (self->stale != NULL) {
+	PyMem_Free(self->stale);
+    }
+    if (self->compressed != NULL) {
+	free_compressed(self);
+	PyMem_Free(self->compressed);
+    }
+    free_cache(self);
+    self->ob_type->tp_free((PyObject*) self);
+}
+
+
+/* Drawing functions
+ */
+
+/* copy_pixels: copy the pixels where they differ.
+ *   the comparison stops at the first difference and the rest is
+ *   simply copied. returns non-zero if anything is changed.
+ */
+#define COMPARE_CHUNK 64
+
+static int
+copy_pixels(RGBAPixel* dst, const RGBAPixel* src, int n)
+{
+    int i;
+    for (i = 0; i < n; i += COMPARE_CHUNK) {
+	int k = (n-i < COMPARE_CHUNK)? n-i : COMPARE_CHUNK;
+	if (memcmp(&dst[i], &src[i], k * sizeof(RGBAPixel))) {
+	    memcpy(&dst[i], &src[i], (n-i) * sizeof(RGBAPixel));
+	    return 1;
+	}
+    }
+    return 0;
+}
+
+/* blit_pixels: copy the pixels and mark the changed blocks.
+ *   returns the number of changed lines.
+ */
+static int
+blit_pixels(PyFlvScreen* self, int px, int py, int pw, int ph, const RGBAPixel* src)
+{
+    int changes = 0;
+    int blk_size = self->blk_size;
+    int x0 = (px < 0)? 0 : px;
+    int x1 = (self->pix_width < px+pw)? self->pix_width : px+pw;
+
+    if (x1 <= x0) return 0;
+    for (; 0 < ph; ph--, py++, src += pw) {
+	const RGBAPixel* s = src + (x0-px);
+	RGBAPixel* dst;
+	int by, b, x, n;
+	int changed = 0;
+	if (py < 0 || self->pix_height <= py) continue;
+	dst = &self->pixels[py*self->pix_width];
+	/* skip an unchanged line at once. */
+	if (memcmp(&dst[x0], s, (x1-x0) * sizeof(RGBAPixel)) == 0) continue;
+	by = py / blk_size;
+	b = by * self->blk_width;
+	for (x = x0; x < x1; x += n, s += n) {
+	    int bx = x / blk_size;
+	    n = (bx+1)*blk_size - x;
+	    if (x1-x < n) n = x1-x;
+	    if (changed && self->blocks[b+bx] && self->stale[b+bx]) {
+		/* this line and the block are known changed. */
+		memcpy(&dst[x], s, n * sizeof(RGBAPixel));
+	    } else if (copy_pixels(&dst[x], s, n)) {
+		mark_block(self, bx, by);
+		changed = 1;
+	    }
+	}
+	if (changed) {
+	    changes++;
+	}
+    }
+
+    return changes;
+}
+
+/* mark_pixels: mark the blocks in the area changed.
+ */
+static void
+mark_pixels(PyFlvScreen* self, int px, int py, int pw, int ph)
+{
+    int blk_size = self->blk_size;
+    int x0 = (px < 0)? 0 : px;
+    int y0 = (py < 0)? 0 : py;
+    int x1 = (self->pix_width < px+pw)? self->pix_width : px+pw;
+    int y1 = (self->pix_height < py+ph)? self->pix_height : py+ph;
+    int bx, by;
+
+    if (x1 <= x0 || y1 <= y0) return;
+    for (by = y0/blk_size; by <= (y1-1)/blk_size; by++) {
+	for (bx = x0/blk_size; bx <= (x1-1)/blk_size; bx++) {
+	    mark_block(self, bx, by);
+	}
+    }
+}
+
+/* mark_cursor: mark the blocks under the cursor changed.
+ */
+static void
+mark_cursor(PyFlvScreen* self)
+{
+    if (self->cur_image == NULL) return;
+    mark_pixels(self, self->cur_x - self->cur_hotx, self->cur_y - self->cur_hoty,
+		self->cur_width, self->cur_height);
+}
+
+/* fill_pixels: fill the area with a color and mark the changed blocks.
+ *   returns the number of changed lines.
+ */
+static int
+fill_pixels(PyFlvScreen* self, int px, int py, int pw, int ph, RGBAPixel color)
+{
+    int changes = 0;
+    int blk_size = self->blk_size;
+    int x0 = (px < 0)? 0 : px;
+    int y0 = (py < 0)? 0 : py;
+    int x1 = (self->pix_width < px+pw)? self->pix_width : px+pw;
+    int y1 = (self->pix_height < py+ph)? self->pix_height : py+ph;
+    int y;
+
+    for (y = y0; y < y1; y++) {
+	RGBAPixel* dst = &self->pixels[y*self->pix_width];
+	int changed = 0;
+	int x;
+	for (x = x0; x < x1; x++) {
+	    if (memcmp(&dst[x], &color, sizeof(RGBAPixel))) {
+		dst[x] = color;
+		mark_block(self, x/blk_size, y/blk_size);
+		changed = 1;
+	    }
+	}
+	if (changed) {
+	    changes++;
+	}
+    }
+
+    return changes;
+}
+
+/* blit_raw: convert the pixels in the current format and copy them.
+ *   returns the number of changed lines, or -1 if no memory.
+ */
+static int
+blit_raw(PyFlvScreen* self, int px, int py, int pw, int ph, const unsigned char* p)
+{
+    int changes = 0;
+    int y;
+    RGBAPixel* line;
+
+    if (self->rgbx) {
+	return blit_pixels(self, px, py, pw, ph, (const RGBAPixel*)p);
+    }
+    if (pw <= 0) return 0;
+    line = (RGBAPixel*)PyMem_Malloc(pw * sizeof(RGBAPixel));
+    if (line == NULL) return -1;
+    for (y = 0; y < ph; y++, p += pw*self->pix_bytes) {
+	read_pixels(self, p, line, pw);
+	changes += blit_pixels(self, px, py+y, pw, 1, line);
+    }
+    PyMem_Free(line);
+    return changes;
+}
+
+/* decode_hextile: decode hextile tiles in [p,end) and draw them.
+ *   (*tile, *bg, *fg) is the state that is carried over between calls.
+ *   returns the end of the decoded tiles.
+ */
+static const unsigned char*
+decode_hextile(PyFlvScreen* self, int px, int py, int pw, int ph,
+	       const unsigned char* p, const unsigned char* end,
+	       int* tile, unsigned int* bg, unsigned int* fg)
+{
+    int bpp = self->pix_bytes;
+    int ntiles = ((pw+15)/16) * ((ph+15)/16);
+
+    for (; *tile < ntiles; (*tile)++) {
+	const unsigned char* q = p;
+	int tx = (*tile % ((pw+15)/16)) * 16;
+	int ty = (*tile / ((pw+15)/16)) * 16;
+	int tw = (pw-tx < 16)? pw-tx : 16;
+	int th = (ph-ty < 16)? ph-ty : 16;
+	int subenc;
+	if (end <= q) break;
+	subenc = *(q++);
+	if (subenc & 1) {
+	    /* Raw */
+	    int n = tw*th*bpp;
+	    if (end-q < n) break;
+	    if (self->rgbx) {
+		blit_pixels(self, px+tx, py+ty, tw, th, (const RGBAPixel*)q);
+	    } else {
+		RGBAPixel pixels[16*16];
+		read_pixels(self, q, pixels, tw*th);
+		blit_pixels(self, px+tx, py+ty, tw, th, pixels);
+	    }
+	    q += n;
+	} else {
+	    RGBAPixel pixels[16*16];
+	    unsigned int tbg = *bg, tfg = *fg;
+	    int nsubrects = 0;
+	    int n = ((subenc & 2)? bpp : 0) +
+		((subenc & 4)? bpp : 0) +
+		((subenc & 8)? 1 : 0);
+	    if (end-q < n) break;
+	    if (subenc & 2) {
+		/* BackgroundSpecified */
+		RGBAPixel color;
+		read_pixel(self, q, &color);
+		memcpy(&tbg, &color, sizeof(RGBAPixel));
+		q += bpp;
+	    }
+	    if (subenc & 4) {
+		/* ForegroundSpecified */
+		RGBAPixel color;
+		read_pixel(self, q, &color);
+		memcpy(&tfg, &color, sizeof(RGBAPixel));
+		q += bpp;
+	    }
+	    if (subenc & 8) {
+		/* AnySubrects */
+		nsubrects = *(q++);
+	    }
+	    n = nsubrects * (((subenc & 16)? bpp : 0) + 2);
+	    if (end-q < n) break;
+	    if (nsubrects == 0) {
+		RGBAPixel color;
+		memcpy(&color, &tbg, sizeof(RGBAPixel));
+		fill_pixels(self, px+tx, py+ty, tw, th, color);
+	    } else {
+		/* paint the tile in a local buffer first. */
+		int i;
+		for (i = 0; i < tw*th; i++) {
+		    memcpy(&pixels[i], &tbg, sizeof(RGBAPixel));
+		}
+		for (i = 0; i < nsubrects; i++) {
+		    RGBAPixel color;
+		    int sx, sy, sw, sh;
+		    if (subenc & 16) {
+			/* SubrectsColoured */
+			read_pixel(self, q, &color);
+			q += bpp;
+		    } else {
+			memcpy(&color, &tfg, sizeof(RGBAPixel));
+		    }
+		    sx = q[0] >> 4;
+		    sy = q[0] & 15;
+		    sw = (q[1] >> 4) + 1;
+		    sh = (q[1] & 15) + 1;
+		    q += 2;
+		    if (tw < sx+sw) sw = tw-sx;
+		    if (th < sy+sh) sh = th-sy;
+		    for (; 0 < sh; sh--, sy++) {
+			int dx;
+			for (dx = 0; dx < sw; dx++) {
+			    pixels[sy*tw + sx+dx] = color;
+			}
+		    }
+		}
+		blit_pixels(self, px+tx, py+ty, tw, th, pixels);
+	    }
+	    *bg = tbg;
+	    *fg = tfg;
+	}
+	p = q;
+    }
+
+    return p;
+}
+
+
+/* FlvScreen.blit_rgba(x,y,w,h,data)
+ *   copy the rgba data (a string or any other buffer object).
+ */
+static PyObject*
+FlvScreen_blit_rgba(PyFlvScreen* self, PyObject* args)
+{
+    Py_buffer data;
+    int px, py, pw, ph;
+    int changes;
+
+    if (check_busy(self) < 0) return NULL;
+    if (!PyArg_ParseTuple(args, "iiiis*", &px, &py, &pw, &ph, &data)) {
+	return NULL;
+    }
+
+    /* check the data size */
+    if (data.len != pw*ph*sizeof(RGBAPixel)) {
+	PyBuffer_Release(&data);
+	PyErr_SetString(PyExc_FlvError, "invalid data size");
+	return NULL;
+    }
+
+    /* copy the image data */
+    changes = blit_pixels(self, px, py, pw, ph, (RGBAPixel*)data.buf);
+
+    PyBuffer_Release(&data);
+    return PyInt_FromLong(changes);
+}
+
+
+/* FlvScreen.set_format(bpp,depth,bigendian,truecolour,rmax,gmax,bmax,rshift,gshift,bshift)
+ *   set the pixel format of the incoming data (same as SetPixelFormat).
+ */
+static PyObject*
+FlvScreen_set_format(PyFlvScreen* self, PyObject* args)
+{
+    int bpp, depth, bigendian, truecolour;
+    int red_max, green_max, blue_max;
+    int red_shift, green_shift, blue_shift;
+
+    if (check_busy(self) < 0) return NULL;
+    if (!PyArg_ParseTuple(args, "iiiiiiiiii", &bpp, &depth, &bigendian, &truecolour,
+			  &red_max, &green_max, &blue_max,
+			  &red_shift, &green_shift, &blue_shift)) {
+	return NULL;
+    }
+    if (set_format(self, bpp, depth, bigendian, truecolour,
+		   red_max, green_max, blue_max,
+		   red_shift, green_shift, blue_shift) < 0) {
+	PyErr_SetString(PyExc_FlvError, "unsupported pixel format");
+	return NULL;
+    }
+
+    Py_RETURN_NONE;
+}
+
+
+/* FlvScreen.blit_pixels(x,y,w,h,data)
+ *   convert the pixels in the current format and copy them.
+ */
+static PyObject*
+FlvScreen_blit_pixels(PyFlvScreen* self, PyObject* args)
+{
+    Py_buffer data;
+    int px, py, pw, ph;
+    int changes;
+
+    if (check_busy(self) < 0) return NULL;
+    if (!PyArg_ParseTuple(args, "iiiis*", &px, &py, &pw, &ph, &data)) {
+	return NULL;
+    }
+
+    /* check the data size */
+    if (pw < 0 || ph < 0 || data.len != pw*ph*self->pix_bytes) {
+	PyBuffer_Release(&data);
+	PyErr_SetString(PyExc_FlvError, "invalid data size");
+	return NULL;
+    }
+
+    changes = blit_raw(self, px, py, pw, ph, (const unsigned char*)data.buf);
+    PyBuffer_Release(&data);
+    if (changes < 0) return PyErr_NoMemory();
+    return PyInt_FromLong(changes);
+}
+
+
+/* FlvScreen.convert(data)
+ *   convert the pixels in the current format to a rgba string.
+ */
+static PyObject*
+FlvScreen_convert(PyFlvScreen* self, PyObject* args)
+{
+    Py_buffer data;
+    PyObject* result;
+    int n;
+
+    if (!PyArg_ParseTuple(args, "s*", &data)) {
+	return NULL;
+    }
+    if (data.len % self->pix_bytes) {
+	PyBuffer_Release(&data);
+	PyErr_SetString(PyExc_FlvError, "invalid data size");
+	return NULL;
+    }
+
+    n = data.len / self->pix_bytes;
+    result = PyString_FromStringAndSize(NULL, n * sizeof(RGBAPixel));
+    if (result != NULL) {
+	read_pixels(self, (const unsigned char*)data.buf,
+		    (RGBAPixel*)PyString_AS_STRING(result), n);
+    }
+
+    PyBuffer_Release(&data);
+    return result;
+}
+
+
+/* FlvScreen.fill_rect(x,y,w,h,color)
+ *   fill the area with a color (a pixel value in the current format).
+ */
+static PyObject*
+FlvScreen_fill_rect(PyFlvScreen* self, PyObject* args)
+{
+    Py_buffer color;
+    int px, py, pw, ph;
+    int changes;
+    RGBAPixel c;
+
+    if (check_busy(self) < 0) return NULL;
+    if (!PyArg_ParseTuple(args, "iiiis*", &px, &py, &pw, &ph, &color)) {
+	return NULL;
+    }
+    if (color.len != self->pix_bytes) {
+	PyBuffer_Release(&color);
+	PyErr_SetString(PyExc_FlvError, "invalid color size");
+	return NULL;
+    }
+    read_pixel(self, (const unsigned char*)color.buf, &c);
+    PyBuffer_Release(&color);
+
+    changes = fill_pixels(self, px, py, pw, ph, c);
+
+    return PyInt_FromLong(changes);
+}
+
+
+/* FlvScreen.copy_rect(sx,sy,dx,dy,w,h)
+ *   move the pixels within the screen.
+ *   the area that is outside the screen is not copied.
+ */
+static PyObject*
+FlvScreen_copy_rect(PyFlvScreen* self, PyObject* args)
+{
+    int sx, sy, dx, dy, pw, ph;
+    int changes = 0;
+    int i;
+
+    if (check_busy(self) < 0) return NULL;
+    if (!PyArg_ParseTuple(args, "iiiiii", &sx, &sy, &dx, &dy, &pw, &ph)) {
+	return NULL;
+    }
+
+    /* clip the source and destination */
+    if (sx < 0) { dx -= sx; pw += sx; sx = 0; }
+    if (sy < 0) { dy -= sy; ph += sy; sy = 0; }
+    if (dx < 0) { sx -= dx; pw += dx; dx = 0; }
+    if (dy < 0) { sy -= dy; ph += dy; dy = 0; }
+    if (self->pix_width < sx+pw) { pw = self->pix_width-sx; }
+    if (self->pix_width < dx+pw) { pw = self->pix_width-dx; }
+    if (self->pix_height < sy+ph) { ph = self->pix_height-sy; }
+    if (self->pix_height < dy+ph) { ph = self->pix_height-dy; }
+    if (pw <= 0 || ph <= 0) {
+	return PyInt_FromLong(0);
+    }
+
+    if (sy == dy) {
+	/* each line overlaps itself: copy it via a temporary buffer. */
+	RGBAPixel* tmp = (RGBAPixel*)PyMem_Malloc(pw * sizeof(RGBAPixel));
+	if (tmp == NULL) return PyErr_NoMemory();
+	for (i = 0; i < ph; i++) {
+	    memcpy(tmp, &self->pixels[(sy+i)*self->pix_width + sx], pw * sizeof(RGBAPixel));
+	    changes += blit_pixels(self, dx, dy+i, pw, 1, tmp);
+	}
+	PyMem_Free(tmp);
+    } else if (sy < dy) {
+	/* moving down: start from the bottom line. */
+	for (i = ph-1; 0 <= i; i--) {
+	    changes += blit_pixels(self, dx, dy+i, pw, 1,
+				   &self->pixels[(sy+i)*self->pix_width + sx]);
+	}
+    } else {
+	/* moving up: start from the top line. */
+	for (i = 0; i < ph; i++) {
+	    changes += blit_pixels(self, dx, dy+i, pw, 1,
+				   &self->pixels[(sy+i)*self->pix_width + sx]);
+	}
+    }
+
+    return PyInt_FromLong(changes);
+}
+
+
+/* FlvScreen.blit_hextile(x,y,w,h,data,state)
+ *   decode hextile tiles and draw them.
+ *   state is a tuple (tile, bg, fg) that is carried over between calls.
+ *   returns (consumed, state), where state is None after the last tile.
+ */
+static PyObject*
+FlvScreen_blit_hextile(PyFlvScreen* self, PyObject* args)
+{
+    Py_buffer data;
+    int px, py, pw, ph;
+    int tile;
+    unsigned int bg, fg;
+    int ntiles, consumed;
+    const unsigned char* p;
+
+    if (check_busy(self) < 0) return NULL;
+    if (!PyArg_ParseTuple(args, "iiiis*(iII)", &px, &py, &pw, &ph, &data,
+			  &tile, &bg, &fg)) {
+	return NULL;
+    }
+
+    p = (const unsigned char*)data.buf;
+    ntiles = ((pw+15)/16) * ((ph+15)/16);
+    consumed = decode_hextile(self, px, py, pw, ph, p, p + data.len,
+			      &tile, &bg, &fg) - p;
+    PyBuffer_Release(&data);
+    if (tile < ntiles) {
+	return Py_BuildValue("i(iII)", consumed, tile, bg, fg);
+    } else {
+	return Py_BuildValue("iO", consumed, Py_None);
+    }
+}
+
+
+/* FlvScreen.blit_zrle(x,y,w,h,data)
+ *   draw the decompressed zrle data.
+ */
+#define ZRLE_TILE_SIZE 64
+
+static PyObject*
+FlvScreen_blit_zrle(PyFlvScreen* self, PyObject* args)
+{
+    Py_buffer data;
+    int px, py, pw, ph;
+    int tx, ty;
+    const unsigned char* p;
+    const unsigned char* end;
+    int cpix = self->cpix_bytes;
+
+    if (check_busy(self) < 0) return NULL;
+    if (!PyArg_ParseTuple(args, "iiiis*", &px, &py, &pw, &ph, &data)) {
+	return NULL;
+    }
+
+    p = (const unsigned char*)data.buf;
+    end = p + data.len;
+    for (ty = 0; ty < ph; ty += ZRLE_TILE_SIZE) {
+	int th = (ph-ty < ZRLE_TILE_SIZE)? ph-ty : ZRLE_TILE_SIZE;
+	for (tx = 0; tx < pw; tx += ZRLE_TILE_SIZE) {
+	    int tw = (pw-tx < ZRLE_TILE_SIZE)? pw-tx : ZRLE_TILE_SIZE;
+	    RGBAPixel pixels[ZRLE_TILE_SIZE*ZRLE_TILE_SIZE];
+	    RGBAPixel palette[128];
+	    int subenc, npalette, i;
+	    if (end <= p) goto invalid;
+	    subenc = *(p++);
+	    if (subenc == 0) {
+		/* Raw */
+		if (end-p < tw*th*cpix) goto invalid;
+		for (i = 0; i < tw*th; i++, p += cpix) {
+		    read_cpixel(self, p, &pixels[i]);
+		}
+		blit_pixels(self, px+tx, py+ty, tw, th, pixels);
+		continue;
+	    }
+	    if (subenc == 1) {
+		/* Solid */
+		if (end-p < cpix) goto invalid;
+		read_cpixel(self, p, &palette[0]);
+		p += cpix;
+		fill_pixels(self, px+tx, py+ty, tw, th, palette[0]);
+		continue;
+	    }
+	    /* read the palette */
+	    if (subenc <= 16) {
+		npalette = subenc;
+	    } else if (130 <= subenc) {
+		npalette = subenc-128;
+	    } else if (subenc == 128) {
+		npalette = 0;
+	    } else {
+		goto invalid;
+	    }
+	    if (end-p < npalette*cpix) goto invalid;
+	    for (i = 0; i < npalette; i++, p += cpix) {
+		read_cpixel(self, p, &palette[i]);
+	    }
+	    if (subenc <= 16) {
+		/* Packed Palette */
+		int bits = (npalette <= 2)? 1 : (npalette <= 4)? 2 : 4;
+		int rowbytes = (tw*bits+7)/8;
+		int x, y;
+		if (end-p < rowbytes*th) goto invalid;
+		for (y = 0; y < th; y++, p += rowbytes) {
+		    for (x = 0; x < tw; x++) {
+			int b = x*bits;
+			int c = (p[b/8] >> (8-bits-(b%8))) & ((1<<bits)-1);
+			if (npalette <= c) goto invalid;
+			pixels[y*tw+x] = palette[c];
+		    }
+		}
+	    } else {
+		/* Plain RLE or Palette RLE */
+		for (i = 0; i < tw*th; ) {
+		    RGBAPixel color;
+		    int run = 1;
+		    if (npalette == 0) {
+			if (end-p < cpix+1) goto invalid;
+			read_cpixel(self, p, &color);
+			p += cpix;
+			run = 0;
+		    } else {
+			int c;
+			if (end <= p) goto invalid;
+			c = *(p++);
+			if (npalette <= (c & 127)) goto invalid;
+			color = palette[c & 127];
+			if (c & 128) {
+			    run = 0;
+			}
+		    }
+		    if (run == 0) {
+			/* run length: 255, 255, ..., n -> 255+255+...+n+1 */
+			do {
+			    if (end <= p) goto invalid;
+			    run += *p;
+			} while (*(p++) == 255);
+			run++;
+		    }
+		    if (tw*th-i < run) goto invalid;
+		    for (; 0 < run; run--, i++) {
+			pixels[i] = color;
+		    }
+		}
+	    }
+	    blit_pixels(self, px+tx, py+ty, tw, th, pixels);
+	}
+    }
+
+    PyBuffer_Release(&data);
+    Py_RETURN_NONE;
+
+invalid:
+    PyBuffer_Release(&data);
+    PyErr_SetString(PyExc_FlvError, "invalid zrle data");
+    return NULL;
+}
+
+
+/* FlvScreen.blit_tight(x,y,w,h,filter,data,palette)
+ *   draw the decompressed tight data.
+ *   filter is one of 0 (copy), 1 (palette) or 2 (gradient).
+ *   A palette with only one color fills the rectangle without data.
+ */
+static PyObject*
+FlvScreen_blit_tight(PyFlvScreen* self, PyObject* args)
+{
+    Py_buffer data, palette;
+    int px, py, pw, ph;
+    int filter;
+    int npalette;
+    RGBAPixel colors[256];
+    RGBAPixel* line = NULL;
+    int* prev = NULL;
+    const unsigned char* p;
+    int tpix = self->tpix_bytes;
+    int x, y;
+
+    if (check_busy(self) < 0) return NULL;
+    if (!PyArg_ParseTuple(args, "iiiiis*s*", &px, &py, &pw, &ph, &filter,
+			  &data, &palette)) {
+	return NULL;
+    }
+
+    p = (const unsigned char*)data.buf;
+    npalette = palette.len / tpix;
+    if (256 < npalette) goto invalid;
+    for (x = 0; x < npalette; x++) {
+	read_tpixel(self, (const unsigned char*)palette.buf + x*tpix, &colors[x]);
+    }
+    if (pw <= 0 || ph <= 0) goto done;
+
+    if (filter == 1 && npalette == 1) {
+	/* Fill */
+	fill_pixels(self, px, py, pw, ph, colors[0]);
+	goto done;
+    }
+
+    line = (RGBAPixel*)PyMem_Malloc(pw * sizeof(RGBAPixel));
+    if (line == NULL) goto nomem;
+    switch (filter) {
+    case 0:
+	/* Copy */
+	if (data.len != pw*ph*tpix) goto invalid;
+	for (y = 0; y < ph; y++) {
+	    for (x = 0; x < pw; x++, p += tpix) {
+		read_tpixel(self, p, &line[x]);
+	    }
+	    blit_pixels(self, px, py+y, pw, 1, line);
+	}
+	break;
+
+    case 1:
+	/* Palette */
+	if (npalette == 2) {
+	    int rowbytes = (pw+7)/8;
+	    if (data.len != rowbytes*ph) goto invalid;
+	    for (y = 0; y < ph; y++, p += rowbytes) {
+		for (x = 0; x < pw; x++) {
+		    line[x] = colors[(p[x/8] >> (7-(x%8))) & 1];
+		}
+		blit_pixels(self, px, py+y, pw, 1, line);
+	    }
+	} else {
+	    if (data.len != pw*ph) goto invalid;
+	    for (y = 0; y < ph; y++) {
+		for (x = 0; x < pw; x++, p++) {
+		    if (npalette <= *p) goto invalid;
+		    line[x] = colors[*p];
+		}
+		blit_pixels(self, px, py+y, pw, 1, line);
+	    }
+	}
+	break;
+
+    case 2:
+	/* Gradient: each component is predicted from the left, upper
+	   and upper-left pixels. */
+	if (data.len != pw*ph*tpix) goto invalid;
+	prev = (int*)PyMem_Malloc((pw+1) * 3 * 2 * sizeof(int));
+	if (prev == NULL) goto nomem;
+	memset(prev, 0, (pw+1) * 3 * 2 * sizeof(int));
+	{
+	    int shift[3], max[3];
+	    shift[0] = self->red_shift;
+	    shift[1] = self->green_shift;
+	    shift[2] = self->blue_shift;
+	    max[0] = (tpix == 3)? 255 : self->red_max;
+	    max[1] = (tpix == 3)? 255 : self->green_max;
+	    max[2] = (tpix == 3)? 255 : self->blue_max;
+	    for (y = 0; y < ph; y++) {
+		/* upper line at prev[0..], current line at cur[0..];
+		   both are offset by one pixel for the left edge. */
+		int* upper = prev + ((y % 2)? 0 : (pw+1) * 3);
+		int* cur = prev + ((y % 2)? (pw+1) * 3 : 0);
+		for (x = 0; x < pw; x++, p += tpix) {
+		    unsigned long d = (tpix == 3)? 0 : pixel_value(self, p);
+		    int c;
+		    for (c = 0; c < 3; c++) {
+			int e = (tpix == 3)? p[c] : (int)((d >> shift[c]) & max[c]);
+			int v = (cur[x*3 + c] +
+				 upper[(x+1)*3 + c] -
+				 upper[x*3 + c]);
+			if (v < 0) v = 0;
+			if (max[c] < v) v = max[c];
+			cur[(x+1)*3 + c] = (v + e) & max[c];
+		    }
+		    line[x].red = cur[(x+1)*3 + 0] * 255 / max[0];
+		    line[x].green = cur[(x+1)*3 + 1] * 255 / max[1];
+		    line[x].blue = cur[(x+1)*3 + 2] * 255 / max[2];
+		    line[x].alpha = 0;
+		}
+		blit_pixels(self, px, py+y, pw, 1, line);
+	    }
+	}
+	break;
+
+    default:
+	goto invalid;
+    }
+
+done:
+    PyMem_Free(line);
+    PyMem_Free(prev);
+    PyBuffer_Release(&data);
+    PyBuffer_Release(&palette);
+    Py_RETURN_NONE;
+
+invalid:
+    PyErr_SetString(PyExc_FlvError, "invalid tight data");
+    goto error;
+nomem:
+    PyErr_NoMemory();
+error:
+    PyMem_Free(line);
+    PyMem_Free(prev);
+    PyBuffer_Release(&data);
+    PyBuffer_Release(&palette);
+    return NULL;
+}
+
+
+/* FlvScreen.blit_rects(x0,y0,data,nrects)
+ *   decode the rectangles of a FramebufferUpdate message and draw them.
+ *   (x0,y0) is subtracted from the position of each rectangle.
+ *   it stops at a rectangle that is not complete in the data or whose
+ *   encoding is other than raw, rre, corre or hextile.
+ *   returns (consumed, n), where n is the number of decoded rectangles.
+ */
+#define RECT_HEADER_SIZE 12
+
+static PyObject*
+FlvScreen_blit_rects(PyFlvScreen* self, PyObject* args)
+{
+    Py_buffer data;
+    int x0, y0, nrects;
+    int n = 0;
+    int bpp = self->pix_bytes;
+    const unsigned char* p;
+    const unsigned char* end;
+    int consumed;
+
+    if (check_busy(self) < 0) return NULL;
+    if (!PyArg_ParseTuple(args, "iis*i", &x0, &y0, &data, &nrects)) {
+	return NULL;
+    }
+
+    p = (const unsigned char*)data.buf;
+    end = p + data.len;
+    for (; n < nrects; n++) {
+	const unsigned char* q = p;
+	int px, py, pw, ph;
+	long enc;
+	if (end-q < RECT_HEADER_SIZE) break;
+	px = (q[0] << 8 | q[1]) - x0;
+	py = (q[2] << 8 | q[3]) - y0;
+	pw = (q[4] << 8 | q[5]);
+	ph = (q[6] << 8 | q[7]);
+	enc = (long)((unsigned long)q[8] << 24 | q[9] << 16 | q[10] << 8 | q[11]);
+	if (enc & 0x80000000L) enc -= 0x100000000L;
+	q += RECT_HEADER_SIZE;
+	if (enc == 0) {
+	    /* Raw */
+	    if ((end-q) / bpp / (pw? pw : 1) < ph) break;
+	    if (blit_raw(self, px, py, pw, ph, q) < 0) {
+		PyBuffer_Release(&data);
+		return PyErr_NoMemory();
+	    }
+	    q += pw*ph*bpp;
+	} else if (enc == 2 || enc == 4) {
+	    /* RRE or CoRRE */
+	    int size = bpp + ((enc == 4)? 4 : 8);
+	    unsigned long nsubrects;
+	    RGBAPixel color;
+	    if (end-q < 4+bpp) break;
+	    nsubrects = ((unsigned long)q[0] << 24 | q[1] << 16 | q[2] << 8 | q[3]);
+	    if ((unsigned long)((end-q-4-bpp) / size) < nsubrects) break;
+	    read_pixel(self, q+4, &color);
+	    fill_pixels(self, px, py, pw, ph, color);
+	    q += 4+bpp;
+	    for (; 0 < nsubrects; nsubrects--, q += size) {
+		const unsigned char* r = q+bpp;
+		read_pixel(self, q, &color);
+		if (enc == 4) {
+		    fill_pixels(self, px+r[0], py+r[1], r[2], r[3], color);
+		} else {
+		    fill_pixels(self, px+(r[0] << 8 | r[1]), py+(r[2] << 8 | r[3]),
+				(r[4] << 8 | r[5]), (r[6] << 8 | r[7]), color);
+		}
+	    }
+	} else if (enc == 5) {
+	    /* Hextile: the tiles drawn for an incomplete rectangle are
+	     * drawn again when the caller decodes it. */
+	    int tile = 0;
+	    unsigned int bg = 0, fg = 0;
+	    q = decode_hextile(self, px, py, pw, ph, q, end, &tile, &bg, &fg);
+	    if (tile < ((pw+15)/16) * ((ph+15)/16)) break;
+	} else {
+	    break;
+	}
+	p = q;
+    }
+
+    consumed = p - (const unsigned char*)data.buf;
+    PyBuffer_Release(&data);
+    return Py_BuildValue("ii", consumed, n);
+}
+
+
+/* FlvScreen.set_cursor(width,height,hotx,hoty,data)
+ *   set the cursor image (ARGB data). An empty image hides the cursor.
+ *   only the blocks under the old and new cursor are marked changed.
+ */
+static PyObject*
+FlvScreen_set_cursor(PyFlvScreen* self, PyObject* args)
+{
+    Py_buffer data;
+    int width, height, hotx, hoty;
+    unsigned char* image = NULL;
+
+    if (check_busy(self) < 0) return NULL;
+    if (!PyArg_ParseTuple(args, "iiiis*", &width, &height, &hotx, &hoty, &data)) {
+	return NULL;
+    }
+    if (width < 0 || height < 0 || data.len != width * height * 4) {
+	PyBuffer_Release(&data);
+	PyErr_SetString(PyExc_FlvError, "invalid data size");
+	return NULL;
+    }
+    if (0 < data.len) {
+	image = (unsigned char*)PyMem_Malloc(data.len);
+	if (image == NULL) {
+	    PyBuffer_Release(&data);
+	    return PyErr_NoMemory();
+	}
+	memcpy(image, data.buf, data.len);
+    }
+    PyBuffer_Release(&data);
+
+    mark_cursor(self);
+    PyMem_Free(self->cur_image);
+    self->cur_image = image;
+    self->cur_width = width;
+    self->cur_height = height;
+    self->cur_hotx = hotx;
+    self->cur_hoty = hoty;
+    mark_cursor(self);
+
+    Py_RETURN_NONE;
 }
 
 
-/* FlvScreen.blit_rgba(x,y,w,h,data)
- *   copy the rgba data.
+/* FlvScreen.move_cursor(x,y)
+ *   move the cursor hotspot to (x,y).
+ *   only the blocks under the old and new cursor are marked changed.
  */
 static PyObject*
-FlvScreen_blit_rgba(PyFlvScreen* self, PyObject* args)
+FlvScreen_move_cursor(PyFlvScreen* self, PyObject* args)
 {
-    PyObject* data;
-    int px, py, pw, ph;
-    int changes = 0;
-    int blk_size = self->blk_size;
-
-    if (!PyArg_ParseTuple(args, "iiiiO", &px, &py, &pw, &ph, &data)) {
-	return NULL;
-    }
+    int x, y;
 
-    /* check the data type */
-    if (!PyString_CheckExact(data)) {
-	PyErr_SetString(PyExc_TypeError, "must be string");
-	return NULL;
-    }
-    /* check the data size */
-    if (PyString_Size(data) != pw*ph*sizeof(RGBAPixel)) {
-	PyErr_SetString(PyExc_FlvError, "invalid data size");
+    if (check_busy(self) < 0) return NULL;
+    if (!PyArg_ParseTuple(args, "ii", &x, &y)) {
 	return NULL;
     }
-
-    /* copy the image data */
-    {
-	RGBAPixel* src = (RGBAPixel*)PyString_AsString(data);
-	int bx0 = idiv(px, blk_size);
-	int bx1 = idiv(px+pw-1, blk_size);
-	for (; 0 < ph; ph--, py++, src += pw) {
-	    int bx;
-	    int by = idiv(py, blk_size);
-	    int changed = 0;
-	    if (by < 0 || self->blk_height <= by) continue;
-	    for (bx = bx0; bx <= bx1; bx++) {
-		int px0 = bx * blk_size;
-		int px1 = (bx+1) * blk_size;
-		unsigned char* blk = &self->blocks[by*self->blk_width + bx];
-		RGBAPixel* dst = &self->pixels[py*self->pix_width + px0];
-		int i, j, n;
-		if (bx < 0 || self->blk_width <= bx) continue;
-		if (px0 < px) {
-		    i = 0;
-		    j = px-px0;
-		    if (px+pw < px1) {
-			/*     px
-			 *     |<-pw->|
-			 *  +--|------|-+
-			 *  |  |<====>| |
-			 *  px0         px1
-			 */
-			n = pw;
-		    } else {
-			/*     px
-			 *     |<-pw-|-->
-			 *  +--|-----+
-			 *  |  |<===>|
-			 *  px0      px1
-			 */
-			n = px1-px;
-		    }
-		} else {
-		    i = px0-px;
-		    j = 0;
-		    if (px+pw < px1) {
-			/*  px
-			 *  |<--|-pw->|
-			 *      +-----|-+
-			 *      |<===>| |
-			 *      px0     px1
-			 */
-			n = px+pw-px0;
-		    } else {
-			/*  px
-			 *  |<--|-pw-|-->|
-			 *      +----+
-			 *      |<==>|
-			 *      px0  px1
-			 */
-			n = blk_size;
-		    }
-		}
-		n *= sizeof(RGBAPixel);
-		if (memcmp(&dst[j], &src[i], n)) {
-		    *blk = 1;
-		    changed = 1;
-		}
-		memcpy(&dst[j], &src[i], n);
-	    }
-	    if (changed) {
-		changes++;
-	    }
-	}
+    if (x != self->cur_x || y != self->cur_y) {
+	mark_cursor(self);
+	self->cur_x = x;
+	self->cur_y = y;
+	mark_cursor(self);
     }
 
-    return PyInt_FromLong(changes);
+    Py_RETURN_NONE;
 }
 
 
@@ -251,13 +1496,94 @@ FlvScreen_changed(PyFlvScreen* self)
 }
 
 
+/* FlvScreen.dirty_map()
+ *   returns the marks of the blocks as a string of block_width*block_height
+ *   bytes from the top. A changed block is non-zero.
+ */
+static PyObject*
+FlvScreen_dirty_map(PyFlvScreen* self)
+{
+    return PyString_FromStringAndSize((char*)self->blocks, self->blk_width * self->blk_height);
+}
+
+/* FlvScreen.dirty_count()
+ *   returns the number of the marked blocks.
+ */
+static PyObject*
+FlvScreen_dirty_count(PyFlvScreen* self)
+{
+    return PyInt_FromLong(self->dirty_count);
+}
+
+/* FlvScreen.dirty_bounds()
+ *   returns the bounding box (x0,y0,x1,y1) of the marked blocks,
+ *   or None if nothing is marked.
+ */
+static PyObject*
+FlvScreen_dirty_bounds(PyFlvScreen* self)
+{
+    if (self->dirty_count == 0) {
+	Py_RETURN_NONE;
+    }
+    return Py_BuildValue("(iiii)", self->dirty_x0, self->dirty_y0,
+			 self->dirty_x1, self->dirty_y1);
+}
+
+
+/* get_block: convert a block to FLV pixels with the cursor.
+ *   the lines are flipped vertically.
+ */
+static void
+get_block(const PyFlvScreen* self, int x, int y, FLVPixel* pixels)
+{
+    int px = x * self->blk_size;
+    int py = y * self->blk_size;
+    int dy;
+
+    for (dy = 0; dy < self->blk_size; dy++) {
+	const RGBAPixel* src = &self->pixels[(py+dy)*self->pix_width + px];
+	FLVPixel* dst = &pixels[(self->blk_size-1-dy)*self->blk_size];
+	int dx;
+	for (dx = 0; dx < self->blk_size; dx++, src++, dst++) {
+	    dst->red = src->red;
+	    dst->green = src->green;
+	    dst->blue = src->blue;
+	}
+    }
+    if (self->cur_image != NULL) {
+	/* overlay the cursor */
+	int cx = self->cur_x - self->cur_hotx;
+	int cy = self->cur_y - self->cur_hoty;
+	int x0 = (cx < px)? px : cx;
+	int y0 = (cy < py)? py : cy;
+	int x1 = (px+self->blk_size < cx+self->cur_width)? px+self->blk_size : cx+self->cur_width;
+	int y1 = (py+self->blk_size < cy+self->cur_height)? py+self->blk_size : cy+self->cur_height;
+	int i, j;
+	for (j = y0; j < y1; j++) {
+	    const unsigned char* src = &self->cur_image[((j-cy)*self->cur_width + (x0-cx))*4];
+	    FLVPixel* dst = &pixels[(self->blk_size-1-(j-py))*self->blk_size + (x0-px)];
+	    for (i = x0; i < x1; i++, src += 4, dst++) {
+		int a = src[0];
+		if (a == 255) {
+		    dst->red = src[1];
+		    dst->green = src[2];
+		    dst->blue = src[3];
+		} else if (a != 0) {
+		    dst->red = (src[1]*a + dst->red*(255-a)) / 255;
+		    dst->green = (src[2]*a + dst->green*(255-a)) / 255;
+		    dst->blue = (src[3]*a + dst->blue*(255-a)) / 255;
+		}
+	    }
+	}
+    }
+}
+
 /* FlvScreen.get(i, j)
  *   returns the FLV-aware data of a block bitmap.
  */
 static PyObject*
 FlvScreen_get(PyFlvScreen* self, PyObject* args)
 {
-    PyObject* result;
     int x, y;
 
     if (!PyArg_ParseTuple(args, "ii", &x, &y)) {
@@ -268,36 +1594,471 @@ FlvScreen_get(PyFlvScreen* self, PyObject* args)
 	return NULL;
     }
 
-    {
-	/* flip vertically */
-	int px = x * self->blk_size;
-	int py = y * self->blk_size;
-	int dy;
-	for (dy = 0; dy < self->blk_size; dy++) {
-	    RGBAPixel* src = &self->pixels[(py+dy)*self->pix_width + px];
-	    FLVPixel* dst = &self->tmppix[(self->blk_size-1-dy)*self->blk_size];
-	    int dx;
-	    for (dx = 0; dx < self->blk_size; dx++, src++, dst++) {
-		dst->red = src->red;
-		dst->green = src->green;
-		dst->blue = src->blue;
+    get_block(self, x, y, self->tmppix);
+    return PyString_FromStringAndSize((char*)self->tmppix,
+				      self->blk_size * self->blk_size * sizeof(FLVPixel));
+}
+
+
+#define MAX_ENCODE_THREADS 64
+
+/* EncodeTask: a part of the blocks processed by a thread.
+ *   each thread takes every step-th block in todo from start.
+ */
+typedef struct _EncodeTask {
+    const PyFlvScreen* screen;
+    const int* blocks;		/* (x,y) of the blocks in the frame */
+    const int* todo;		/* indices of the blocks to process */
+    int ntodo;
+    unsigned char* raw;		/* FLV pixels of each block, or NULL */
+    uLong* hashes;
+    unsigned char* out;		/* a slot of bound bytes for each block */
+    uLong* lengths;		/* compressed size of each block, 0 if failed */
+    uLong bound;
+    int level;
+    int start, step;
+} EncodeTask;
+
+/* hash_blocks: get the FLV pixels of the blocks of a task and hash them.
+ */
+static void*
+hash_blocks(void* arg)
+{
+    EncodeTask* task = (EncodeTask*)arg;
+    int blk_size = task->screen->blk_size;
+    uLong blk_bytes = blk_size * blk_size * sizeof(FLVPixel);
+    int j;
+
+    for (j = task->start; j < task->ntodo; j += task->step) {
+	int i = task->todo[j];
+	unsigned char* pixels = task->raw + i*blk_bytes;
+	get_block(task->screen, task->blocks[i*2], task->blocks[i*2+1], (FLVPixel*)pixels);
+	task->hashes[i] = crc32(0, pixels, blk_bytes);
+    }
+    return NULL;
+}
+
+/* encode_blocks: compress the blocks of a task.
+ *   this runs without the GIL, so the screen must not be changed meanwhile.
+ */
+static void*
+encode_blocks(void* arg)
+{
+    EncodeTask* task = (EncodeTask*)arg;
+    int blk_size = task->screen->blk_size;
+    uLong blk_bytes = blk_size * blk_size * sizeof(FLVPixel);
+    FLVPixel* pixels;
+    z_stream z;
+    int j;
+
+    pixels = (FLVPixel*)malloc(blk_bytes);
+    if (pixels == NULL) return NULL;
+    memset(&z, 0, sizeof(z));
+    if (deflateInit(&z, task->level) != Z_OK) {
+	free(pixels);
+	return NULL;
+    }
+    /* one stream is reset for each block, which gives the same output
+     * as compressing each block separately. */
+    for (j = task->start; j < task->ntodo; j += task->step) {
+	int i = task->todo[j];
+	deflateReset(&z);
+	if (task->raw != NULL) {
+	    z.next_in = task->raw + i*blk_bytes;
+	} else {
+	    get_block(task->screen, task->blocks[i*2], task->blocks[i*2+1], pixels);
+	    z.next_in = (Bytef*)pixels;
+	}
+	z.avail_in = blk_bytes;
+	z.next_out = task->out + i*task->bound;
+	z.avail_out = task->bound;
+	if (deflate(&z, Z_FINISH) == Z_STREAM_END) {
+	    task->lengths[i] = z.total_out;
+	}
+    }
+    deflateEnd(&z);
+    free(pixels);
+    return NULL;
+}
+
+/* run_tasks: run a function for each task on its own thread.
+ *   the first task runs in this thread.
+ */
+static void
+run_tasks(EncodeTask* tasks, int ntasks, void* (*func)(void*))
+{
+    pthread_t threads[MAX_ENCODE_THREADS];
+    int started[MAX_ENCODE_THREADS];
+    int i;
+
+    for (i = 0; i < ntasks; i++) {
+	started[i] = (0 < i && pthread_create(&threads[i], NULL, func, &tasks[i]) == 0);
+    }
+    for (i = 0; i < ntasks; i++) {
+	if (!started[i]) {
+	    func(&tasks[i]);
+	}
+    }
+    for (i = 0; i < ntasks; i++) {
+	if (started[i]) {
+	    pthread_join(threads[i], NULL);
+	}
+    }
+}
+
+/* FlvScreen.encode_frame((x,y,w,h), keyframe, level=-1, threads=1)
+ *   returns a ScreenVideo packet of the window (in blocks).
+ *   only the changed blocks are sent unless it is a key frame.
+ *   level is the zlib compression level. The blocks are compressed
+ *   by the given number of threads without the GIL. The threads are
+ *   started for each call and joined before it returns, so nothing is
+ *   left running between frames; while they run, the other methods that
+ *   change the screen raise FlvError.
+ *   The compressed blocks are kept and reused until they are changed.
+ */
+static PyObject*
+FlvScreen_encode_frame(PyFlvScreen* self, PyObject* args)
+{
+    int wx, wy, ww, wh;
+    int keyframe;
+    int level = Z_DEFAULT_COMPRESSION;
+    int nthreads = 1;
+    int blk_size = self->blk_size;
+    uLong blk_bytes = blk_size * blk_size * sizeof(FLVPixel);
+    uLong bound = compressBound(blk_bytes);
+    EncodeTask tasks[MAX_ENCODE_THREADS];
+    int* blocks;
+    int* todo;
+    const unsigned char** src;
+    unsigned char* out;
+    unsigned char* raw = NULL;
+    uLong* hashes = NULL;
+    int* same = NULL;		/* an earlier block with the same content */
+    int* firsts = NULL;
+    int nfirsts = 0;
+    uLong* lengths;
+    int nblocks = 0, ntodo = 0;
+    Py_ssize_t size;
+    PyObject* result = NULL;
+    unsigned char* p;
+    int i, j, x, y;
+
+    if (check_busy(self) < 0) return NULL;
+    if (!PyArg_ParseTuple(args, "(iiii)i|ii", &wx, &wy, &ww, &wh, &keyframe,
+			  &level, &nthreads)) {
+	return NULL;
+    }
+    if (wx < 0 || wy < 0 || ww <= 0 || wh <= 0 ||
+	self->blk_width < wx+ww || self->blk_height < wy+wh ||
+	4096 <= ww*blk_size || 4096 <= wh*blk_size) {
+	PyErr_SetString(PyExc_FlvError, "invalid window");
+	return NULL;
+    }
+    self->busy = 1;
+
+    blocks = (int*)PyMem_Malloc(ww*wh * 2 * sizeof(int));
+    todo = (int*)PyMem_Malloc(ww*wh * sizeof(int));
+    src = (const unsigned char**)PyMem_Malloc(ww*wh * sizeof(unsigned char*));
+    lengths = (uLong*)PyMem_Malloc(ww*wh * sizeof(uLong));
+    out = (unsigned char*)PyMem_Malloc(ww*wh * bound);
+    if (blocks == NULL || todo == NULL || src == NULL || lengths == NULL || out == NULL) {
+	PyErr_NoMemory();
+	goto finally;
+    }
+    if (self->cache != NULL) {
+	for (nfirsts = 1; nfirsts < ww*wh*2; nfirsts *= 2);
+	raw = (unsigned char*)PyMem_Malloc(ww*wh * blk_bytes);
+	hashes = (uLong*)PyMem_Malloc(ww*wh * sizeof(uLong));
+	same = (int*)PyMem_Malloc(ww*wh * sizeof(int));
+	firsts = (int*)PyMem_Malloc(nfirsts * sizeof(int));
+	if (raw == NULL || hashes == NULL || same == NULL || firsts == NULL) {
+	    PyErr_NoMemory();
+	    goto finally;
+	}
+    }
+
+    /* list the blocks to send, from the bottom.
+     * the unchanged ones are taken from the last compressed data. */
+    for (y = wy+wh-1; wy <= y; y--) {
+	for (x = wx; x < wx+ww; x++) {
+	    int b = y*self->blk_width + x;
+	    if (keyframe || self->blocks[b]) {
+		CompressedBlock* blk = &self->compressed[b];
+		blocks[nblocks*2] = x;
+		blocks[nblocks*2+1] = y;
+		if (!self->stale[b] && blk->data != NULL && blk->level == level) {
+		    src[nblocks] = blk->data;
+		    lengths[nblocks] = blk->length;
+		} else {
+		    src[nblocks] = out + nblocks*bound;
+		    lengths[nblocks] = 0;
+		    todo[ntodo++] = nblocks;
+		}
+		nblocks++;
+	    }
+	}
+    }
+
+    if (MAX_ENCODE_THREADS < nthreads) nthreads = MAX_ENCODE_THREADS;
+    if (ntodo < nthreads) nthreads = ntodo;
+    if (nthreads < 1) nthreads = 1;
+    for (i = 0; i < nthreads; i++) {
+	tasks[i].screen = self;
+	tasks[i].blocks = blocks;
+	tasks[i].todo = todo;
+	tasks[i].ntodo = ntodo;
+	tasks[i].raw = raw;
+	tasks[i].hashes = hashes;
+	tasks[i].out = out;
+	tasks[i].lengths = lengths;
+	tasks[i].bound = bound;
+	tasks[i].level = level;
+	tasks[i].start = i;
+	tasks[i].step = nthreads;
+    }
+
+    /* look up the same contents in the LRU cache and in this frame. */
+    if (raw != NULL && 0 < ntodo) {
+	Py_BEGIN_ALLOW_THREADS
+	run_tasks(tasks, nthreads, hash_blocks);
+	Py_END_ALLOW_THREADS
+	for (i = 0; i < nfirsts; i++) {
+	    firsts[i] = -1;
+	}
+	for (i = j = 0; i < ntodo; i++) {
+	    int k = todo[i];
+	    int h = hashes[k] & (nfirsts-1);
+	    CacheEntry* e = cache_find(self, hashes[k], level, raw + k*blk_bytes);
+	    same[k] = -1;
+	    if (e != NULL) {
+		memcpy(out + k*bound, e->data, e->length);
+		lengths[k] = e->length;
+		continue;
+	    }
+	    for (; 0 <= firsts[h]; h = (h+1) & (nfirsts-1)) {
+		int k0 = firsts[h];
+		if (hashes[k0] == hashes[k] &&
+		    memcmp(raw + k0*blk_bytes, raw + k*blk_bytes, blk_bytes) == 0) {
+		    same[k] = k0;
+		    break;
+		}
+	    }
+	    if (same[k] < 0) {
+		firsts[h] = k;
+		todo[j++] = k;
+	    }
+	}
+	ntodo = j;
+	for (i = 0; i < nthreads; i++) {
+	    tasks[i].ntodo = ntodo;
+	}
+    }
+
+    /* compress the rest. */
+    if (0 < ntodo) {
+	Py_BEGIN_ALLOW_THREADS
+	run_tasks(tasks, nthreads, encode_blocks);
+	Py_END_ALLOW_THREADS
+    }
+    for (i = 0; raw != NULL && i < nblocks; i++) {
+	if (src[i] == out + i*bound && 0 <= same[i]) {
+	    memcpy(out + i*bound, out + same[i]*bound, lengths[same[i]]);
+	    lengths[i] = lengths[same[i]];
+	}
+    }
+
+    /* put them together. */
+    size = 5 + (ww*wh - nblocks)*2;
+    for (i = 0; i < nblocks; i++) {
+	if (lengths[i] == 0 || 65535 < lengths[i]) {
+	    PyErr_SetString(PyExc_FlvError, "compression failed");
+	    goto finally;
+	}
+	size += 2 + lengths[i];
+    }
+    result = PyString_FromStringAndSize(NULL, size);
+    if (result == NULL) goto finally;
+    p = (unsigned char*)PyString_AS_STRING(result);
+
+    /* header */
+    p[0] = 3 | (keyframe? 0x10 : 0x20);
+    p[1] = ((blk_size/16-1) << 4) | ((ww*blk_size) >> 8);
+    p[2] = (ww*blk_size) & 0xff;
+    p[3] = ((blk_size/16-1) << 4) | ((wh*blk_size) >> 8);
+    p[4] = (wh*blk_size) & 0xff;
+    p += 5;
+
+    /* blocks from the bottom */
+    i = 0;
+    for (y = wy+wh-1; wy <= y; y--) {
+	for (x = wx; x < wx+ww; x++) {
+	    if (i < nblocks && blocks[i*2] == x && blocks[i*2+1] == y) {
+		p[0] = lengths[i] >> 8;
+		p[1] = lengths[i] & 0xff;
+		memcpy(p+2, src[i], lengths[i]);
+		p += 2+lengths[i];
+		i++;
+	    } else {
+		p[0] = p[1] = 0;
+		p += 2;
 	    }
 	}
-	result = PyString_FromStringAndSize((char*)self->tmppix, 
-					    self->blk_size * self->blk_size * sizeof(FLVPixel));
     }
 
+    /* keep the new ones. */
+    for (i = 0; i < nblocks; i++) {
+	int b = blocks[i*2+1]*self->blk_width + blocks[i*2];
+	if (src[i] != out + i*bound) continue;
+	if (store_compressed(self, b, level, src[i], lengths[i]) < 0) {
+	    Py_DECREF(result);
+	    result = PyErr_NoMemory();
+	    goto finally;
+	}
+    }
+    for (i = 0; raw != NULL && i < ntodo; i++) {
+	int k = todo[i];
+	cache_insert(self, hashes[k], level, raw + k*blk_bytes, out + k*bound, lengths[k]);
+    }
+
+finally:
+    PyMem_Free(blocks);
+    PyMem_Free(todo);
+    PyMem_Free(src);
+    PyMem_Free(lengths);
+    PyMem_Free(out);
+    PyMem_Free(raw);
+    PyMem_Free(hashes);
+    PyMem_Free(same);
+    PyMem_Free(firsts);
+    self->busy = 0;
     return result;
 }
 
 
+/* FlvScreen.set_cache(entries)
+ *   keep up to the given number of compressed blocks by their content,
+ *   so that the same blocks at any place are compressed only once.
+ *   0 disables the cache.
+ */
+static PyObject*
+FlvScreen_set_cache(PyFlvScreen* self, PyObject* args)
+{
+    int entries;
+    int blk_bytes = self->blk_size * self->blk_size * sizeof(FLVPixel);
+    uLong bound = compressBound(blk_bytes);
+    int i;
+
+    if (check_busy(self) < 0) return NULL;
+    if (!PyArg_ParseTuple(args, "i", &entries)) {
+	return NULL;
+    }
+    if (entries < 0) {
+	PyErr_SetString(PyExc_FlvError, "invalid size");
+	return NULL;
+    }
+
+    free_cache(self);
+    if (entries == 0) {
+	Py_RETURN_NONE;
+    }
+    self->cache = PyMem_Malloc(entries * sizeof(CacheEntry));
+    if (self->cache == NULL) return PyErr_NoMemory();
+    memset(self->cache, 0, entries * sizeof(CacheEntry));
+    self->cache_size = entries;
+    for (self->cache_nbuckets = 1; self->cache_nbuckets < entries; self->cache_nbuckets *= 2);
+    self->cache_buckets = PyMem_Malloc(self->cache_nbuckets * sizeof(int));
+    if (self->cache_buckets == NULL) {
+	free_cache(self);
+	return PyErr_NoMemory();
+    }
+    for (i = 0; i < self->cache_nbuckets; i++) {
+	self->cache_buckets[i] = -1;
+    }
+    for (i = 0; i < entries; i++) {
+	self->cache[i].pixels = PyMem_Malloc(blk_bytes);
+	self->cache[i].data = PyMem_Malloc(bound);
+	if (self->cache[i].pixels == NULL || self->cache[i].data == NULL) {
+	    free_cache(self);
+	    return PyErr_NoMemory();
+	}
+    }
+
+    Py_RETURN_NONE;
+}
+
+
+/* FlvScreen.resize(block_width, block_height)
+ *   change the screen size. The pixels in the overlapping area are kept
+ *   and everything is marked changed.
+ */
+static PyObject*
+FlvScreen_resize(PyFlvScreen* self, PyObject* args)
+{
+    int blk_width, blk_height;
+    int pix_width, pix_height;
+    unsigned char* blocks;
+    unsigned char* stale;
+    CompressedBlock* compressed;
+    RGBAPixel* pixels;
+    int y;
+
+    if (check_busy(self) < 0) return NULL;
+    if (!PyArg_ParseTuple(args, "ii", &blk_width, &blk_height)) {
+	return NULL;
+    }
+    if (blk_width <= 0 || blk_height <= 0) {
+	PyErr_SetString(PyExc_FlvError, "invalid size");
+	return NULL;
+    }
+
+    pix_width = blk_width * self->blk_size;
+    pix_height = blk_height * self->blk_size;
+    blocks = PyMem_Malloc(blk_width * blk_height);
+    stale = PyMem_Malloc(blk_width * blk_height);
+    compressed = PyMem_Malloc(blk_width * blk_height * sizeof(CompressedBlock));
+    pixels = PyMem_Malloc(pix_width * pix_height * sizeof(RGBAPixel));
+    if (blocks == NULL || stale == NULL || compressed == NULL || pixels == NULL) {
+	PyMem_Free(blocks);
+	PyMem_Free(stale);
+	PyMem_Free(compressed);
+	PyMem_Free(pixels);
+	return PyErr_NoMemory();
+    }
+    memset(stale, 1, blk_width * blk_height);
+    memset(compressed, 0, blk_width * blk_height * sizeof(CompressedBlock));
+    memset(pixels, 0, pix_width * pix_height * sizeof(RGBAPixel));
+    for (y = 0; y < pix_height && y < self->pix_height; y++) {
+	int w = (pix_width < self->pix_width)? pix_width : self->pix_width;
+	memcpy(&pixels[y*pix_width], &self->pixels[y*self->pix_width], w * sizeof(RGBAPixel));
+    }
+
+    free_compressed(self);
+    PyMem_Free(self->blocks);
+    PyMem_Free(self->stale);
+    PyMem_Free(self->compressed);
+    PyMem_Free(self->pixels);
+    self->blocks = blocks;
+    self->stale = stale;
+    self->compressed = compressed;
+    self->pixels = pixels;
+    self->blk_width = blk_width;
+    self->blk_height = blk_height;
+    self->pix_width = pix_width;
+    self->pix_height = pix_height;
+    set_marks(self, 1);
+
+    Py_RETURN_NONE;
+}
+
+
 /* FlvScreen.reset()
  *   mark everything unchanged.
  */
 static PyObject*
 FlvScreen_reset(PyFlvScreen* self)
 {
-    memset(self->blocks, 0, self->blk_width * self->blk_height);
+    if (check_busy(self) < 0) return NULL;
+    set_marks(self, 0);
     Py_RETURN_NONE;
 }
 
@@ -355,12 +2116,63 @@ static PyMethodDef FlvScreen_methods[] = {
     { "blit_rgba", (PyCFunction)FlvScreen_blit_rgba, METH_VARARGS,
       "blit_rgba"
     },
+    { "set_format", (PyCFunction)FlvScreen_set_format, METH_VARARGS,
+      "set_format"
+    },
+    { "blit_pixels", (PyCFunction)FlvScreen_blit_pixels, METH_VARARGS,
+      "blit_pixels"
+    },
+    { "convert", (PyCFunction)FlvScreen_convert, METH_VARARGS,
+      "convert"
+    },
+    { "fill_rect", (PyCFunction)FlvScreen_fill_rect, METH_VARARGS,
+      "fill_rect"
+    },
+    { "copy_rect", (PyCFunction)FlvScreen_copy_rect, METH_VARARGS,
+      "copy_rect"
+    },
+    { "blit_hextile", (PyCFunction)FlvScreen_blit_hextile, METH_VARARGS,
+      "blit_hextile"
+    },
+    { "blit_zrle", (PyCFunction)FlvScreen_blit_zrle, METH_VARARGS,
+      "blit_zrle"
+    },
+    { "blit_tight", (PyCFunction)FlvScreen_blit_tight, METH_VARARGS,
+      "blit_tight"
+    },
+    { "blit_rects", (PyCFunction)FlvScreen_blit_rects, METH_VARARGS,
+      "blit_rects"
+    },
+    { "set_cursor", (PyCFunction)FlvScreen_set_cursor, METH_VARARGS,
+      "set_cursor"
+    },
+    { "move_cursor", (PyCFunction)FlvScreen_move_cursor, METH_VARARGS,
+      "move_cursor"
+    },
     { "changed", (PyCFunction)FlvScreen_changed, METH_NOARGS,
       "changed"
     },
+    { "dirty_map", (PyCFunction)FlvScreen_dirty_map, METH_NOARGS,
+      "dirty_map"
+    },
+    { "dirty_count", (PyCFunction)FlvScreen_dirty_count, METH_NOARGS,
+      "dirty_count"
+    },
+    { "dirty_bounds", (PyCFunction)FlvScreen_dirty_bounds, METH_NOARGS,
+      "dirty_bounds"
+    },
     { "get", (PyCFunction)FlvScreen_get, METH_VARARGS,
       "get"
     },
+    { "encode_frame", (PyCFunction)FlvScreen_encode_frame, METH_VARARGS,
+      "encode_frame"
+    },
+    { "set_cache", (PyCFunction)FlvScreen_set_cache, METH_VARARGS,
+      "set_cache"
+    },
+    { "resize", (PyCFunction)FlvScreen_resize, METH_VARARGS,
+      "resize"
+    },
     { "reset", (PyCFunction)FlvScreen_reset, METH_NOARGS,
       "reset"
     },
@@ -386,6 +2198,9 @@ static PyMemberDef FlvScreen_members[] = {
     { "pixel_height", T_INT, offsetof(PyFlvScreen, pix_height), READONLY,
       "the number of vertical pixels"
     },
+    { "pixel_bytes", T_INT, offsetof(PyFlvScreen, pix_bytes), READONLY,
+      "the number of bytes per incoming pixel"
+    },
     {NULL},
 };
 
@@ -479,10 +2294,124 @@ FlvScreen_flv2rgba(PyObject* self, PyObject* args)
     return result;
 }
 
+/* mask_bit: get a pixel of a 1-bit bitmap whose rows are padded to bytes.
+ */
+static int
+mask_bit(const unsigned char* bits, int rowbytes, int x, int y)
+{
+    return (bits[y*rowbytes + x/8] >> (7 - (x%8))) & 1;
+}
+
+/* flvscreen.cursor2argb(width, height, image, mask)
+ *   make an ARGB cursor image from rgba pixels and a 1-bit mask (RichCursor).
+ */
+static PyObject*
+FlvScreen_cursor2argb(PyObject* self, PyObject* args)
+{
+    Py_buffer image, mask;
+    PyObject* result;
+    int width, height;
+    int rowbytes;
+
+    if (!PyArg_ParseTuple(args, "iis*s*", &width, &height, &image, &mask)) {
+	return NULL;
+    }
+
+    rowbytes = (width+7)/8;
+    if (width < 0 || height < 0 ||
+	image.len != width * height * sizeof(RGBAPixel) ||
+	mask.len != rowbytes * height) {
+	PyBuffer_Release(&image);
+	PyBuffer_Release(&mask);
+	PyErr_SetString(PyExc_FlvError, "invalid data size");
+	return NULL;
+    }
+
+    result = PyString_FromStringAndSize(NULL, width * height * 4);
+    if (result != NULL) {
+	const RGBAPixel* src = (const RGBAPixel*)image.buf;
+	unsigned char* dst = (unsigned char*)PyString_AS_STRING(result);
+	int x, y;
+	for (y = 0; y < height; y++) {
+	    for (x = 0; x < width; x++, src++, dst += 4) {
+		if (mask_bit((const unsigned char*)mask.buf, rowbytes, x, y)) {
+		    dst[0] = 0xff;
+		    dst[1] = src->red;
+		    dst[2] = src->green;
+		    dst[3] = src->blue;
+		} else {
+		    memset(dst, 0, 4);
+		}
+	    }
+	}
+    }
+
+    PyBuffer_Release(&image);
+    PyBuffer_Release(&mask);
+    return result;
+}
+
+/* flvscreen.xcursor2argb(width, height, fgcolor, bgcolor, shape, mask)
+ *   make an ARGB cursor image from two rgb colors and 1-bit bitmaps (XCursor).
+ */
+static PyObject*
+FlvScreen_xcursor2argb(PyObject* self, PyObject* args)
+{
+    Py_buffer fg, bg, shape, mask;
+    PyObject* result = NULL;
+    int width, height;
+    int rowbytes;
+
+    if (!PyArg_ParseTuple(args, "iis*s*s*s*", &width, &height,
+			  &fg, &bg, &shape, &mask)) {
+	return NULL;
+    }
+
+    rowbytes = (width+7)/8;
+    if (width < 0 || height < 0 || fg.len != 3 || bg.len != 3 ||
+	shape.len != rowbytes * height || mask.len != rowbytes * height) {
+	PyErr_SetString(PyExc_FlvError, "invalid data size");
+	goto done;
+    }
+
+    result = PyString_FromStringAndSize(NULL, width * height * 4);
+    if (result != NULL) {
+	unsigned char* dst = (unsigned char*)PyString_AS_STRING(result);
+	int x, y;
+	for (y = 0; y < height; y++) {
+	    for (x = 0; x < width; x++, dst += 4) {
+		if (mask_bit((const unsigned char*)mask.buf, rowbytes, x, y)) {
+		    dst[0] = 0xff;
+		    if (mask_bit((const unsigned char*)shape.buf, rowbytes, x, y)) {
+			memcpy(dst+1, fg.buf, 3);
+		    } else {
+			memcpy(dst+1, bg.buf, 3);
+		    }
+		} else {
+		    memset(dst, 0, 4);
+		}
+	    }
+	}
+    }
+
+done:
+    PyBuffer_Release(&fg);
+    PyBuffer_Release(&bg);
+    PyBuffer_Release(&shape);
+    PyBuffer_Release(&mask);
+    return result;
+}
+
 static PyMethodDef flvscreen_functions[] = {
     { "flv2rgba", (PyCFunction)FlvScreen_flv2rgba, METH_VARARGS,
       "flv2rgba"
     },
+    { "cursor2argb", (PyCFunction)FlvScreen_cursor2argb, METH_VARARGS,
+      "cursor2argb"
+    },
+    { "xcursor2argb", (PyCFunction)FlvScreen_xcursor2argb, METH_VARARGS,
+      "xcursor2argb"
+    },
     {NULL, NULL},
 };
 
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
-import sys, unittest
+import sys, unittest, zlib
+from struct import pack
 import flvscreen
 
 class TestFlvScreen(unittest.TestCase):
@@ -73,10 +74,306 @@ class TestFlvScreen(unittest.TestCase):
         self.assertRaises(flvscreen.FlvError, lambda : screen.blit_rgba(0,0,1,1, ''))
         return
 
+    def testBuffer(self):
+        screen = flvscreen.FlvScreen(2, 1, 1)
+        screen.reset()
+        data = bytearray('\x00\x00\x00\x00\x11\x22\x33\x00')
+        self.assertEqual(screen.blit_rgba(0,0,1,1, memoryview(data)[4:]), 1)
+        self.assertEqual(screen.changed(), [(0,0)])
+        self.assertEqual(screen.get(0,0),
+                         '\x00\x00\x00\x00\x00\x00\x33\x22\x11\x00\x00\x00')
+        self.assertRaises(flvscreen.FlvError, lambda : screen.blit_rgba(0,0,1,1, data))
+        return
+
+    def testFillRect(self):
+        screen = flvscreen.FlvScreen(2, 2, 2)
+        screen.reset()
+        self.assertEqual(screen.fill_rect(1,1,2,5, '\x11\x22\x33\x00'), 3)
+        self.assertEqual(screen.changed(), [(0,1),(1,1),(0,0),(1,0)])
+        self.assertEqual(screen.get(1,0), '\x33\x22\x11\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+        screen.reset()
+        self.assertEqual(screen.fill_rect(1,1,1,1, '\x11\x22\x33\x00'), 0)
+        self.assertEqual(screen.changed(), [])
+        self.assertRaises(flvscreen.FlvError, lambda : screen.fill_rect(0,0,1,1, '\x00'))
+        return
+
+    def testCopyRect(self):
+        screen = flvscreen.FlvScreen(2, 3, 1)
+        screen.blit_rgba(0,0,3,1, '\x11\x11\x11\x00\x22\x22\x22\x00\x33\x33\x33\x00')
+        screen.reset()
+        # overlapping move to the right.
+        self.assertEqual(screen.copy_rect(0,0,1,0,3,1), 1)
+        self.assertEqual(screen.changed(), [(0,0),(1,0)])
+        self.assertEqual(screen.get(0,0), '\x00\x00\x00\x00\x00\x00\x11\x11\x11\x11\x11\x11')
+        self.assertEqual(screen.get(1,0), '\x00\x00\x00\x00\x00\x00\x22\x22\x22\x33\x33\x33')
+        screen.reset()
+        # moving down; the source outside the screen is ignored.
+        self.assertEqual(screen.copy_rect(2,0,4,1,4,2), 1)
+        self.assertEqual(screen.changed(), [(2,0)])
+        self.assertEqual(screen.get(2,0), '\x22\x22\x22\x33\x33\x33\x00\x00\x00\x00\x00\x00')
+        self.assertEqual(screen.copy_rect(0,0,0,0,6,2), 0)
+        return
+
+    def testHextile(self):
+        screen = flvscreen.FlvScreen(2, 10, 1)
+        screen.reset()
+        A = '\x11\x22\x33\x00'
+        B = '\x44\x55\x66\x00'
+        # tile 1: background A and a 1x1 subrect of B at (1,0).
+        # tile 2: background A (carried over), no subrects.
+        data = '\x0e' + A + B + '\x01\x10\x00' + '\x00'
+        # incomplete data.
+        self.assertEqual(screen.blit_hextile(0,0,20,2, data[:5], (0,0,0)), (0, (0,0,0)))
+        (n, state) = screen.blit_hextile(0,0,20,2, data[:-1], (0,0,0))
+        self.assertEqual(n, len(data)-1)
+        self.assertEqual(state[0], 1)
+        self.assertEqual(screen.blit_hextile(0,0,20,2, data[-1:], state), (1, None))
+        self.assertEqual(screen.get(0,0), '\x33\x22\x11\x33\x22\x11\x33\x22\x11\x66\x55\x44')
+        self.assertEqual(screen.get(9,0), '\x33\x22\x11'*4)
+        self.assertEqual(len(screen.changed()), 10)
+        # raw tile.
+        screen.reset()
+        self.assertEqual(screen.blit_hextile(0,0,2,1, '\x01'+A+A, (0,0,0)), (9, None))
+        self.assertEqual(screen.changed(), [(0,0)])
+        return
+
+    def testZRLE(self):
+        screen = flvscreen.FlvScreen(2, 2, 1)
+        screen.reset()
+        # packed palette: 2 colors, 1 bit/pixel.
+        self.assertEqual(screen.blit_zrle(0,0,4,1, '\x02\x11\x22\x33\x44\x55\x66\x50'), None)
+        self.assertEqual(screen.get(0,0), '\x00\x00\x00\x00\x00\x00\x33\x22\x11\x66\x55\x44')
+        self.assertEqual(screen.get(1,0), '\x00\x00\x00\x00\x00\x00\x33\x22\x11\x66\x55\x44')
+        screen.reset()
+        # plain RLE: 3 pixels of one color, 1 pixel of another.
+        screen.blit_zrle(0,0,4,1, '\x80\x11\x22\x33\x02\x44\x55\x66\x00')
+        self.assertEqual(screen.changed(), [(0,0)])
+        self.assertEqual(screen.get(0,0), '\x00\x00\x00\x00\x00\x00\x33\x22\x11\x33\x22\x11')
+        # palette RLE and solid.
+        screen.blit_zrle(0,0,4,1, '\x82\x11\x22\x33\x44\x55\x66\x81\x02\x00')
+        self.assertEqual(screen.get(0,0), '\x00\x00\x00\x00\x00\x00\x66\x55\x44\x66\x55\x44')
+        screen.blit_zrle(0,0,4,1, '\x01\x00\x00\x00')
+        self.assertEqual(screen.get(1,0), '\x00\x00\x00'*4)
+        self.assertRaises(flvscreen.FlvError, lambda : screen.blit_zrle(0,0,4,1, '\x80\x11\x22\x33\x04'))
+        self.assertRaises(flvscreen.FlvError, lambda : screen.blit_zrle(0,0,4,1, '\x00'))
+        return
+
+    def testTight(self):
+        screen = flvscreen.FlvScreen(2, 1, 1)
+        # fill.
+        screen.blit_tight(0,0,2,2, 1, '', '\x11\x22\x33')
+        self.assertEqual(screen.get(0,0), '\x33\x22\x11'*4)
+        # 2-color palette.
+        screen.blit_tight(0,0,2,2, 1, '\x40\x80', '\x11\x22\x33\x44\x55\x66')
+        self.assertEqual(screen.get(0,0), '\x66\x55\x44\x33\x22\x11\x33\x22\x11\x66\x55\x44')
+        # gradient.
+        screen.blit_tight(0,0,2,2, 2, '\x10\x10\x10\x01\x02\x03\x01\x01\x01\x05\x05\x05', '')
+        self.assertEqual(screen.get(0,0), '\x11\x11\x11\x19\x18\x17\x10\x10\x10\x13\x12\x11')
+        self.assertRaises(flvscreen.FlvError, lambda : screen.blit_tight(0,0,2,2, 0, '\x00', ''))
+        self.assertRaises(flvscreen.FlvError, lambda : screen.blit_tight(0,0,2,2, 3, '', ''))
+        return
+
+    def testFormat(self):
+        screen = flvscreen.FlvScreen(2, 1, 1)
+        self.assertEqual(screen.pixel_bytes, 4)
+        # 16bit RGB565, little endian.
+        screen.set_format(16, 16, 0, 1, 31, 63, 31, 11, 5, 0)
+        self.assertEqual(screen.pixel_bytes, 2)
+        self.assertEqual(screen.convert('\x00\xf8\xe0\x07'), '\xff\x00\x00\x00\x00\xff\x00\x00')
+        screen.reset()
+        self.assertEqual(screen.blit_pixels(0,0,2,1, '\x00\xf8\x1f\x00'), 1)
+        self.assertEqual(screen.get(0,0), '\x00\x00\x00\x00\x00\x00\x00\x00\xff\xff\x00\x00')
+        self.assertRaises(flvscreen.FlvError, lambda : screen.blit_pixels(0,0,2,1, '\x00'))
+        screen.fill_rect(0,0,2,2, '\xe0\x07')
+        self.assertEqual(screen.get(0,0), '\x00\xff\x00'*4)
+        # 8bit BGR233.
+        screen.set_format(8, 8, 1, 1, 7, 7, 3, 0, 3, 6)
+        screen.blit_hextile(0,0,2,2, '\x01\x07\x38\xc0\x00', (0,0,0))
+        self.assertEqual(screen.get(0,0), '\xff\x00\x00\x00\x00\x00\x00\x00\xff\x00\xff\x00')
+        # 32bit little endian.
+        screen.set_format(32, 24, 0, 1, 255, 255, 255, 16, 8, 0)
+        screen.blit_zrle(0,0,2,2, '\x01\x11\x22\x33')
+        self.assertEqual(screen.get(0,0), '\x11\x22\x33'*4)
+        self.assertRaises(flvscreen.FlvError, lambda : screen.set_format(8, 8, 0, 0, 0, 0, 0, 0, 0, 0))
+        return
+
     def testFLV2RGBA(self):
         self.assertEqual(flvscreen.flv2rgba(2, 2, '123456abcdef'),
                          'cba\x00fed\x00321\x00654\x00')
         self.assertRaises(flvscreen.FlvError, lambda : flvscreen.flv2rgba(2, 2, '12'))
         return
 
-if __name__ == '__main__': unittest.main()
+    def testCursor(self):
+        self.assertEqual(flvscreen.cursor2argb(2, 2, '123x456xabcxdefx', '\x80\x40'),
+                         '\xff123\x00\x00\x00\x00\x00\x00\x00\x00\xffdef')
+        self.assertEqual(flvscreen.xcursor2argb(9, 1, 'abc', 'def', '\x80\x80', '\xc0\x80'),
+                         '\xffabc\xffdef' + '\x00\x00\x00\x00'*6 + '\xffabc')
+        self.assertRaises(flvscreen.FlvError, lambda : flvscreen.cursor2argb(2, 2, '', '\x80\x40'))
+        return
+
+    def testCursorOverlay(self):
+        screen = flvscreen.FlvScreen(2, 3, 3)
+        screen.reset()
+        # a 2x1 cursor with its hotspot at the right pixel.
+        screen.set_cursor(2, 1, 1, 0, '\xff\x11\x22\x33\x00\x00\x00\x00')
+        self.assertEqual(screen.changed(), [(0,0)])
+        screen.reset()
+        screen.move_cursor(3, 3)
+        self.assertEqual(screen.changed(), [(1,1), (0,0)])
+        self.assertEqual(screen.get(1,1), '\x33\x22\x11\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+        self.assertEqual(screen.get(0,0), '\x00\x00\x00'*4)
+        screen.reset()
+        screen.move_cursor(3, 3)
+        self.assertEqual(screen.changed(), [])
+        screen.move_cursor(3, 2)
+        self.assertEqual(screen.changed(), [(1,1)])
+        self.assertEqual(screen.get(1,1), '\x00\x00\x00\x00\x00\x00\x33\x22\x11\x00\x00\x00')
+        # the pixels under the cursor are kept.
+        screen.blit_rgba(2,2,1,1, '\x44\x55\x66\x00')
+        self.assertEqual(screen.get(1,1), '\x00\x00\x00\x00\x00\x00\x33\x22\x11\x00\x00\x00')
+        screen.reset()
+        screen.set_cursor(0, 0, 0, 0, '')
+        self.assertEqual(screen.changed(), [(1,1)])
+        self.assertEqual(screen.get(1,1), '\x00\x00\x00\x00\x00\x00\x66\x55\x44\x00\x00\x00')
+        self.assertRaises(flvscreen.FlvError, lambda : screen.set_cursor(1, 1, 0, 0, ''))
+        return
+
+    def testRects(self):
+        screen = flvscreen.FlvScreen(2, 2, 1)
+        raw = pack('>HHHHl', 11, 10, 2, 1, 0) + '\x01\x02\x03\x00\x04\x05\x06\x00'
+        rre = pack('>HHHHl', 12, 10, 1, 2, 2) + pack('>L', 1) + '\x07\x08\x09\x00' + \
+              '\x0a\x0b\x0c\x00' + pack('>HHHH', 0, 1, 1, 1)
+        copy = pack('>HHHHl', 10, 10, 1, 1, 1) + pack('>HH', 11, 10)
+        data = raw + rre + copy
+        self.assertEqual(screen.blit_rects(10, 10, data, 3), (len(raw+rre), 2))
+        self.assertEqual(screen.get(0,0), '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x03\x02\x01')
+        self.assertEqual(screen.get(1,0), '\x0c\x0b\x0a\x00\x00\x00\x09\x08\x07\x00\x00\x00')
+        # an incomplete rectangle is left to the caller.
+        self.assertEqual(screen.blit_rects(10, 10, raw[:-1], 1), (0, 0))
+        self.assertEqual(screen.blit_rects(10, 10, raw, 0), (0, 0))
+        return
+
+    def testEncodeFrame(self):
+        screen = flvscreen.FlvScreen(16, 3, 2)
+        screen.reset()
+        screen.blit_rgba(16,0,1,1, '\x01\x02\x03\x00')
+        screen.blit_rgba(0,16,1,1, '\x04\x05\x06\x00')
+        def block(x, y):
+            data = zlib.compress(screen.get(x,y))
+            return pack('>H', len(data)) + data
+        # only the changed blocks, from the bottom.
+        self.assertEqual(screen.encode_frame((0,0,3,2), 0),
+                         '\x23\x00\x30\x00\x20' + block(0,1) + '\x00\x00'*3 + block(1,0) + '\x00\x00')
+        self.assertEqual(screen.encode_frame((1,0,2,1), 1),
+                         '\x13\x00\x20\x00\x10' + block(1,0) + block(2,0))
+        self.assertRaises(flvscreen.FlvError, lambda : screen.encode_frame((2,0,2,1), 1))
+        # the same output with threads.
+        for threads in (2, 3, 8):
+            self.assertEqual(screen.encode_frame((0,0,3,2), 1, -1, threads),
+                             screen.encode_frame((0,0,3,2), 1))
+        return
+
+    def testBlockCache(self):
+        ops = []
+        def draw(screen, *args):
+            ops.append(args)
+            screen.fill_rect(*args)
+        def fresh(level=-1):
+            # the same image on a screen without the compressed blocks.
+            screen = flvscreen.FlvScreen(16, 3, 2)
+            for args in ops:
+                screen.fill_rect(*args)
+            return screen.encode_frame((0,0,3,2), 1, level)
+        for entries in (0, 1, 8):
+            ops = []
+            screen = flvscreen.FlvScreen(16, 3, 2)
+            screen.set_cache(entries)
+            screen.encode_frame((0,0,3,2), 1)
+            screen.reset()
+            draw(screen, 10,10,12,12, '\x01\x02\x03\x00')
+            screen.encode_frame((0,0,3,2), 0)
+            screen.reset()
+            self.assertEqual(screen.encode_frame((0,0,3,2), 1), fresh())
+            # the same blocks at other places.
+            draw(screen, 0,0,16,16, '\x04\x05\x06\x00')
+            draw(screen, 32,16,16,16, '\x04\x05\x06\x00')
+            self.assertEqual(screen.encode_frame((0,0,3,2), 1, 9), fresh(9))
+            self.assertEqual(screen.encode_frame((0,0,3,2), 1), fresh())
+        self.assertRaises(flvscreen.FlvError, lambda : screen.set_cache(-1))
+        return
+
+    def testResize(self):
+        screen = flvscreen.FlvScreen(2, 2, 1)
+        screen.blit_rgba(0,0,4,2, '\x01\x02\x03\x00'*4 + '\x04\x05\x06\x00'*4)
+        screen.reset()
+        screen.resize(1, 2)
+        self.assertEqual((screen.block_width, screen.block_height), (1, 2))
+        self.assertEqual((screen.pixel_width, screen.pixel_height), (2, 4))
+        self.assertEqual(screen.changed(), [(0,1), (0,0)])
+        self.assertEqual(screen.get(0,0), '\x06\x05\x04'*2 + '\x03\x02\x01'*2)
+        self.assertEqual(screen.get(0,1), '\x00\x00\x00'*4)
+        self.assertRaises(flvscreen.FlvError, lambda : screen.resize(0, 1))
+        return
+
+    def testDirty(self):
+        screen = flvscreen.FlvScreen(2, 3, 2)
+        self.assertEqual(screen.dirty_map(), '\x01'*6)
+        self.assertEqual(screen.dirty_count(), 6)
+        self.assertEqual(screen.dirty_bounds(), (0,0,3,2))
+        screen.reset()
+        self.assertEqual(screen.dirty_map(), '\x00'*6)
+        self.assertEqual(screen.dirty_count(), 0)
+        self.assertEqual(screen.dirty_bounds(), None)
+        screen.fill_rect(3,3,1,1, '\x01\x02\x03\x00')
+        screen.fill_rect(2,1,1,1, '\x01\x02\x03\x00')
+        self.assertEqual(screen.dirty_map(), '\x00\x01\x00\x00\x01\x00')
+        self.assertEqual(screen.dirty_count(), 2)
+        self.assertEqual(screen.dirty_bounds(), (1,0,2,2))
+        self.assertEqual(screen.dirty_count(), len(screen.changed()))
+        return
+
+    def testBusy(self):
+        import os, threading
+        screen = flvscreen.FlvScreen(32, 20, 20)
+        screen.blit_rgba(0,0,640,640, os.urandom(640*640*4))
+        def encode():
+            for _ in xrange(20):
+                screen.encode_frame((0,0,20,20), 1, 9, 2)
+        thread = threading.Thread(target=encode)
+        thread.start()
+        refused = 0
+        while thread.isAlive():
+            try:
+                screen.fill_rect(0,0,1,1, '\x01\x02\x03\x00')
+            except flvscreen.FlvError:
+                refused += 1
+        thread.join()
+        self.assert_(refused)
+        self.assertEqual(screen.fill_rect(0,0,1,1, '\x04\x05\x06\x00'), 1)
+        return
+
+
+# benchmark: full screen updates.
+def benchmark(n=50):
+    import time
+    screen = flvscreen.FlvScreen(32, 60, 34)
+    (w, h) = (screen.pixel_width, screen.pixel_height)
+    data1 = '\x01\x02\x03\x00'*(w*h)
+    data2 = '\x04\x05\x06\x00'*(w*h)
+    screen.blit_rgba(0,0,w,h, data1)
+    t0 = time.time()
+    for i in xrange(n):
+        screen.blit_rgba(0,0,w,h, data1)
+    t1 = time.time()
+    for i in xrange(n):
+        screen.blit_rgba(0,0,w,h, (data1, data2)[i % 2])
+    t2 = time.time()
+    print 'blit_rgba %dx%d: unchanged %.2fms, changed %.2fms' % \
+          (w, h, (t1-t0)*1000/n, (t2-t1)*1000/n)
+    return
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['bench']:
+        benchmark()
+    else:
+        unittest.main()
@@ -17,6 +17,7 @@ setup(
     ],
   scripts=[
     'tools/flvrec.py',
+    'tools/flvmrec.py',
     'tools/flvcat.py',
     'tools/flvdump.py',
     'tools/flvaddmp3.py',
@@ -36,6 +37,6 @@ setup(
                          #define_macros=[],
                          #include_dirs=[],
                          #library_dirs=[],
-                         #libraries=[],
+                         libraries=['z', 'pthread'],
                          )],
   )
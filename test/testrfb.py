@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+import sys, os, unittest, StringIO
+from struct import pack, unpack
+from vnc2flv.rfb import RFBProxy, RFBNetworkClient, RFBFileClient, RFBMultiplexer
+from vnc2flv.rfb import RFBError, RFBAuthError
+from vnc2flv.video import FLVVideoSink
+from flvscreen import FlvError
+
+
+# canned server messages.
+def handshake(width, height, name='test'):
+    pixelformat = pack('>BBBBHHHBBBxxx', 32, 24, 1, 1, 255, 255, 255, 24, 16, 8)
+    return ('RFB 003.003\x0a' + pack('>L', 1) +
+            pack('>HH16sL', width, height, pixelformat, len(name)) + name)
+
+def rejection(reason):
+    return 'RFB 003.003\x0a' + pack('>LL', 0, len(reason)) + reason
+
+def update(rects):
+    return '\x00\x00' + pack('>H', len(rects)) + ''.join(rects)
+
+def rect(x, y, w, h, enc, data):
+    return pack('>HHHHl', x, y, w, h, enc) + data
+
+def raw(w, h, pixel='\x10\x20\x30\x00'):
+    return pixel*(w*h)
+
+
+##  Writer: records the frames written by the sink.
+##
+class Writer(object):
+
+    def __init__(self):
+        self.sizes = []
+        self.frames = []
+        return
+
+    def set_screen_size(self, width, height):
+        self.sizes.append((width, height))
+        return
+
+    def write_video_frame(self, timestamp, data):
+        # (timestamp, keyframe)
+        self.frames.append((timestamp, bool(ord(data[0]) & 0x10)))
+        return
+
+
+##  Proxy: keeps the sent messages and runs on a fake clock.
+##
+class Proxy(RFBProxy):
+
+    def __init__(self, *args, **kwargs):
+        RFBProxy.__init__(self, *args, **kwargs)
+        self.sent = []
+        self.clock = 0
+        return
+
+    def send(self, s):
+        self.sent.append(s)
+        return
+
+    def time(self):
+        return self.clock
+
+    # the update requests as (incremental, x, y, w, h).
+    def requested(self):
+        return [ (ord(s[1]),)+unpack('>HHHH', s[2:]) for s in self.sent if s[0] == '\x03' ]
+
+
+def proxy(width=64, height=32, framerate=10, **kwargs):
+    writer = Writer()
+    sink = FLVVideoSink(writer, blocksize=16, framerate=framerate)
+    p = Proxy(sink, **kwargs)
+    p.open()
+    p.feed(handshake(width, height))
+    return (p, writer)
+
+
+class TestRFBProxy(unittest.TestCase):
+
+    def testPipeline(self):
+        (p, writer) = proxy(pipeline=3)
+        self.assertEqual(len(p.requested()), 3)
+        self.assertEqual(p.requests, 3)
+        p.feed(update([rect(0,0,64,32,0,raw(64,32))]))
+        self.assertEqual(len(p.requested()), 4)
+        self.assertEqual(p.requests, 3)
+        return
+
+    def testMergedRequests(self):
+        # the requests for a resized screen are not counted,
+        # so the server merging them does not stop the pipeline.
+        (p, writer) = proxy(pipeline=1)
+        p.feed(update([rect(0,0,64,32,0,raw(64,32))]))
+        p.feed(update([rect(0,0,128,64,-223,'')]))
+        self.assertEqual(p.requests, 1)
+        n = len(p.requested())
+        p.feed(update([rect(64,0,64,64,0,raw(64,64))]))
+        self.assertEqual(len(p.requested()), n+1)
+        self.assertEqual(p.requests, 1)
+        return
+
+    def testPacing(self):
+        (p, writer) = proxy(pacing=10)
+        self.assertEqual(p.requested(), [(0,0,0,64,32)])
+        p.clock = 30
+        p.feed(update([rect(0,0,64,32,0,raw(64,32))]))
+        # the next request waits for the next frame.
+        self.assertEqual(len(p.requested()), 1)
+        self.assertEqual(p.send_scheduled_request(), 70)
+        p.clock = 100
+        self.assertEqual(p.send_scheduled_request(), None)
+        self.assertEqual(p.requested()[-1], (1,0,0,64,32))
+        return
+
+    def testPacingRoundUp(self):
+        # a request is never scheduled at the current time.
+        (p, writer) = proxy(pacing=30)
+        for t in xrange(0, 1000):
+            p.clock = t
+            (p.nextrequest, p.requests) = (None, 0)
+            p.schedule_request()
+            self.assert_(t < p.nextrequest <= t+34)
+        return
+
+    def testStats(self):
+        rects = [rect(0,0,4,4,0,raw(4,4)), rect(0,0,4,4,1,pack('>HH',4,4)), rect(4,4,4,4,0,raw(4,4))]
+        data = handshake(32,16) + update(rects) + '\x02' + update([])
+        p = Proxy(FLVVideoSink(Writer()), stats=True)
+        p.open()
+        p.feed(data)
+        stats = p.get_stats()
+        self.assertEqual(stats['bytes'], len(data))
+        self.assertEqual(stats['messages']['FramebufferUpdate']['count'], 2)
+        self.assertEqual(stats['messages']['Bell'], {'count': 1, 'bytes': 1})
+        self.assertEqual(stats['encodings']['Raw'], {'rects': 2, 'bytes': 2*(12+64)})
+        self.assertEqual(stats['encodings']['CopyRect'], {'rects': 1, 'bytes': 16})
+        return
+
+    def testHandshakeRejected(self):
+        writer = Writer()
+        p = Proxy(FLVVideoSink(writer, blocksize=16, framerate=10))
+        p.open()
+        basetime = p.basetime
+        self.assertRaises(RFBAuthError, lambda : p.feed(rejection('too many')))
+        self.failIf(p.session_open)
+        # the next attempt continues the same recording.
+        p.open()
+        p.feed(handshake(32, 16))
+        self.assert_(p.session_open)
+        self.assertEqual(p.basetime, basetime)
+        self.assertEqual(writer.sizes, [(32, 16)])
+        return
+
+    def testReconnect(self):
+        (p, writer) = proxy(32, 16)
+        p.feed(update([rect(0,0,32,16,0,raw(32,16))]))
+        p.clock = 150
+        p.feed(update([]))
+        screen = p.sink.screen
+        p.session_open = False
+        p.open()
+        p.clock = 250
+        p.feed(handshake(32, 16) + update([rect(0,0,16,16,0,raw(16,16,'\x40\x50\x60\x00'))]))
+        # the screen is kept and the timeline goes on.
+        self.assert_(p.sink.screen is screen)
+        self.assertEqual(writer.frames, [(0, False), (100, False), (200, True)])
+        return
+
+    def testReplay(self):
+        s1 = handshake(32, 16) + update([rect(0,0,32,16,0,raw(32,16))])
+        s2 = handshake(32, 16) + update([rect(0,0,16,16,0,raw(16,16,'\x40\x50\x60\x00'))])
+        capture = ('RFBCAP\x01\x20' +
+                   pack('>LL', 0, len(s1)) + s1 +
+                   pack('>LL', 150, 4) + update([]) +
+                   pack('>LL', 160, 0) +
+                   pack('>LL', 250, len(s2)) + s2)
+        writer = Writer()
+        client = RFBFileClient(StringIO.StringIO(capture),
+                               FLVVideoSink(writer, blocksize=16, framerate=10))
+        client.open()
+        self.assertRaises(EOFError, lambda : [ client.idle() for _ in xrange(10) ])
+        self.assertEqual(writer.frames, [(0, False), (100, False), (200, True)])
+        return
+
+    def testStall(self):
+        class Client(RFBNetworkClient):
+            def send(self, s): self.sent.append(s)
+            def time(self): return self.clock
+        client = Client('localhost', 5900, FLVVideoSink(Writer(), blocksize=16),
+                        pipeline=2, stall=3000)
+        (client.sent, client.clock) = ([], 0)
+        RFBProxy.open(client)
+        client.feed(handshake(64, 32))
+        client.lastrecv = 0
+        n = len(client.sent)
+        client.clock = 2999
+        client.check_stall()
+        self.assertEqual(len(client.sent), n)
+        # one extra request; the pipeline is still counted.
+        client.clock = 3000
+        client.check_stall()
+        self.assertEqual(len(client.sent), n+1)
+        self.assertEqual(client.requests, 2)
+        client.clock = 5999
+        client.check_stall()
+        self.assertEqual(len(client.sent), n+1)
+        return
+
+
+##  Session: a fake client for the multiplexer.
+##
+class Session(object):
+
+    host = 'localhost'
+    port = 5900
+    session_open = True
+
+    def __init__(self, error=None, where=None):
+        (self.fd, w) = os.pipe()
+        os.write(w, 'x')
+        os.close(w)
+        self.error = error
+        self.where = where
+        self.received = 0
+        self.closed = False
+        return
+
+    def fileno(self): return self.fd
+    def open(self): return
+    def time(self): return 0
+    def check_stall(self): return
+
+    def fail(self, where):
+        if self.where == where: raise self.error
+        return
+
+    def send_scheduled_request(self):
+        self.fail('request')
+        return None
+
+    def recv(self):
+        self.received += 1
+        self.fail('recv')
+        return
+
+    def flush_sink(self, t):
+        self.fail('flush')
+        return
+
+    def close(self):
+        os.close(self.fd)
+        self.closed = True
+        self.fail('close')
+        return
+
+
+class TestRFBMultiplexer(unittest.TestCase):
+
+    def testErrors(self):
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            for (error, where) in ((FlvError('x'), 'recv'),
+                                   (RFBError('x'), 'request'),
+                                   (IOError('x'), 'flush')):
+                mux = RFBMultiplexer()
+                (good, bad) = (Session(), Session(error, where))
+                mux.add(good)
+                mux.add(bad)
+                mux.idle()
+                mux.idle()
+                self.assert_(bad.closed)
+                self.assertEqual(mux.clients.keys(), [good.fd])
+                self.assertEqual(good.received, 2)
+                mux.close()
+            # a failing close does not leave the others open.
+            mux = RFBMultiplexer()
+            sessions = [Session(), Session(IOError('x'), 'close'), Session()]
+            for session in sessions:
+                mux.add(session)
+            mux.close()
+            self.assertEqual([ s.closed for s in sessions ], [True, True, True])
+            self.assertEqual(mux.clients, {})
+        finally:
+            sys.stderr = stderr
+        return
+
+
+if __name__ == '__main__': unittest.main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+##
+##  flvmrec.py - recording multiple VNC servers at once.
+##
+##  Copyright (c) 2009-2010 by Yusuke Shinyama
+##
+
+import sys, time, socket, signal
+from ConfigParser import RawConfigParser
+from vnc2flv.flv import FLVWriter
+from vnc2flv.rfb import RFBNetworkClient, RFBMultiplexer, RFBError, PWDFile, PWDCache
+from vnc2flv.video import FLVVideoSink, str2clip
+
+
+# Each section of the config file defines one session:
+#
+#   [DEFAULT]
+#   framerate = 12
+#   pwdfile = lab.pwd
+#
+#   [lab1]
+#   host = lab1:0
+#   output = lab1-%Y%m%d%H%M.flv
+#
+DEFAULTS = {
+    'port': '',
+    'output': '',
+    'pwdfile': '',
+    'framerate': '12',
+    'keyframe': '120',
+    'encoding': '5,0',
+    'cursor': '1',
+    'blocksize': '32',
+    'clipping': '',
+    'requests': '1',
+    'continuous': '0',
+    'bitsperpixel': '32',
+    'queuesize': '0',
+    'compresslevel': '',
+    'adaptive': '0',
+    'rcvbuf': '0',
+    'pacing': '0',
+    'threads': '1',
+    'blockcache': '0',
+    'stall': '5000',
+    }
+
+def str2host(s, port=''):
+    if ':' in s:
+        i = s.index(':')
+        return (s[:i] or 'localhost', int(s[i+1:])+5900)
+    return (s or 'localhost', int(port or 5900))
+
+
+##  FLVSession
+##
+class FLVSession(object):
+
+    def __init__(self, name, conf, debug=0):
+        self.name = name
+        (self.host, self.port) = str2host(conf.get(name, 'host'), conf.get(name, 'port'))
+        self.filename = time.strftime(conf.get(name, 'output') or (name+'%Y%m%d%H%M.flv'))
+        framerate = conf.getint(name, 'framerate')
+        preferred_encoding = tuple( int(i) for i in conf.get(name, 'encoding').split(',') )
+        localcursor = (conf.get(name, 'cursor') == 'local')
+        if localcursor:
+            preferred_encoding += (-232,-239,-240,)
+        elif not conf.getboolean(name, 'cursor'):
+            preferred_encoding += (-232,-239,)
+        compresslevel = None
+        if conf.get(name, 'compresslevel'):
+            compresslevel = conf.getint(name, 'compresslevel')
+        clipping = None
+        if conf.get(name, 'clipping'):
+            clipping = str2clip(conf.get(name, 'clipping'))
+        if conf.get(name, 'pwdfile'):
+            pwdcache = PWDFile(conf.get(name, 'pwdfile'))
+        else:
+            pwdcache = PWDCache('%s:%d' % (self.host, self.port))
+        self.framerate = framerate
+        self.debug = debug
+        # the file is created by start() once the server is connected.
+        self.fp = self.writer = None
+        self.sink = FLVVideoSink(None,
+                                 blocksize=conf.getint(name, 'blocksize'),
+                                 framerate=framerate,
+                                 keyframe=conf.getint(name, 'keyframe'),
+                                 clipping=clipping,
+                                 queuesize=conf.getint(name, 'queuesize'),
+                                 cursor=localcursor,
+                                 threads=conf.getint(name, 'threads'),
+                                 blockcache=conf.getint(name, 'blockcache'),
+                                 debug=debug)
+        self.client = RFBNetworkClient(self.host, self.port, self.sink,
+                                       timeout=500/framerate,
+                                       pwdcache=pwdcache,
+                                       preferred_encoding=preferred_encoding,
+                                       pipeline=conf.getint(name, 'requests'),
+                                       continuous=conf.getboolean(name, 'continuous'),
+                                       bitsperpixel=conf.getint(name, 'bitsperpixel'),
+                                       compresslevel=compresslevel,
+                                       adaptive=conf.getboolean(name, 'adaptive'),
+                                       rcvbuf=conf.getint(name, 'rcvbuf'),
+                                       pacing=(conf.getboolean(name, 'pacing') and framerate),
+                                       stall=conf.getint(name, 'stall'),
+                                       debug=debug)
+        return
+
+    def start(self):
+        self.fp = file(self.filename, 'wb')
+        self.writer = FLVWriter(self.fp, framerate=self.framerate, debug=self.debug)
+        self.sink.writer = self.writer
+        return
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.fp.close()
+        return
+
+
+##  flvmrec
+##
+def flvmrec(sessions, timeout=50, debug=0, verbose=1):
+    mux = RFBMultiplexer(timeout=timeout, debug=debug)
+    retval = 0
+    try:
+        def sigint_handler(sig, frame):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGINT, sigint_handler)
+        for session in sessions:
+            try:
+                mux.add(session.client)
+            except (socket.error, RFBError), e:
+                print >>sys.stderr, 'Cannot connect: %s: %s' % (session.name, e)
+                retval = 1
+                continue
+            try:
+                session.start()
+            except IOError, e:
+                print >>sys.stderr, 'Cannot open: %s: %s' % (session.filename, e)
+                mux.remove(session.client)
+                retval = 1
+                continue
+            if verbose:
+                print >>sys.stderr, 'start recording: %s (%s:%d) -> %s' % \
+                      (session.name, session.host, session.port, session.filename)
+        try:
+            while mux.clients:
+                mux.idle()
+        finally:
+            mux.close()
+    except KeyboardInterrupt:
+        pass
+    if verbose:
+        print >>sys.stderr, 'stop recording'
+    for session in sessions:
+        session.close()
+        if verbose and session.sink.queuesize:
+            stats = session.sink.get_stats()
+            print >>sys.stderr, ('%s: frames: %d, dropped: %d, queue: %d (max %d)' %
+                                 (session.name, stats['frames'], stats['dropped'],
+                                  stats['queued'], stats['maxqueue']))
+    return retval
+
+
+# main
+def main(argv):
+    import getopt, vnc2flv
+    def usage():
+        print argv[0], vnc2flv.__version__
+        print 'usage: %s [-d] [-q] [-t timeout] config [section ...]' % argv[0]
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], 'dqt:')
+    except getopt.GetoptError:
+        return usage()
+    debug = 0
+    verbose = 1
+    timeout = 50
+    for (k, v) in opts:
+        if k == '-d': debug += 1
+        elif k == '-q': verbose -= 1
+        elif k == '-t': timeout = int(v)
+    if not args: return usage()
+    conf = RawConfigParser(DEFAULTS)
+    if not conf.read(args[0]):
+        print >>sys.stderr, 'Cannot read: %s' % args[0]
+        return 1
+    names = args[1:] or conf.sections()
+    sessions = [ FLVSession(name, conf, debug=debug) for name in names ]
+    return flvmrec(sessions, timeout=timeout, debug=debug, verbose=verbose)
+
+if __name__ == "__main__": sys.exit(main(sys.argv))
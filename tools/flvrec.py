@@ -5,21 +5,40 @@
 ##  Copyright (c) 2009-2010 by Yusuke Shinyama
 ##
 
-import sys, time, socket, os, os.path, subprocess, signal
+import sys, time, socket, os, os.path, subprocess, signal, json
 from vnc2flv.flv import FLVWriter
-from vnc2flv.rfb import RFBNetworkClient, RFBError, PWDFile, PWDCache
+from vnc2flv.rfb import RFBNetworkClient, RFBFileClient, RFBError, PWDFile, PWDCache
 from vnc2flv.video import FLVVideoSink, str2clip, str2size
 
 
+# the statistics are written every STATS_INTERVAL seconds.
+STATS_INTERVAL = 10
+
+# writes the statistics as a JSON line.
+def dump_stats(fp, client, sink):
+    fp.write(json.dumps({ 'time': client.time(),
+                          'rfb': client.get_stats(),
+                          'video': sink.get_stats() }) + '\n')
+    fp.flush()
+    return
+
+
 ##  flvrec
 ##
 def flvrec(filename, host='localhost', port=5900,
            framerate=12, keyframe=120,
-           preferred_encoding=(0,), pwdfile=None,
+           preferred_encoding=(5,0), pwdfile=None,
            blocksize=32, clipping=None,
-           cmdline=None,
-           debug=0, verbose=1):
+           cmdline=None, pipeline=1, continuous=False, bitsperpixel=32,
+           queuesize=0, localcursor=False, capture=None, replay=None,
+           compresslevel=None, adaptive=False, reconnect=0, rcvbuf=0,
+           pacing=False, statsfile=None, threads=1, blockcache=0,
+           realtime=False, debug=0, verbose=1):
     fp = file(filename, 'wb')
+    capfp = None
+    statsfp = None
+    if statsfile:
+        statsfp = file(statsfile, 'a')
     if pwdfile:
         pwdcache = PWDFile(pwdfile)
     else:
@@ -27,10 +46,23 @@ def flvrec(filename, host='localhost', port=5900,
     writer = FLVWriter(fp, framerate=framerate, debug=debug)
     sink = FLVVideoSink(writer,
                         blocksize=blocksize, framerate=framerate, keyframe=keyframe,
-                        clipping=clipping, debug=debug)
-    client = RFBNetworkClient(host, port, sink, timeout=500/framerate,
-                              pwdcache=pwdcache, preferred_encoding=preferred_encoding,
-                              debug=debug)
+                        clipping=clipping, queuesize=queuesize,
+                        cursor=localcursor, threads=threads, blockcache=blockcache,
+                        debug=debug)
+    if replay:
+        capfp = file(replay, 'rb')
+        client = RFBFileClient(capfp, sink, realtime=realtime,
+                               stats=bool(statsfp), debug=debug)
+    else:
+        if capture:
+            capfp = file(capture, 'wb')
+        client = RFBNetworkClient(host, port, sink, timeout=500/framerate,
+                                  pwdcache=pwdcache, preferred_encoding=preferred_encoding,
+                                  pipeline=pipeline, continuous=continuous,
+                                  bitsperpixel=bitsperpixel, compresslevel=compresslevel,
+                                  adaptive=adaptive, capture=capfp, rcvbuf=rcvbuf,
+                                  pacing=(pacing and framerate), stats=bool(statsfp),
+                                  debug=debug)
     if verbose:
         print >>sys.stderr, 'start recording'
     pid = 0
@@ -46,12 +78,35 @@ def flvrec(filename, host='localhost', port=5900,
             raise KeyboardInterrupt
         signal.signal(signal.SIGINT, sigint_handler)
         client.open()
+        laststats = time.time()
         try:
             while 1:
-                client.idle()
+                if statsfp and laststats+STATS_INTERVAL <= time.time():
+                    dump_stats(statsfp, client, sink)
+                    laststats = time.time()
+                try:
+                    client.idle()
+                except (socket.error, RFBError), e:
+                    if not reconnect or replay: raise
+                    print >>sys.stderr, 'Connection lost:', e
+                    # retry with an increasing interval up to reconnect seconds.
+                    delay = 1
+                    while 1:
+                        time.sleep(delay)
+                        try:
+                            client.reconnect()
+                            # the server may still reject the handshake.
+                            while not client.session_open:
+                                client.idle()
+                            break
+                        except (socket.error, RFBError), e:
+                            print >>sys.stderr, 'Cannot reconnect:', e
+                            delay = min(delay*2, reconnect)
+                    if verbose:
+                        print >>sys.stderr, 'resume recording'
         finally:
             client.close()
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, EOFError):
         pass
     except socket.error, e:
         print >>sys.stderr, 'Socket error:', e
@@ -63,8 +118,17 @@ def flvrec(filename, host='localhost', port=5900,
         os.killpg(os.getpgid(pid), signal.SIGTERM)
     if verbose:
         print >>sys.stderr, 'stop recording'
+        if queuesize:
+            print >>sys.stderr, ('frames: %(frames)d, dropped: %(dropped)d, '
+                                 'queue: %(queued)d (max %(maxqueue)d)' % sink.get_stats())
     writer.close()
     fp.close()
+    if capfp:
+        capfp.close()
+    if statsfp:
+        if client.basetime is not None:
+            dump_stats(statsfp, client, sink)
+        statsfp.close()
     return retval
 
 
@@ -74,12 +138,16 @@ def main(argv):
     def usage():
         print argv[0], vnc2flv.__version__
         print ('usage: %s [-d] [-q] [-o filename] [-r framerate] [-K keyframe]'
-               ' [-e vnc_encoding] [-P vnc_pwdfile] [-N]'
+               ' [-e vnc_encoding] [-P vnc_pwdfile] [-N] [-M]'
                ' [-B blocksize] [-C clipping] [-S subprocess]'
+               ' [-U requests] [-c] [-D bitsperpixel] [-Q queuesize]'
+               ' [-W capturefile] [-I capturefile] [-l] [-z level] [-a] [-R maxdelay]'
+               ' [-b rcvbuf] [-p] [-J statsfile] [-T threads]'
+               ' [-L blockcache]'
                ' [host[:display] [port]]' % argv[0])
         return 100
     try:
-        (opts, args) = getopt.getopt(argv[1:], 'dqo:r:K:t:e:P:NB:C:S:')
+        (opts, args) = getopt.getopt(argv[1:], 'dqo:r:K:t:e:P:NMB:C:S:U:cD:Q:W:I:lz:aR:b:pJ:T:L:')
     except getopt.GetoptError:
         return usage()
     debug = 0
@@ -87,12 +155,28 @@ def main(argv):
     filename = 'out%s.flv' % time.strftime('%Y%m%d%H%M')
     framerate = 12
     keyframe = 120
-    preferred_encoding = (0,)
+    preferred_encoding = (5,0)
     pwdfile = None
     cursor = True
+    localcursor = False
     blocksize = 32
     clipping = None
     cmdline = None
+    pipeline = 1
+    continuous = False
+    bitsperpixel = 32
+    queuesize = 0
+    capture = None
+    replay = None
+    realtime = False
+    compresslevel = None
+    adaptive = False
+    reconnect = 0
+    rcvbuf = 0
+    pacing = False
+    statsfile = None
+    threads = 1
+    blockcache = 0
     (host, port) = ('localhost', 5900)
     for (k, v) in opts:
         if k == '-d': debug += 1
@@ -103,10 +187,31 @@ def main(argv):
         elif k == '-e': preferred_encoding = tuple( int(i) for i in v.split(',') )
         elif k == '-P': pwdfile = v
         elif k == '-N': cursor = False
+        elif k == '-M': localcursor = True
         elif k == '-B': blocksize = int(v)
         elif k == '-C': clipping = str2clip(v)
         elif k == '-S': cmdline = v
-    if not cursor:
+        elif k == '-U': pipeline = int(v)
+        elif k == '-c': continuous = True
+        elif k == '-D': bitsperpixel = int(v)
+        elif k == '-Q': queuesize = int(v)
+        elif k == '-W': capture = v
+        elif k == '-I': replay = v
+        elif k == '-l': realtime = True
+        elif k == '-z': compresslevel = int(v)
+        elif k == '-a': adaptive = True
+        elif k == '-R': reconnect = int(v)
+        elif k == '-b': rcvbuf = int(v)
+        elif k == '-p': pacing = True
+        elif k == '-J': statsfile = v
+        elif k == '-T': threads = int(v)
+        elif k == '-L': blockcache = int(v)
+    if queuesize and (threads != 1 or blockcache):
+        print >>sys.stderr, '-Q cannot be used with -T or -L.'
+        return 100
+    if localcursor:
+        preferred_encoding += (-232,-239,-240,)
+    elif not cursor:
         preferred_encoding += (-232,-239,)
     if 1 <= len(args):
         if ':' in args[0]:
@@ -120,6 +225,12 @@ def main(argv):
     return flvrec(filename, host, port, framerate=framerate, keyframe=keyframe,
                   preferred_encoding=preferred_encoding, pwdfile=pwdfile,
                   blocksize=blocksize, clipping=clipping, cmdline=cmdline,
-                  debug=debug, verbose=verbose)
+                  pipeline=pipeline, continuous=continuous,
+                  bitsperpixel=bitsperpixel, queuesize=queuesize,
+                  localcursor=localcursor, capture=capture, replay=replay,
+                  compresslevel=compresslevel, adaptive=adaptive,
+                  reconnect=reconnect, rcvbuf=rcvbuf, pacing=pacing,
+                  statsfile=statsfile, threads=threads, blockcache=blockcache,
+                  realtime=realtime, debug=debug, verbose=verbose)
 
 if __name__ == "__main__": sys.exit(main(sys.argv))
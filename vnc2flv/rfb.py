@@ -8,15 +8,10 @@
 # For the details of RFB protocol,
 # see http://www.realvnc.com/docs/rfbproto.pdf
 
-import sys, time, socket
-from struct import pack, unpack
+import sys, time, socket, select, zlib
+from struct import pack, unpack, calcsize, error as StructError
 from d3des import decrypt_passwd, generate_response
-
-
-def byte2bit(s):
-    return ''.join([ chr((ord(s[i>>3]) >> (7 - i&7)) & 1) for i in xrange(len(s)*8) ])
-def str2bitmap(data, width, height, rowbytes):
-    return ''.join([ byte2bit(data[i*rowbytes:(i+1)*rowbytes])[:width] for i in xrange(height) ])
+from flvscreen import cursor2argb, xcursor2argb, FlvError
 
 
 # Exceptions
@@ -24,6 +19,39 @@ class RFBError(Exception): pass
 class RFBAuthError(RFBError): pass
 class RFBProtocolError(RFBError): pass
 
+# Errors caused by one session: a broken connection, odd data or a failed write.
+SESSION_ERRORS = (socket.error, IOError, RFBError, FlvError, zlib.error, StructError)
+
+
+# Pixel formats that can be requested:
+#   (bitsperpixel, depth, bigendian, truecolour,
+#    red_max, green_max, blue_max, red_shift, green_shift, blue_shift)
+PIXEL_FORMATS = {
+    32: (32, 24, 1, 1, 255, 255, 255, 24, 16, 8), # RGBX
+    16: (16, 16, 1, 1, 31, 63, 31, 11, 5, 0),     # RGB565
+    8: (8, 8, 1, 1, 7, 7, 3, 0, 3, 6),            # BGR233
+    }
+
+# Capture file (.rfbcap):
+#   header: 'RFBCAP' + version (1 byte) + bitsperpixel (1 byte)
+#   records: timestamp in msec (4 bytes) + length (4 bytes) + received data
+RFBCAP_MAGIC = 'RFBCAP\x01'
+
+# Names used in the statistics.
+MESSAGE_NAMES = {
+    '\x00': 'FramebufferUpdate',
+    '\x01': 'SetColourMapEntries',
+    '\x02': 'Bell',
+    '\x03': 'ServerCutText',
+    '\x96': 'EndOfContinuousUpdates',
+    }
+ENCODING_NAMES = {
+    0: 'Raw', 1: 'CopyRect', 2: 'RRE', 4: 'CoRRE', 5: 'Hextile',
+    7: 'Tight', 16: 'ZRLE',
+    -239: 'RichCursor', -240: 'XCursor', -232: 'CursorPos',
+    -223: 'DesktopSize', -308: 'ExtendedDesktopSize',
+    }
+
 
 
 ##  PWDCache
@@ -60,10 +88,52 @@ class PWDFile(object):
 ##
 class RFBProxy(object):
 
-    def __init__(self, sink, pwdcache=None, preferred_encoding=(5,0), debug=0):
+    # adaptive compression: the link usage is checked every ADAPT_INTERVAL
+    # msec. The compress level is lowered when the updates arrive faster
+    # than ADAPT_FAST_RATE bytes/sec (the server's CPU is the limit).
+    # Otherwise it is raised when the updates occupy more than
+    # ADAPT_BUSY_HIGH of the time or no request was answered within
+    # ADAPT_LATENCY_HIGH msec, and lowered when the updates occupy
+    # less than ADAPT_BUSY_LOW.
+    ADAPT_INTERVAL = 2000
+    ADAPT_BUSY_HIGH = 0.5
+    ADAPT_BUSY_LOW = 0.1
+    ADAPT_LATENCY_HIGH = 300
+    ADAPT_FAST_RATE = 5000000
+    ADAPT_LEVELS = (1, 9)
+
+    def __init__(self, sink, pwdcache=None, preferred_encoding=(5,0), bufsiz=65536,
+                 pipeline=1, continuous=False, bitsperpixel=32,
+                 compresslevel=None, adaptive=False, pacing=0, stats=False, debug=0):
+        if bitsperpixel not in PIXEL_FORMATS:
+            raise ValueError('unsupported bitsperpixel: %r' % bitsperpixel)
         self.sink = sink
         self.pwdcache = pwdcache
         self.preferred_encoding = preferred_encoding
+        self.bufsiz = bufsiz
+        # pipeline: the number of outstanding update requests.
+        self.pipeline = pipeline
+        # continuous: use ContinuousUpdates if the server supports it.
+        self.continuous = continuous
+        # bitsperpixel: the pixel format requested to the server.
+        self.bitsperpixel = bitsperpixel
+        # compresslevel: the CompressLevel (0-9) requested to the server.
+        self.compresslevel = compresslevel
+        # adaptive: change the compress level according to the link usage.
+        self.adaptive = adaptive
+        if adaptive and compresslevel is None:
+            self.compresslevel = 6
+        # pacing: if non-zero, the update requests are sent in step with
+        # the output frames at this frame rate instead of after every update.
+        self.pacing = pacing
+        self.nextrequest = None
+        # stats: count the bytes, messages and time spent (see get_stats).
+        self.stats = None
+        if stats:
+            self.stats = { 'states': {}, 'messages': {}, 'encodings': {},
+                           'flush': [0, 0.0] }
+        self._pos = 0
+        self._msg = self._rect = None
         self.debug = debug
         self.basetime = None
         self.session_open = False
@@ -74,7 +144,7 @@ class RFBProxy(object):
                          red_shift, green_shift, blue_shift):
         # should return 10-tuple (bitsperpixel, depth, bigendian, truecolour,
         #   red_max, green_max, blue_max, red_shift, green_shift, blue_shift)
-        return (32, 8, 1, 1, 255, 255, 255, 24, 16, 8)
+        return PIXEL_FORMATS[self.bitsperpixel]
 
     def send(self, s):
         "Send data s to the server."
@@ -84,38 +154,289 @@ class RFBProxy(object):
         assert self.basetime != None
         return int(time.time()*1000) - self.basetime
 
-    def request_update(self):
+    # count: False for an extra request that the server may merge with
+    # the outstanding ones, so that it does not hold back the pipeline.
+    def request_update(self, incremental=1, rect=None, count=True):
         if not self.session_open: return
         if self.debug:
-            print >>sys.stderr, 'FrameBufferUpdateRequest'
-        self.send('\x03\x01' + pack('>HHHH', *self.clipping))
+            print >>sys.stderr, 'FrameBufferUpdateRequest: incremental=%d' % incremental
+        self.send(pack('>BB', 3, incremental) + pack('>HHHH', *(rect or self.clipping)))
+        if count:
+            self.requests += 1
+            if self.adaptive:
+                self._requested.append(self.time())
+        return
+
+    # keeps the pipeline of the update requests full.
+    def request_more(self):
+        if self.continuous_updates: return
+        if self.pacing:
+            self.schedule_request()
+        else:
+            while self.requests < self.pipeline:
+                self.request_update()
+        return
+
+    def enable_continuous_updates(self):
+        if self.debug:
+            print >>sys.stderr, 'EnableContinuousUpdates'
+        self.send(pack('>BB', 150, 1) + pack('>HHHH', *self.clipping))
+        self.continuous_updates = True
+        return
+
+    # schedules a request at the beginning of the next output frame.
+    def schedule_request(self):
+        if self.nextrequest is None and self.requests < self.pipeline:
+            frame = self.time() * self.pacing / 1000 + 1
+            # rounded up so that it is always later than now.
+            self.nextrequest = (frame * 1000 + self.pacing-1) / self.pacing
+        return
+
+    def send_scheduled_request(self):
+        "Sends the scheduled request if it is due. Returns msec until the next one, or None."
+        if self.nextrequest is None or not self.session_open: return None
+        t = self.time()
+        if t < self.nextrequest:
+            return self.nextrequest - t
+        self.nextrequest = None
+        self.ticks += 1
+        # only the visible part of the clipping is requested, except once
+        # a second so that the changes outside the window are noticed.
+        rect = None
+        if self.ticks % self.pacing:
+            rect = self.sink.get_visible_area()
+        if rect:
+            (x0, y0, w0, h0) = self.clipping
+            (x, y, w, h) = rect
+            (x1, y1) = (max(x, x0), max(y, y0))
+            (x2, y2) = (min(x+w, x0+w0), min(y+h, y0+h0))
+            rect = (x1, y1, max(0, x2-x1), max(0, y2-y1))
+        self.request_update(rect=rect)
+        self.schedule_request()
+        if self.nextrequest is None: return None
+        return self.nextrequest - t
+
+    def send_encodings(self):
+        # DesktopSize and ExtendedDesktopSize
+        encodings = self.preferred_encoding + (-223, -308)
+        if self.continuous:
+            # ContinuousUpdates
+            encodings += (-313,)
+        if self.compresslevel is not None:
+            # CompressLevel
+            encodings += (-256+self.compresslevel,)
+        if self.debug:
+            print >>sys.stderr, 'SetEncodings: %r' % (encodings,)
+        self.send('\x02\x00' + pack('>H', len(encodings)) +
+                  ''.join( pack('>l', e) for e in encodings ))
+        return
+
+    # measures the link usage and changes the compress level.
+    def adapt(self):
+        t = self.time()
+        interval = t - self._adapt_start
+        if interval < self.ADAPT_INTERVAL: return
+        busy = self._adapt_busy / float(interval)
+        # throughput while the updates are coming.
+        rate = self._adapt_bytes * 1000 / max(1, self._adapt_busy)
+        # the shortest time from a request to its update; a request for
+        # a still screen is held by the server, so the average is useless.
+        latency = self._adapt_latency
+        (lo, hi) = self.ADAPT_LEVELS
+        level = self.compresslevel
+        if self.ADAPT_FAST_RATE < rate:
+            level = max(level-1, lo)
+        elif (self.ADAPT_BUSY_HIGH < busy or
+              (latency is not None and self.ADAPT_LATENCY_HIGH < latency)):
+            level = min(level+1, hi)
+        elif busy < self.ADAPT_BUSY_LOW:
+            level = max(level-1, lo)
+        if self.debug:
+            print >>sys.stderr, 'adapt: busy=%.2f, rate=%d bytes/sec, latency=%r, compresslevel=%d' % \
+                  (busy, rate, latency, level)
+        if level != self.compresslevel:
+            self.compresslevel = level
+            self.send_encodings()
+        self._adapt_start = t
+        self._adapt_busy = self._adapt_bytes = 0
+        self._adapt_latency = None
         return
 
     def open(self):
-        self.basetime = int(time.time()*1000)
-        self._curbuf = ''
+        # the timestamps continue when the session is opened again.
+        if self.basetime is None:
+            self.basetime = int(time.time()*1000)
+        # The receive buffer: bytes in [_start,_end) are not consumed yet.
+        # State handlers are given a memoryview of this buffer, which is
+        # valid only until the handler returns.
+        self._buf = bytearray(self.bufsiz)
+        self._view = memoryview(self._buf)
+        self._start = self._end = 0
+        # ZRLE uses one zlib stream throughout the connection.
+        self._zrle = zlib.decompressobj()
+        # Tight uses four zlib streams.
+        self._tight = [ zlib.decompressobj() for _ in xrange(4) ]
         (self._length, self._state) = self.init()
+        if self.stats is not None:
+            self.count_message('Handshake')
+        # statistics for the adaptive compression.
+        self._adapt_start = self._framestart = 0
+        self._adapt_busy = self._adapt_bytes = 0
+        self._adapt_latency = None
+        self._requested = []
+        return
+
+    def get_buffer(self, n):
+        "Returns a writable view that has at least n free bytes."
+        size = self._end - self._start
+        need = max(size+n, abs(self._length))
+        if len(self._buf) < need:
+            # allocate a larger buffer.
+            buf = bytearray(max(need, len(self._buf)*2))
+            buf[:size] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+            (self._start, self._end) = (0, size)
+        elif len(self._buf) < self._end+n:
+            # move the remaining bytes to the beginning.
+            self._view[:size] = self._view[self._start:self._end]
+            (self._start, self._end) = (0, size)
+        return self._view[self._end:]
+
+    def feed_buffer(self, n):
+        "Processes n bytes that have been written to get_buffer()."
+        self._end += n
+        self._adapt_bytes += n
+        if self.stats is not None:
+            return self.feed_buffer_stats()
+        while 1:
+            if self._length < 0:
+                # A state with a negative length wants at least -length bytes.
+                # It receives all the available data and returns
+                # (consumed, (length, state)).
+                if self._end - self._start < -self._length: break
+                x = self._view[self._start:self._end]
+                if self.debug:
+                    print >>sys.stderr, 'feed: state=%r, data=%r' % (self._state, x[:10].tobytes())
+                (n, (self._length, self._state)) = self._state(x)
+                self._start += n
+            else:
+                if self._end - self._start < self._length: break
+                i = self._start
+                self._start += self._length
+                x = self._view[i:self._start]
+                if self.debug:
+                    print >>sys.stderr, 'feed: state=%r, data=%r' % (self._state, x[:10].tobytes())
+                (self._length, self._state) = self._state(x)
+        if self._start == self._end:
+            self._start = self._end = 0
+        return
+
+    # same as feed_buffer() except that the states are counted.
+    def feed_buffer_stats(self):
+        states = self.stats['states']
+        while 1:
+            greedy = (self._length < 0)
+            if greedy:
+                if self._end - self._start < -self._length: break
+                x = self._view[self._start:self._end]
+            else:
+                if self._end - self._start < self._length: break
+                x = self._view[self._start:self._start+self._length]
+            state = self._state
+            t0 = time.time()
+            r = state(x)
+            dt = time.time() - t0
+            c = states.get(state.__name__)
+            if c is None:
+                c = states[state.__name__] = [0, 0.0]
+            c[0] += 1
+            c[1] += dt
+            if greedy:
+                (n, (self._length, self._state)) = r
+            else:
+                n = len(x)
+                (self._length, self._state) = r
+            self._start += n
+            self._pos += n
+        if self._start == self._end:
+            self._start = self._end = 0
+        return
+
+    # counts a message that starts at the current position.
+    def count_message(self, name):
+        self.count_rects(None)
+        if self._msg is not None:
+            (c, pos) = self._msg
+            c[1] += self._pos - pos
+        c = self.stats['messages'].get(name)
+        if c is None:
+            c = self.stats['messages'][name] = [0, 0]
+        c[0] += 1
+        self._msg = (c, self._pos)
+        return
+
+    # counts n rectangles that start at the current position.
+    def count_rects(self, name, n=1):
+        if self._rect is not None:
+            (c, pos) = self._rect
+            c[1] += self._pos - pos
+            self._rect = None
+        if name is None: return
+        c = self.stats['encodings'].get(name)
+        if c is None:
+            c = self.stats['encodings'][name] = [0, 0]
+        c[0] += n
+        self._rect = (c, self._pos)
+        return
+
+    def flush_sink(self, t):
+        if self.stats is None:
+            self.sink.flush(t)
+            return
+        t0 = time.time()
+        self.sink.flush(t)
+        c = self.stats['flush']
+        c[0] += 1
+        c[1] += time.time() - t0
         return
 
+    def get_stats(self):
+        "Returns the counters as a dict (or None if stats is not enabled)."
+        if self.stats is None: return None
+        # the current message and rectangle are counted up to here.
+        def pending(c):
+            for x in (self._msg, self._rect):
+                if x is not None and x[0] is c:
+                    return self._pos - x[1]
+            return 0
+        return {
+            'bytes': self._pos,
+            'states': dict( (k, {'calls': c, 'seconds': t})
+                            for (k, (c, t)) in self.stats['states'].iteritems() ),
+            'messages': dict( (k, {'count': c[0], 'bytes': c[1]+pending(c)})
+                              for (k, c) in self.stats['messages'].iteritems() ),
+            'encodings': dict( (k, {'rects': c[0], 'bytes': c[1]+pending(c)})
+                               for (k, c) in self.stats['encodings'].iteritems() ),
+            'flush': {'calls': self.stats['flush'][0], 'seconds': self.stats['flush'][1]},
+            }
+
     def feed(self, data):
-        self._curbuf += data
-        while self._length <= len(self._curbuf):
-            x = self._curbuf[:self._length]
-            self._curbuf = self._curbuf[self._length:]
-            if self.debug:
-                print >>sys.stderr, 'feed: state=%r, data=%r' % (self._state, x[:10])
-            (self._length, self._state) = self._state(x)
+        n = len(data)
+        self.get_buffer(n)[:n] = data
+        self.feed_buffer(n)
         return
 
     def close(self):
         self.session_open = False
-        self.sink.flush(self.time())
+        self.flush_sink(self.time())
         self.sink.close()
         return
 
     def init(self):
         return (12, self.init_1)
     def init_1(self, server_version):
+        server_version = server_version.tobytes()
         # send: client protocol version
         self.protocol_version = 3
         if server_version.startswith('RFB 003.007'):
@@ -138,7 +459,7 @@ class RFBProxy(object):
         return (reason_length, self.autherr_2)
     def autherr_2(self, reason):
         # receive reason string
-        raise RFBAuthError('Auth Error: %s' % reason)
+        raise RFBAuthError('Auth Error: %s' % reason.tobytes())
 
     def auth3(self):
         # protocol 3.3 (or 3.6)
@@ -164,6 +485,7 @@ class RFBProxy(object):
         (nsecurities,) = unpack('>B', data)
         return (nsecurities, self.auth7_2)
     def auth7_2(self, server_securities):
+        server_securities = server_securities.tobytes()
         if self.debug:
             print >>sys.stderr, 'server_securities: %r' % server_securities
         # must include None or VNCAuth
@@ -188,6 +510,7 @@ class RFBProxy(object):
         # vnc challange & response auth
         return (16, self.crauth_1)
     def crauth_1(self, challange):
+        challange = challange.tobytes()
         if self.debug:
             print >>sys.stderr, 'challange: %r' % challange
         if not self.pwdcache:
@@ -225,7 +548,7 @@ class RFBProxy(object):
         (self.width, self.height, self.pixelformat, namelen) = unpack('>HH16sL', server_init)
         return (namelen, self.start_2)
     def start_2(self, name):
-        self.name = name
+        self.name = name.tobytes()
         (bitsperpixel, depth, bigendian, truecolour,
          red_max, green_max, blue_max,
          red_shift, green_shift, blue_shift) = unpack('>BBBBHHHBBBxxx', self.pixelformat)
@@ -237,29 +560,46 @@ class RFBProxy(object):
             print >>sys.stderr, ' rgbshift=', (red_shift, green_shift, blue_shift)
         # setformat
         self.send('\x00\x00\x00\x00')
-        # 32bit, 8bit-depth, big-endian(RGBX), truecolour, 255max
         (bitsperpixel, depth, bigendian, truecolour,
          red_max, green_max, blue_max,
          red_shift, green_shift, blue_shift) = self.preferred_format(bitsperpixel, depth, bigendian, truecolour,
                                                                      red_max, green_max, blue_max,
                                                                      red_shift, green_shift, blue_shift)
         self.bytesperpixel = bitsperpixel/8
+        # Tight sends 24bit colors in 3 bytes.
+        if (bitsperpixel == 32 and depth == 24 and truecolour and
+            red_max == 255 and green_max == 255 and blue_max == 255):
+            self.tpixelsize = 3
+        else:
+            self.tpixelsize = self.bytesperpixel
         pixelformat = pack('>BBBBHHHBBBxxx', bitsperpixel, depth, bigendian, truecolour,
                            red_max, green_max, blue_max,
                            red_shift, green_shift, blue_shift)
         self.send(pixelformat)
+        self.sink.set_format((bitsperpixel, depth, bigendian, truecolour,
+                              red_max, green_max, blue_max,
+                              red_shift, green_shift, blue_shift))
         self.clipping = self.sink.init_screen(self.width, self.height, self.name)
-        self.send('\x02\x00' + pack('>H', len(self.preferred_encoding)))
-        for e in self.preferred_encoding:
-            self.send(pack('>l', e))
+        self.send_encodings()
+        self._adapt_start = self.time()
         self.session_open = True
+        self.requests = 0
+        self.continuous_updates = False
+        self.nextrequest = None
+        self.ticks = 0
+        # the first request gets the entire screen.
+        self.request_update(incremental=0)
+        while self.requests < self.pipeline:
+            self.request_update()
         return self.loop()
 
     def loop(self):
-        self.request_update()
         return (1, self.loop_1)
 
-    def loop_1(self, c):
+    def loop_1(self, data):
+        c = data[0]
+        if self.stats is not None:
+            self.count_message(MESSAGE_NAMES.get(c, 'Unknown'))
         if c == '\x00':
             # framebuffer update
             return self.framebegin()
@@ -274,6 +614,14 @@ class RFBProxy(object):
         elif c == '\x03':
             # cut-and-paste
             return self.cutnpaste()
+        elif c == '\x96':
+            # end of continuous updates
+            if self.debug:
+                print >>sys.stderr, 'EndOfContinuousUpdates'
+            if self.continuous and not self.continuous_updates:
+                # the server supports it.
+                self.enable_continuous_updates()
+            return self.loop()
         else:
             # others
             raise RFBProtocolError('Unsupported msg: %d' % ord(c))
@@ -285,7 +633,7 @@ class RFBProxy(object):
         return (length, self.cutnpaste_2)
     def cutnpaste_2(self, data):
         if self.debug:
-            print >>sys.stderr, 'ServerCutText: %r' % data
+            print >>sys.stderr, 'ServerCutText: %r' % data.tobytes()
         return self.loop()
 
     def cmap(self):
@@ -301,23 +649,56 @@ class RFBProxy(object):
     def framebegin(self):
         return (3, self.frame_1)
     def frameend(self):
-        self.sink.flush(self.time())
+        t = self.time()
+        self._adapt_busy += t - self._framestart
+        self.flush_sink(t)
+        if self.adaptive:
+            self.adapt()
+        self.request_more()
         return self.loop()
 
     def frame_1(self, data):
         (nrects,) = unpack('>xH', data)
+        self.requests = max(0, self.requests-1)
+        self._framestart = self.time()
+        if self._requested:
+            latency = self._framestart - self._requested.pop(0)
+            if self._adapt_latency is None or latency < self._adapt_latency:
+                self._adapt_latency = latency
+            # the requests merged by the server are answered at once.
+            del self._requested[:max(0, len(self._requested)-self.requests)]
         if self.debug:
             print >>sys.stderr, 'FrameBufferUpdate: nrects=%d' % nrects
         self.nrects = nrects
         return self.framerect()
     def framerect(self):
         if self.nrects:
+            if not self.debug:
+                # let the sink decode as many rectangles as it can.
+                return (-12, self.framerect_fast)
             self.nrects -= 1
             return (12, self.framerect_1)
         else:
             return self.frameend()
+    def framerect_fast(self, data):
+        if self.stats is not None:
+            # one at a time, so that each rectangle is counted by its encoding.
+            (n, nrects) = self.sink.update_screen_rects(data, 1)
+            if nrects:
+                (enc,) = unpack('>l', data[8:12])
+                self.count_rects(ENCODING_NAMES.get(enc, str(enc)))
+        else:
+            (n, nrects) = self.sink.update_screen_rects(data, self.nrects)
+        if nrects == 0:
+            # the next rectangle is decoded here.
+            self.nrects -= 1
+            return (0, (12, self.framerect_1))
+        self.nrects -= nrects
+        return (n, self.framerect())
     def framerect_1(self, data):
         (x, y, width, height, enc) = unpack('>HHHHl', data)
+        if self.stats is not None:
+            self.count_rects(ENCODING_NAMES.get(enc, str(enc)))
         self.rectpos = (x, y)
         self.rectsize = (width, height)
         if self.debug:
@@ -326,20 +707,23 @@ class RFBProxy(object):
             # RawEncoding
             return self.encraw(width, height)
         elif enc == 1:
-            # CopyRectEncoding (NOT SUPPORTED)
-            raise RFBProtocolError('Unsupported encoding: 0x%02x' % enc)
+            # CopyRectEncoding
+            return self.enccopy()
         elif enc == 2:
             # RREEncoding
             return self.encrre()
         elif enc == 4:
-            # CoRREEncoding (NOT SUPPORTED)
-            raise RFBProtocolError('Unsupported encoding: 0x%02x' % enc)
+            # CoRREEncoding
+            return self.encrre('>BBBB')
         elif enc == 5:
-            # HextileEncoding (NOT SUPPORTED)
-            raise RFBProtocolError('Unsupported encoding: 0x%02x' % enc)
+            # HextileEncoding
+            return self.enchextile(width, height)
+        elif enc == 7:
+            # TightEncoding
+            return self.enctight()
         elif enc == 16:
-            # ZRLEEncoding (NOT SUPPORTED)
-            raise RFBProtocolError('Unsupported encoding: 0x%02x' % enc)
+            # ZRLEEncoding
+            return self.enczrle()
         elif enc == -239:
             # RichCursor
             return self.richcursor(width, height)
@@ -349,6 +733,12 @@ class RFBProxy(object):
         elif enc == -232:
             # CursorPos -> only change the cursor position
             return self.cursorpos(x, y)
+        elif enc == -223:
+            # DesktopSize
+            return self.desktopsize(width, height)
+        elif enc == -308:
+            # ExtendedDesktopSize
+            return self.extdesktopsize(x, y)
         else:
             raise RFBProtocolError('Unsupported encoding: 0x%02x' % enc)
 
@@ -357,70 +747,181 @@ class RFBProxy(object):
     def encraw_1(self, data):
         if self.debug:
             print >>sys.stderr, ' RawEncoding: received=%d' % (len(data))
-        self.sink.update_screen_rgbabits(self.rectpos, self.rectsize, data)
+        self.sink.update_screen_pixels(self.rectpos, self.rectsize, data)
+        return self.framerect()
+
+    def enchextile(self, width, height):
+        if width == 0 or height == 0:
+            return self.framerect()
+        # (tile, bgcolor, fgcolor)
+        self.hextile = (0, 0, 0)
+        return (-1, self.enchextile_1)
+    def enchextile_1(self, data):
+        (n, self.hextile) = self.sink.update_screen_hextile(self.rectpos, self.rectsize,
+                                                            data, self.hextile)
+        if self.hextile is None:
+            if self.debug:
+                print >>sys.stderr, ' HextileEncoding: done'
+            return (n, self.framerect())
+        # wait for more data.
+        return (n, (n-len(data)-1, self.enchextile_1))
+
+    def enczrle(self):
+        return (4, self.enczrle_1)
+    def enczrle_1(self, data):
+        (length,) = unpack('>L', data)
+        return (length, self.enczrle_2)
+    def enczrle_2(self, data):
+        if self.debug:
+            print >>sys.stderr, ' ZRLEEncoding: received=%d' % len(data)
+        data = self._zrle.decompress(data.tobytes())
+        self.sink.update_screen_zrle(self.rectpos, self.rectsize, data)
+        return self.framerect()
+
+    def enctight(self):
+        return (1, self.enctight_1)
+    def enctight_1(self, data):
+        c = ord(data[0])
+        # reset the zlib streams.
+        for i in xrange(4):
+            if c & (1 << i):
+                self._tight[i] = zlib.decompressobj()
+        c >>= 4
+        if c == 8:
+            # FillCompression
+            return (self.tpixelsize, self.enctight_fill)
+        elif 8 < c:
+            # JpegCompression (NOT SUPPORTED)
+            raise RFBProtocolError('Unsupported tight compression: 0x%x' % c)
+        # BasicCompression
+        self.tightstream = c & 3
+        self.tightfilter = 0
+        self.tightpalette = ''
+        if c & 4:
+            return (1, self.enctight_filter)
+        return self.enctight_data()
+    def enctight_fill(self, data):
+        if self.debug:
+            print >>sys.stderr, ' TightEncoding: fill'
+        self.sink.update_screen_tight(self.rectpos, self.rectsize, 1, '', data.tobytes())
+        return self.framerect()
+    def enctight_filter(self, data):
+        self.tightfilter = ord(data[0])
+        if self.tightfilter == 1:
+            # PaletteFilter
+            return (1, self.enctight_palette)
+        elif self.tightfilter == 0 or self.tightfilter == 2:
+            # CopyFilter or GradientFilter
+            return self.enctight_data()
+        raise RFBProtocolError('Unsupported tight filter: %d' % self.tightfilter)
+    def enctight_palette(self, data):
+        return ((ord(data[0])+1) * self.tpixelsize, self.enctight_palette_1)
+    def enctight_palette_1(self, data):
+        self.tightpalette = data.tobytes()
+        return self.enctight_data()
+    def enctight_data(self):
+        (width, height) = self.rectsize
+        if self.tightfilter != 1:
+            n = width*height*self.tpixelsize
+        elif len(self.tightpalette) == 2*self.tpixelsize:
+            n = (width+7)/8*height
+        else:
+            n = width*height
+        if n < 12:
+            # not compressed.
+            self.tightlength = None
+            return (n, self.enctight_data_2)
+        self.tightlength = 0
+        self.tightshift = 0
+        return (1, self.enctight_data_1)
+    def enctight_data_1(self, data):
+        # compact length: 7bit + 7bit + 8bit.
+        c = ord(data[0])
+        if self.tightshift == 14:
+            self.tightlength |= c << 14
+        else:
+            self.tightlength |= (c & 0x7f) << self.tightshift
+            if c & 0x80:
+                self.tightshift += 7
+                return (1, self.enctight_data_1)
+        return (self.tightlength, self.enctight_data_2)
+    def enctight_data_2(self, data):
+        data = data.tobytes()
+        if self.tightlength is not None:
+            data = self._tight[self.tightstream].decompress(data)
+        if self.debug:
+            print >>sys.stderr, ' TightEncoding: filter=%d, data=%d' % (self.tightfilter, len(data))
+        self.sink.update_screen_tight(self.rectpos, self.rectsize,
+                                      self.tightfilter, data, self.tightpalette)
         return self.framerect()
 
     def enccopy(self):
         return (4, self.enccopy_1)
-    def enccopy_1(self):
+    def enccopy_1(self, data):
+        (sx, sy) = unpack('>HH', data)
+        if self.debug:
+            print >>sys.stderr, ' CopyRectEncoding: from (%d,%d)' % (sx, sy)
+        self.sink.update_screen_copyrect(self.rectpos, self.rectsize, (sx, sy))
+        (x0, y0, w0, h0) = self.clipping
+        (x, y) = self.rectpos
+        (width, height) = self.rectsize
+        if ((x < x0+w0 and x0 < x+width and y < y0+h0 and y0 < y+height) and
+            not (x0 <= sx and y0 <= sy and sx+width <= x0+w0 and sy+height <= y0+h0)):
+            # the source is not entirely visible to us: get the pixels.
+            self.request_update(incremental=0, rect=(x, y, width, height), count=False)
         return self.framerect()
 
-    def encrre(self):
-        return (4, self.encrre_1)
+    def encrre(self, fmt='>HHHH'):
+        # fmt: subrect position and size ('>BBBB' for CoRRE).
+        self.rrefmt = fmt
+        return (4+self.bytesperpixel, self.encrre_1)
     def encrre_1(self, data):
-        (self.nsubrects,) = unpack('>L', data)
-        return (self.bytesperpixel, self.encrre_2)
-    def encrre_2(self, bgcolor):
+        (nsubrects,) = unpack('>L', data[:4])
+        bgcolor = data[4:].tobytes()
         if self.debug:
-            print >>sys.stderr, ' RREEncoding: subrects=%d, bgcolor=%r' % (self.nsubrects, bgcolor)
+            print >>sys.stderr, ' RREEncoding: subrects=%d, bgcolor=%r' % (nsubrects, bgcolor)
         self.sink.update_screen_solidrect(self.rectpos, self.rectsize, bgcolor)
-        return self.encrre_subrect()
-    def encrre_subrect(self):
-        if self.nsubrect:
-            self.nsubrect -= 1
-            return (self.bytesperpixel, self.encrre_subrect_1)
-        else:
-            return self.framerect()
-    def encrre_subrect_1(self, fgcolor):
-        fgcolor = self.recv(self.bytesperpixel)
-        (x,y,w,h) = unpack('>HHHH', self.recv(8))
-        if 2 <= self.debug:
-            print >>sys.stderr, ' RREEncoding: ', (x,y,w,h,fgcolor)
+        return (nsubrects*(self.bytesperpixel+calcsize(self.rrefmt)), self.encrre_2)
+    def encrre_2(self, data):
+        data = data.tobytes()
+        n = self.bytesperpixel
+        m = n+calcsize(self.rrefmt)
         (x0,y0) = self.rectpos
-        self.sink.update_screen_solidrect((x0+x, y0+y), (w, h), fgcolor)
-        return self.encrre_subrect()
+        for i in xrange(0, len(data), m):
+            fgcolor = data[i:i+n]
+            (x,y,w,h) = unpack(self.rrefmt, data[i+n:i+m])
+            if 2 <= self.debug:
+                print >>sys.stderr, ' RREEncoding: ', (x,y,w,h,fgcolor)
+            self.sink.update_screen_solidrect((x0+x, y0+y), (w, h), fgcolor)
+        return self.framerect()
 
+    # For the cursor pseudo-encodings, the rectangle position is the hotspot.
     def richcursor(self, width, height):
         if width == 0 or height == 0:
+            # hide the cursor.
+            self.sink.update_cursor_image(0, 0, '', self.rectpos)
             return self.framerect()
         rowbytes = (width + 7) / 8
         return (width*height*self.bytesperpixel + rowbytes*height, self.richcursor_1)
     def richcursor_1(self, data):
         (x,y) = self.rectpos
         (width,height) = self.rectsize
-        rowbytes = (width + 7) / 8
         # Cursor image RGB
         n = width*height*self.bytesperpixel
         image = data[:n]
         # Cursor mask -> 1 bit/pixel (1 -> image; 0 -> transparent)
         mask = data[n:]
-        # Set the alpha channel with maskData where bit=1 -> alpha = 255, bit=0 -> alpha=255
         if self.debug:
-            print >>sys.stderr, 'RichCursor: %dx%d at %d,%d' % (width,height,x,y)
-        image = self.sink.convert_pixels(image)
-        mask = str2bitmap(mask, w, h, rowbytes)
-        def conv1(i):
-            if mask[i/4] == '\x01':
-                return '\xff'+image[i]+image[i+1]+image[i+2]
-            else:
-                return '\x00\x00\x00\x00'
-        bits = ''.join([ conv1(i) for i in xrange(0, len(image), 4) ])
-        self.sink.update_cursor_image(width, height, bits)
-        self.sink.update_cursor_pos(x, y)
-        return
+            print >>sys.stderr, 'RichCursor: %dx%d, hotspot=%d,%d' % (width,height,x,y)
+        image = self.sink.convert_pixels(image.tobytes())
+        bits = cursor2argb(width, height, image, mask)
+        self.sink.update_cursor_image(width, height, bits, (x, y))
+        return self.framerect()
 
     def xcursor(self, width, height):
         if width == 0 or height == 0:
+            # hide the cursor.
+            self.sink.update_cursor_image(0, 0, '', self.rectpos)
             return self.framerect()
         rowbytes = (width + 7) / 8
         return (3+3+2*rowbytes*height, self.xcursor_1)
@@ -439,21 +940,10 @@ class RFBProxy(object):
         mask = data[6+n:]
         # Create the image from cursordata and maskdata.
         if self.debug:
-            print >>sys.stderr, 'XCursor: %dx%d at %d,%d' % (width,height,x,y)
-        shape = str2bitmap(shape, width, height, rowbytes)
-        mask = str2bitmap(mask, width, height, rowbytes)
-        def conv1(i):
-            if mask[i] == '\x01':
-                if shape[i] == '\x01':
-                    return '\xff'+fgcolor
-                else:
-                    return '\xff'+bgcolor
-            else:
-                return '\x00\x00\x00\x00'
-        bits = ''.join([ conv1(i) for i in xrange(len(shape)) ])
-        self.sink.update_cursor_image(width, height, bits)
-        self.sink.update_cursor_pos(x, y)
-        return
+            print >>sys.stderr, 'XCursor: %dx%d, hotspot=%d,%d' % (width,height,x,y)
+        bits = xcursor2argb(width, height, fgcolor, bgcolor, shape, mask)
+        self.sink.update_cursor_image(width, height, bits, (x, y))
+        return self.framerect()
 
     def cursorpos(self, x, y):
         if self.debug:
@@ -461,46 +951,310 @@ class RFBProxy(object):
         self.sink.update_cursor_pos(x, y)
         return self.framerect()
 
+    def desktopsize(self, width, height):
+        if self.debug:
+            print >>sys.stderr, 'DesktopSize: %dx%d' % (width, height)
+        self.resize(width, height)
+        return self.framerect()
+
+    def extdesktopsize(self, reason, status):
+        # reason=1: the result of our request (never sent).
+        self.extstatus = status
+        return (4, self.extdesktopsize_1)
+    def extdesktopsize_1(self, data):
+        (nscreens,) = unpack('>Bxxx', data)
+        return (nscreens*16, self.extdesktopsize_2)
+    def extdesktopsize_2(self, data):
+        (width, height) = self.rectsize
+        if self.debug:
+            print >>sys.stderr, 'ExtendedDesktopSize: %dx%d, status=%d' % (width, height, self.extstatus)
+        if self.extstatus == 0:
+            self.resize(width, height)
+        return self.framerect()
+
+    def resize(self, width, height):
+        if (width, height) == (self.width, self.height): return
+        (w0, h0) = (self.width, self.height)
+        (x0, y0) = self.clipping[:2]
+        (self.width, self.height) = (width, height)
+        self.clipping = self.sink.resize_screen(width, height)
+        if self.continuous_updates:
+            # update the area.
+            self.enable_continuous_updates()
+        (cx, cy, cw, ch) = self.clipping
+        if (cx, cy) != (x0, y0):
+            # the clipping has moved: request everything.
+            self.request_update(incremental=0, count=False)
+            return
+        # only the newly exposed areas are requested.
+        for (x, y, w, h) in ((w0, 0, width-w0, height),
+                             (0, h0, min(w0, width), height-h0)):
+            (x1, y1) = (max(x, cx), max(y, cy))
+            (x2, y2) = (min(x+w, cx+cw), min(y+h, cy+ch))
+            if x1 < x2 and y1 < y2:
+                self.request_update(incremental=0, rect=(x1, y1, x2-x1, y2-y1),
+                                    count=False)
+        return
+
 
 ##  RFBNetworkClient
 ##
 class RFBNetworkClient(RFBProxy):
 
+    # the timeout (sec) of connecting to the server.
+    CONNECT_TIMEOUT = 5
+
     def __init__(self, host, port, sink, timeout=50, bufsiz=65536,
-                 pwdcache=None, preferred_encoding=(0,5), debug=0):
+                 pwdcache=None, preferred_encoding=(0,5),
+                 pipeline=1, continuous=False, bitsperpixel=32,
+                 compresslevel=None, adaptive=False, capture=None,
+                 rcvbuf=0, nodelay=True, pacing=0, stall=5000, stats=False, debug=0):
         RFBProxy.__init__(self, sink,
-                          pwdcache=pwdcache, preferred_encoding=preferred_encoding, debug=debug)
+                          pwdcache=pwdcache, preferred_encoding=preferred_encoding,
+                          bufsiz=bufsiz, pipeline=pipeline, continuous=continuous,
+                          bitsperpixel=bitsperpixel, compresslevel=compresslevel,
+                          adaptive=adaptive, pacing=pacing, stats=stats, debug=debug)
         self.host = host
         self.port = port
         self.timeout = timeout
-        self.bufsiz = bufsiz
+        # capture: a file object where the received data is recorded.
+        self.capture = capture
+        # rcvbuf: the socket receive buffer size (0 = system default).
+        self.rcvbuf = rcvbuf
+        # nodelay: send the update requests without delay.
+        self.nodelay = nodelay
+        # stall: msec of silence after which one more request is sent (0 = never).
+        self.stall = stall
         return
 
     def open(self):
+        reopen = (self.basetime is not None)
         RFBProxy.open(self)
+        if self.capture:
+            if reopen:
+                # an empty record marks a new connection.
+                self.capture.write(pack('>LL', self.time(), 0))
+            else:
+                self.capture.write(RFBCAP_MAGIC + chr(self.bitsperpixel))
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.rcvbuf:
+            # must be set before connecting so that a large window is used.
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        if self.nodelay:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(self.CONNECT_TIMEOUT)
         self.sock.connect((self.host, self.port))
         self.sock.settimeout(self.timeout*.001)
+        self.lastrecv = self.time()
         if self.debug:
             print >>sys.stderr, 'Connected: %s:%d' % (self.host, self.port)
         return
 
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self):
+        buf = self.get_buffer(self.bufsiz)
+        n = self.sock.recv_into(buf)
+        if not n: raise RFBProtocolError('unexpected EOF')
+        self.lastrecv = self.time()
+        # take all the data that has already arrived before processing it.
+        while n < len(buf) and select.select([self.sock], [], [], 0)[0]:
+            m = self.sock.recv_into(buf[n:])
+            if not m: break
+            n += m
+        if self.capture:
+            self.capture.write(pack('>LL', self.time(), n))
+            self.capture.write(buf[:n])
+        self.feed_buffer(n)
+        return
+
     def idle(self):
+        wait = self.send_scheduled_request()
+        if wait is None:
+            self.sock.settimeout(self.timeout*.001)
+        else:
+            # a zero timeout would make the socket non-blocking.
+            self.sock.settimeout(max(1, min(self.timeout, wait))*.001)
         try:
-            data = self.sock.recv(self.bufsiz)
-            if not data: raise RFBProtocolError('unexpected EOF')
-            self.feed(data)
+            self.recv()
         except socket.timeout:
             if self.session_open:
-                self.sink.flush(self.time())
+                self.flush_sink(self.time())
+                self.check_stall()
+        return
+
+    # A heuristic: a long silence usually means a still screen, for which
+    # the server rightly holds the requests, but the requests may also have
+    # been merged or lost. One extra request, not counted in the pipeline,
+    # is harmless in the former case and gets the updates going in the latter.
+    def check_stall(self):
+        if not (self.stall and self.session_open) or self.continuous_updates: return
+        t = self.time()
+        if self.lastrecv + self.stall <= t:
+            self.lastrecv = t
+            self.request_update(count=False)
         return
 
     def send(self, s):
         return self.sock.send(s)
 
-    def close(self):
-        RFBProxy.close(self)
+    def reconnect(self):
+        "Connects to the server again and continues the same recording."
+        if self.session_open:
+            self.session_open = False
+            self.flush_sink(self.time())
         self.sock.close()
+        self.open()
+        return
+
+    def close(self):
+        try:
+            RFBProxy.close(self)
+        finally:
+            self.sock.close()
+        return
+
+
+##  RFBFileClient
+##
+##  Replays a capture file recorded by RFBNetworkClient.
+##
+class RFBFileClient(RFBProxy):
+
+    def __init__(self, fp, sink, realtime=False,
+                 preferred_encoding=(0,5), pipeline=1, continuous=False,
+                 stats=False, debug=0):
+        RFBProxy.__init__(self, sink, preferred_encoding=preferred_encoding,
+                          pipeline=pipeline, continuous=continuous,
+                          stats=stats, debug=debug)
+        self.fp = fp
+        # realtime: replay with the original timing.
+        self.realtime = realtime
+        self.curtime = 0
+        return
+
+    def open(self):
+        header = self.fp.read(len(RFBCAP_MAGIC)+1)
+        if not header.startswith(RFBCAP_MAGIC):
+            raise RFBError('Not a capture file')
+        self.bitsperpixel = ord(header[-1])
+        if self.bitsperpixel not in PIXEL_FORMATS:
+            raise RFBError('Unsupported bitsperpixel: %d' % self.bitsperpixel)
+        RFBProxy.open(self)
+        return
+
+    def time(self):
+        return self.curtime
+
+    # raises EOFError at the end of the file.
+    def idle(self):
+        header = self.fp.read(8)
+        if len(header) < 8: raise EOFError
+        (t, n) = unpack('>LL', header)
+        data = self.fp.read(n)
+        if len(data) < n: raise EOFError
+        if self.realtime:
+            dt = t*.001 - (time.time() - self.basetime*.001)
+            if 0 < dt:
+                time.sleep(dt)
+        if self.session_open:
+            # the frames before the data was received.
+            self.flush_sink(t-1)
+        self.curtime = t
+        if n == 0:
+            # reconnected.
+            self.session_open = False
+            RFBProxy.open(self)
+            return
+        self.feed(data)
+        return
+
+    # nothing is sent.
+    def send(self, s):
+        return
+
+    # no password is needed.
+    def crauth_1(self, challange):
+        return (4, self.crauth_2)
+
+
+##  RFBMultiplexer
+##
+##  Drives multiple RFBNetworkClients in one select loop.
+##
+class RFBMultiplexer(object):
+
+    def __init__(self, timeout=50, debug=0):
+        self.timeout = timeout
+        self.debug = debug
+        self.clients = {}
+        # epoll is used where available; select() is limited to FD_SETSIZE.
+        self.poll = None
+        if hasattr(select, 'epoll'):
+            self.poll = select.epoll()
+        return
+
+    def add(self, client):
+        client.open()
+        self.clients[client.fileno()] = client
+        if self.poll is not None:
+            self.poll.register(client.fileno(), select.EPOLLIN)
+        return
+
+    def remove(self, client):
+        fd = client.fileno()
+        del self.clients[fd]
+        if self.poll is not None:
+            self.poll.unregister(fd)
+        try:
+            client.close()
+        except SESSION_ERRORS, e:
+            print >>sys.stderr, 'Session error: %s:%d: %s' % (client.host, client.port, e)
+        return
+
+    def wait(self, fds, timeout):
+        if self.poll is None:
+            (ready, _, _) = select.select(list(fds), [], [], timeout*.001)
+            return ready
+        return [ fd for (fd, _) in self.poll.poll(timeout*.001) if fd in fds ]
+
+    def idle(self):
+        # one broken session does not stop the others.
+        broken = {}
+        timeout = self.timeout
+        for (fd, client) in self.clients.items():
+            try:
+                wait = client.send_scheduled_request()
+            except SESSION_ERRORS, e:
+                broken[fd] = e
+                continue
+            if wait is not None:
+                timeout = min(timeout, wait)
+        fds = set( fd for fd in self.clients if fd not in broken )
+        for fd in self.wait(fds, timeout):
+            try:
+                self.clients[fd].recv()
+            except SESSION_ERRORS, e:
+                broken[fd] = e
+        for (fd, client) in self.clients.items():
+            if fd in broken or not client.session_open: continue
+            try:
+                client.flush_sink(client.time())
+                client.check_stall()
+            except SESSION_ERRORS, e:
+                broken[fd] = e
+        for (fd, e) in broken.iteritems():
+            client = self.clients[fd]
+            print >>sys.stderr, 'Session error: %s:%d: %s' % (client.host, client.port, e)
+            self.remove(client)
+        return
+
+    def close(self):
+        for client in self.clients.values():
+            self.remove(client)
+        if self.poll is not None:
+            self.poll.close()
         return
 
 
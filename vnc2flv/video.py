@@ -5,7 +5,7 @@
 ##  Copyright (c) 2009-2010 by Yusuke Shinyama
 ##
 
-import sys, zlib, re
+import sys, zlib, re, threading, Queue
 from struct import pack, unpack
 try:
     from cStringIO import StringIO
@@ -88,11 +88,31 @@ class VideoSink(object):
         self.debug = debug
         self.clipping = clipping
         self.initialized = False
+        self.pixelformat = None
+        self.bytesperpixel = 4
+        return
+
+    # pixelformat is a 10-tuple (bitsperpixel, depth, bigendian, truecolour,
+    #   red_max, green_max, blue_max, red_shift, green_shift, blue_shift)
+    def set_format(self, pixelformat):
+        if self.debug:
+            print >>sys.stderr, 'set_format: %r' % (pixelformat,)
+        self.pixelformat = pixelformat
+        self.bytesperpixel = pixelformat[0]/8
         return
 
     def init_screen(self, width, height, name=None):
         if self.debug:
             print >>sys.stderr, 'init_screen: %dx%d, name=%r' % (width, height, name)
+        return self.get_clipping(width, height)
+
+    # returns the new clipping.
+    def resize_screen(self, width, height):
+        if self.debug:
+            print >>sys.stderr, 'resize_screen: %dx%d' % (width, height)
+        return self.get_clipping(width, height)
+
+    def get_clipping(self, width, height):
         if self.clipping:
             ((xs,x), (ys,y), w, h) = self.clipping
             if xs == '-':
@@ -108,15 +128,21 @@ class VideoSink(object):
         self.initialized = True
         return (x, y, width, height)
 
+    # returns the area that is shown in the movie as (x, y, width, height),
+    # or None if it is the entire clipping.
+    def get_visible_area(self):
+        return None
+
     # data is given as ARGB
     def convert_pixels(self, data):
         return data
     def convert_color1(self, data):
         return unpack('BBBx', data)
 
-    def update_cursor_image(self, width, height, data):
+    # data is given as ARGB. An empty image hides the cursor.
+    def update_cursor_image(self, width, height, data, (hx, hy)):
         if self.debug:
-            print >>sys.stderr, 'update_cursor_image: %dx%d' % (width, height)
+            print >>sys.stderr, 'update_cursor_image: %dx%d, hotspot=(%d,%d)' % (width, height, hx, hy)
         return
 
     def update_cursor_pos(self, x, y):
@@ -129,7 +155,67 @@ class VideoSink(object):
             print >>sys.stderr, 'update_screen_rgbabits: %dx%d at (%d,%d)' % (width,height,x,y)
         return
 
-    def update_screen_solidrect(self, (x, y), (w, h), data):
+    # data is given in the current pixel format.
+    # decodes the rectangles of a FramebufferUpdate message at once.
+    # returns (consumed, nrects); the rest is decoded by the caller.
+    def update_screen_rects(self, data, nrects):
+        return (0, 0)
+
+    def update_screen_pixels(self, (x, y), (width, height), data):
+        if self.debug:
+            print >>sys.stderr, 'update_screen_pixels: %dx%d at (%d,%d)' % (width,height,x,y)
+        return
+
+    # returns (consumed, state); state is None after the last tile.
+    def update_screen_hextile(self, (x, y), (width, height), data, state):
+        if self.debug:
+            print >>sys.stderr, 'update_screen_hextile: %dx%d at (%d,%d), state=%r' % (width,height,x,y, state)
+        # only skip the tiles.
+        (i, bg, fg) = state
+        tw = (width+15)/16
+        ntiles = tw * ((height+15)/16)
+        n = 0
+        while i < ntiles:
+            w = min(16, width-(i % tw)*16)
+            h = min(16, height-(i / tw)*16)
+            if len(data) < n+1: break
+            subenc = ord(data[n])
+            if subenc & 1:
+                m = 1+w*h*self.bytesperpixel
+            else:
+                m = 1
+                if subenc & 2: m += self.bytesperpixel
+                if subenc & 4: m += self.bytesperpixel
+                if subenc & 8:
+                    if len(data) < n+m+1: break
+                    if subenc & 16:
+                        m += 1+ord(data[n+m])*(self.bytesperpixel+2)
+                    else:
+                        m += 1+ord(data[n+m])*2
+            if len(data) < n+m: break
+            n += m
+            i += 1
+        if i < ntiles:
+            return (n, (i, bg, fg))
+        return (n, None)
+
+    def update_screen_zrle(self, (x, y), (width, height), data):
+        if self.debug:
+            print >>sys.stderr, 'update_screen_zrle: %dx%d at (%d,%d)' % (width,height,x,y)
+        return
+
+    # filter: 0=copy, 1=palette, 2=gradient.
+    def update_screen_tight(self, (x, y), (width, height), filter, data, palette):
+        if self.debug:
+            print >>sys.stderr, 'update_screen_tight: %dx%d at (%d,%d), filter=%d' % (width,height,x,y, filter)
+        return
+
+    def update_screen_copyrect(self, (x, y), (width, height), (sx, sy)):
+        if self.debug:
+            print >>sys.stderr, 'update_screen_copyrect: %dx%d at (%d,%d), from (%d,%d)' % (width,height,x,y, sx,sy)
+        return
+
+    def update_screen_solidrect(self, (x, y), (width, height), color):
         if self.debug:
             print >>sys.stderr, 'update_screen_solidrect: %dx%d at (%d,%d), color=%r' % (width,height,x,y, color)
         return
@@ -150,8 +236,12 @@ class VideoSink(object):
 class FLVVideoSink(VideoSink):
 
     def __init__(self, writer, blocksize=32, framerate=15, keyframe=0,
-                 clipping=None, panwindow=None, panspeed=0, debug=0):
+                 clipping=None, panwindow=None, panspeed=0, queuesize=0,
+                 cursor=False, threads=1, blockcache=0, debug=0):
         VideoSink.__init__(self, clipping=clipping, debug=debug)
+        if queuesize and (threads != 1 or blockcache):
+            # the encoder thread compresses the snapshots in Python.
+            raise ValueError('queuesize cannot be used with threads or blockcache')
         self.writer = writer
         self.blocksize = blocksize
         self.framerate = framerate
@@ -165,15 +255,43 @@ class FLVVideoSink(VideoSink):
         self.windowsize = None
         self.curframe = 0
         self.changes = []
+        self.forcekey = False
+        # cursor: draw the cursor given by the cursor pseudo-encodings.
+        self.cursor = cursor
+        # queuesize: if non-zero, the frames are compressed and written
+        # by a separate thread. A frame is skipped when the queue is full.
+        self.queuesize = queuesize
+        self.queue = None
+        self.encoder = None
+        self.lastdropped = None
+        # threads: the number of threads that compress the blocks of a frame.
+        self.threads = threads
+        # blockcache: the number of compressed blocks kept by their content.
+        self.blockcache = blockcache
+        self.stats = { 'frames': 0, 'dropped': 0, 'maxqueue': 0 }
         return
 
     def init_screen(self, width, height, name=None):
+        if self.screen is not None:
+            # reconnected: the last image is kept until the server sends the screen.
+            if self.pixelformat:
+                self.screen.set_format(*self.pixelformat)
+            return self.resize_screen(width, height)
         (x,y, width, height) = VideoSink.init_screen(self, width, height, name=name)
+        if self.queuesize and not self.encoder:
+            self.queue = Queue.Queue(self.queuesize)
+            self.encoder = threading.Thread(target=self.run_encoder)
+            self.encoder.setDaemon(True)
+            self.encoder.start()
         bw = (width+self.blocksize-1) / self.blocksize
         bh = (height+self.blocksize-1) / self.blocksize
         self.screenpos = (x,y)
         self.screensize = (bw,bh)
         self.screen = FlvScreen(self.blocksize, bw, bh)
+        if self.blockcache:
+            self.screen.set_cache(self.blockcache)
+        if self.pixelformat:
+            self.screen.set_format(*self.pixelformat)
         if self.panwindow:
             (w, h) = self.panwindow
             self.windowsize = ((w+self.blocksize-1) / self.blocksize,
@@ -185,37 +303,180 @@ class FLVVideoSink(VideoSink):
         self.writer.set_screen_size(width, height)
         return (x, y, width, height)
 
+    def resize_screen(self, width, height):
+        (x,y, width, height) = VideoSink.resize_screen(self, width, height)
+        bw = (width+self.blocksize-1) / self.blocksize
+        bh = (height+self.blocksize-1) / self.blocksize
+        self.screenpos = (x,y)
+        self.screensize = (bw,bh)
+        self.screen.resize(bw, bh)
+        if self.panwindow:
+            (w, h) = self.panwindow
+            self.windowsize = (min((w+self.blocksize-1) / self.blocksize, bw),
+                               min((h+self.blocksize-1) / self.blocksize, bh))
+        else:
+            self.windowsize = (bw, bh)
+        # keep the window inside the new screen.
+        (wx, wy) = self.windowpos
+        (ww, wh) = self.windowsize
+        self.windowpos = (max(0, min(wx, bw-ww)), max(0, min(wy, bh-wh)))
+        # the next frame has a different size; it must be a key frame.
+        self.forcekey = True
+        if self.queue is None:
+            self.writer.set_screen_size(width, height)
+        else:
+            # the writer belongs to the encoder thread: pass it in order.
+            self.queue.put((None, (width, height)))
+        return (x, y, width, height)
+
+    def get_visible_area(self):
+        if not self.panwindow: return None
+        (x0, y0) = self.screenpos
+        (wx, wy) = self.windowpos
+        (ww, wh) = self.windowsize
+        return (x0+wx*self.blocksize, y0+wy*self.blocksize,
+                ww*self.blocksize, wh*self.blocksize)
+
+    def convert_pixels(self, data):
+        return self.screen.convert(data)
+
+    def update_cursor_image(self, width, height, data, (hx, hy)):
+        if self.cursor:
+            self.screen.set_cursor(width, height, hx, hy, data)
+        return
+
+    def update_cursor_pos(self, x, y):
+        if self.cursor:
+            (x0,y0) = self.screenpos
+            self.screen.move_cursor(x-x0, y-y0)
+        return
+
     def update_screen_rgbabits(self, (x, y), (w, h), data):
         (x0,y0) = self.screenpos
         self.screen.blit_rgba(x-x0, y-y0, w, h, data)
         return
 
+    def update_screen_rects(self, data, nrects):
+        (x0,y0) = self.screenpos
+        return self.screen.blit_rects(x0, y0, data, nrects)
+
+    def update_screen_pixels(self, (x, y), (w, h), data):
+        (x0,y0) = self.screenpos
+        self.screen.blit_pixels(x-x0, y-y0, w, h, data)
+        return
+
+    def update_screen_hextile(self, (x, y), (w, h), data, state):
+        (x0,y0) = self.screenpos
+        return self.screen.blit_hextile(x-x0, y-y0, w, h, data, state)
+
+    def update_screen_zrle(self, (x, y), (w, h), data):
+        (x0,y0) = self.screenpos
+        self.screen.blit_zrle(x-x0, y-y0, w, h, data)
+        return
+
+    def update_screen_tight(self, (x, y), (w, h), filter, data, palette):
+        (x0,y0) = self.screenpos
+        self.screen.blit_tight(x-x0, y-y0, w, h, filter, data, palette)
+        return
+
+    def update_screen_solidrect(self, (x, y), (w, h), color):
+        (x0,y0) = self.screenpos
+        self.screen.fill_rect(x-x0, y-y0, w, h, color)
+        return
+
+    def update_screen_copyrect(self, (x, y), (w, h), (sx, sy)):
+        (x0,y0) = self.screenpos
+        self.screen.copy_rect(sx-x0, sy-y0, x-x0, y-y0, w, h)
+        return
+
     def flush(self, t):
         # t must be >= 0
         if not self.screen: return
         while 1:
             timestamp = self.curframe * 1000 / self.framerate
             if t < timestamp: break
-            self.writer.write_video_frame(timestamp, self.get_update_frame())
+            if self.queue is None:
+                self.writer.write_video_frame(timestamp, self.get_update_frame())
+                self.stats['frames'] += 1
+            elif self.queue.full():
+                # the encoder is behind: skip this frame.
+                # the changed blocks are carried over to the next frame,
+                # and so is a key frame.
+                if self.keyframe and (self.curframe % self.keyframe) == 0:
+                    self.forcekey = True
+                self.stats['dropped'] += 1
+                self.lastdropped = timestamp
+            else:
+                self.queue.put((timestamp, self.snapshot_frame()))
+                self.stats['frames'] += 1
+                self.stats['maxqueue'] = max(self.stats['maxqueue'], self.queue.qsize())
+                self.lastdropped = None
             self.curframe += 1
         return
 
+    def close(self):
+        if self.encoder:
+            if self.lastdropped is not None:
+                # do not lose the last changes.
+                self.queue.put((self.lastdropped, self.snapshot_frame()))
+                self.stats['frames'] += 1
+            self.queue.put(None)
+            self.encoder.join()
+            self.encoder = None
+        VideoSink.close(self)
+        return
+
+    # returns a dict of the statistics.
+    def get_stats(self):
+        stats = self.stats.copy()
+        if self.queue is not None:
+            stats['queued'] = self.queue.qsize()
+        else:
+            stats['queued'] = 0
+        return stats
+
+    # compress and write the frames in the queue.
+    def run_encoder(self):
+        while 1:
+            x = self.queue.get()
+            if x is None: break
+            (timestamp, snapshot) = x
+            if timestamp is None:
+                # the screen is resized from here.
+                self.writer.set_screen_size(*snapshot)
+            else:
+                self.writer.write_video_frame(timestamp, self.encode_frame(snapshot))
+        return
+
     # write SCREENVIDEOPACKET tag
     def get_update_frame(self):
-        changes = self.screen.changed()
+        (window, key) = self.next_window()
+        data = self.screen.encode_frame(window, key, -1, self.threads)
         self.screen.reset()
+        return data
+
+    # move the window and decide if the next frame is a key frame.
+    # returns ((x,y,w,h), key) in blocks.
+    def next_window(self):
         (bw,bh) = self.windowsize
-        (bx,by) = self.do_autopan(self.windowpos, changes)
-        key = ((bx,by) != self.windowpos or
+        (bx,by) = self.do_autopan(self.windowpos, self.screen.dirty_bounds())
+        key = (self.forcekey or (bx,by) != self.windowpos or
                (self.keyframe and (self.curframe % self.keyframe) == 0))
+        self.forcekey = False
         if key:
             # update the entire screen if necessary.
             self.windowpos = (bx,by)
-            changes = set( (bx+x,by+y) for y in xrange(bh) for x in xrange(bw) )
-        else:
-            changes = set(changes)
         if self.debug:
-            print >>sys.stderr, 'update(%d): changes=%r' % (self.curframe, len(changes)), sorted(changes)
+            print >>sys.stderr, 'update(%d): key=%r, changes=%r' % (self.curframe, key, self.screen.dirty_count()), sorted(self.screen.changed())
+        return ((bx,by,bw,bh), key)
+
+    # take the changed blocks out of the screen.
+    # returns (header, blocks), where an unchanged block is None.
+    def snapshot_frame(self):
+        ((bx,by,bw,bh), key) = self.next_window()
+        dirty = self.screen.dirty_map()
+        self.screen.reset()
+        sw = self.screen.block_width
         flags = 3  # screenvideo codec
         if key:
             flags |= 0x10
@@ -226,28 +487,36 @@ class FLVVideoSink(VideoSink):
         h = bh * self.blocksize
         data += chr((self.blocksize/16-1) << 4 | w >> 8) + chr(w & 0xff)
         data += chr((self.blocksize/16-1) << 4 | h >> 8) + chr(h & 0xff)
-        n = 0
+        blocks = []
         for y in xrange(bh, 0, -1):
             y = by+y-1
             for x in xrange(bw):
                 x += bx
-                if (x,y) in changes:
+                if key or dirty[y*sw+x] != '\x00':
                     # changed block
-                    block = zlib.compress(self.screen.get(x,y))
-                    data += pack('>H', len(block)) + block
+                    blocks.append(self.screen.get(x,y))
                 else:
                     # unchanged block
-                    data += pack('>H', 0)
-        return data
+                    blocks.append(None)
+        return (data, blocks)
+
+    # compress the blocks.
+    def encode_frame(self, (data, blocks)):
+        parts = [data]
+        for block in blocks:
+            if block is None:
+                parts.append('\x00\x00')
+            else:
+                block = zlib.compress(block)
+                parts.append(pack('>H', len(block)))
+                parts.append(block)
+        return ''.join(parts)
 
     # do paning.
-    def do_autopan(self, (wx,wy), changes):
-        if changes:
-            r = (min( x for (x,y) in changes ),
-                 min( y for (x,y) in changes ),
-                 max( x for (x,y) in changes )+1,
-                 max( y for (x,y) in changes )+1)
-            self.changes.append(r)
+    # bounds is (x0,y0,x1,y1) of the changed blocks or None.
+    def do_autopan(self, (wx,wy), bounds):
+        if bounds:
+            self.changes.append(bounds)
         elif self.changes:
             self.changes.append(self.changes[-1])
         self.changes = self.changes[-self.panspeed:]